@@ -1,10 +1,42 @@
 # Copyright (c) 2026, Publish and contributors
 # For license information, please see license.txt
 
+from functools import lru_cache
+
 import frappe
 from frappe.model.document import Document
+from frappe.query_builder import Criterion, Order
+from frappe.query_builder.functions import Count, Max
 from frappe.website.website_generator import WebsiteGenerator
 
+from edo.edo.doctype.edo_document_access.edo_document_access import (
+	REVOKED_RETENTION_DAYS,
+	changed_access_query,
+	remove_document_access,
+	sync_document_access,
+)
+from edo.utils.conditional import conditional_response
+from edo.utils.file_access import (
+	get_main_document_url,
+	get_url_expiry,
+	is_main_document_url,
+	resolve_file_path,
+	send_file,
+	verify_signature,
+)
+from edo.utils.fonts import get_font, get_font_path, get_pdf_font_name
+from edo.utils.link_resolver import REFERENCE_TITLE_FIELDS, LinkResolver
+from edo.utils.policy import can, check, get_user_context, scope_filters
+from edo.utils.reference_cache import get_reference, get_reference_version
+from edo.utils.stamp_assets import (
+	get_placed_stamp,
+	get_rendered_stamp,
+	get_stamp_asset,
+	rendered_stamp_key,
+)
+from edo.utils.stamp_overlay import render_overlays
+from edo.utils.tracing import span, start_span, trace
+
 
 class EDODocument(WebsiteGenerator):
 	def get_context(self, context):
@@ -12,285 +44,477 @@ class EDODocument(WebsiteGenerator):
 		context.no_cache = 1
 		return context
 
+	def validate(self):
+		super().validate()
+		self.search_text = build_search_text(self)
+
+	def on_update(self):
+		super().on_update()
+		# Used by publish_workflow_update
+		self.flags.access_users = sync_document_access(self)
+
+	def on_trash(self):
+		super().on_trash()
+		remove_document_access(self.name)
+
+	def after_rename(self, old, new, merge=False):
+		# name is part of the search text
+		self.db_set("search_text", build_search_text(self), update_modified=False)
+
+
+def on_doctype_update():
+	from edo.utils.indexes import add_workflow_indexes
+
+	ensure_search_fulltext_index()
+	add_workflow_indexes("EDO Document")
+
 
 def has_website_permission(doc, ptype, user, verbose=False):
 	"""Check if user has permission to access document on portal"""
-	if not user or user == "Guest":
-		return False
+	return can(get_user_context(user), "access", doc)
 
-	# Check if user has any EDO role
-	edo_roles = ["EDO User", "EDO Admin", "EDO Observer", "EDO Executor", "EDO Manager", "EDO Director", "EDO Reception"]
-	user_roles = frappe.get_roles(user)
-	
-	if any(role in user_roles for role in edo_roles):
-		return True
 
-	return False
+# Realtime event sent to affected users on workflow transitions, see publish_workflow_update
+WORKFLOW_UPDATE_EVENT = "edo_document_update"
+
+# Fields returned for every row of the portal document list
+PORTAL_LIST_FIELDS = (
+	"name", "title", "incoming_number", "incoming_date", "outgoing_number", "outgoing_date",
+	"document_type", "status", "priority", "correspondent", "brief_content", "creation",
+	"executor", "director_approved", "director_rejected", "reception_office",
+)
+
+# Columns the portal list can be sorted by. Keyset cursors are (value, name) pairs on one of them,
+# so only NOT NULL columns are allowed here.
+PORTAL_SORT_FIELDS = ("creation", "modified")
+PORTAL_MAX_PAGE_SIZE = 500
+
+# Fields matched by the portal search box
+PORTAL_SEARCH_FIELDS = ("name", "title", "incoming_number", "outgoing_number", "brief_content")
 
 
 @frappe.whitelist()
-def get_portal_documents(search=None, status=None, document_type=None, priority=None, correspondent=None):
-	"""Get list of documents for portal user with search and filters"""
+def get_portal_documents(search=None, status=None, document_type=None, priority=None, correspondent=None,
+		limit=None, after=None, sort_by="creation", sort_order="desc"):
+	"""Get list of documents for portal user with search and filters
+
+	Without `limit` the whole visible list is returned (legacy mode).
+	With `limit` one page is returned as {documents, next_cursor, has_more}; pass `next_cursor`
+	back as `after` to get the following page. Pages are stable because rows are ordered by
+	(sort_by, name) and the cursor is compared against both columns.
+
+	GET requests are answered with an ETag of max(modified) and count of the visible set;
+	a matching If-None-Match gets an empty 304.
+	"""
 	user = frappe.session.user
+	paginated = limit not in (None, "")
 
 	if not user or user == "Guest":
-		return []
+		return _portal_page([], paginated, sort_by)
 
-	# Check if user has any EDO role
-	edo_roles = ["EDO User", "EDO Admin", "EDO Observer", "EDO Executor", "EDO Manager", "EDO Director", "EDO Reception"]
-	user_roles = frappe.get_roles(user)
-	
-	if not any(role in user_roles for role in edo_roles):
-		return []
+	ctx = get_user_context()
+	if not can(ctx, "access"):
+		return _portal_page([], paginated, sort_by)
 
-	# Build filters
-	filters = []
-	
-	# Role-based filtering:
-	# - Manager and Admin see ALL documents
-	# - Directors see only documents assigned to their reception office (where director_user = user)
-	# - Reception users see only documents of their reception office
-	# - Executors see only documents where they are executor or co-executor
-	#   AND only in status "На исполнении" or "Выполнено" (after director approval)
-	
-	# Filter for Directors - they see documents assigned to them OR documents in their reception office
-	director_reception_offices = []
-	if "EDO Director" in user_roles and "EDO Admin" not in user_roles:
-		# Find reception offices where this user is director
-		director_reception_offices = frappe.get_all(
-			"EDO Reception Office",
-			filters={"director": user},
-			pluck="name"
-		)
-		
-		if director_reception_offices:
-			# Directors see documents where director_user = user
-			# OR documents in their reception office with status "На рассмотрении"
-			# We'll handle OR logic after getting documents
-			filters.append(["director_user", "=", user])
-		else:
-			# If director is not assigned to any reception office, only show documents explicitly assigned
-			filters.append(["director_user", "=", user])
-	
-	# Filter for Reception users - they see only documents of their reception office
-	if "EDO Reception" in user_roles and "EDO Admin" not in user_roles:
-		# Find reception office for this user
-		reception_offices = frappe.get_all(
-			"EDO Reception Office User",
-			filters={"user": user, "parenttype": "EDO Reception Office"},
-			pluck="parent"
-		)
-		
-		if reception_offices:
-			# User belongs to one or more reception offices
-			filters.append(["reception_office", "in", reception_offices])
-		else:
-			# User doesn't belong to any reception office - return empty
-			return []
-	
-	if "EDO Manager" not in user_roles and "EDO Director" not in user_roles and "EDO Admin" not in user_roles and "EDO Reception" not in user_roles:
-		# For executors: filter by executor or co_executors AND status
-		# Executors should only see documents that are approved and ready for execution
-		# Get all documents where user is executor AND status is "На исполнении" or "Выполнено"
-		executor_docs = frappe.get_all(
-			"EDO Document",
-			filters={
-				"executor": user,
-				"status": ["in", ["На исполнении", "Выполнено"]]
-			},
-			pluck="name"
+	if sort_by not in PORTAL_SORT_FIELDS:
+		frappe.throw(f"Invalid sort_by: {sort_by}", frappe.ValidationError)
+	if (sort_order or "").lower() not in ("asc", "desc"):
+		frappe.throw(f"Invalid sort_order: {sort_order}", frappe.ValidationError)
+
+	page_size = None
+	if paginated:
+		page_size = min(max(frappe.utils.cint(limit), 1), PORTAL_MAX_PAGE_SIZE)
+
+	filters = dict(
+		search=search, status=status, document_type=document_type, priority=priority, correspondent=correspondent
+	)
+
+	def version():
+		edo_document = frappe.qb.DocType("EDO Document")
+		query = frappe.qb.from_(edo_document).select(Max(edo_document.modified), Count("*"))
+		conditions = _portal_conditions(edo_document, ctx, **filters)
+		if conditions:
+			query = query.where(Criterion.all(conditions))
+		last_modified, count = query.run()[0]
+		return [str(last_modified), count, sorted(ctx.roles), filters, page_size, after, sort_by, sort_order]
+
+	def build():
+		query = _portal_documents_query(
+			ctx, **filters,
+			sort_by=sort_by, sort_order=sort_order.lower(), after=after,
+			# One extra row tells us whether there is a next page
+			limit=page_size + 1 if page_size else None,
 		)
-		
-		# Get all documents where user is co-executor AND status is "На исполнении" or "Выполнено"
-		co_executor_docs = frappe.get_all(
-			"EDO Co-Executor",
-			filters={"user": user, "parenttype": "EDO Document"},
-			pluck="parent"
+		documents = query.run(as_dict=True)
+		return _portal_page(documents, paginated, sort_by, page_size)
+
+	return conditional_response(get_portal_documents, version, build)
+
+
+# `modified` is set when a row is written, not when its transaction commits: a change written
+# before a poll but committed after it would be older than that poll's server_time
+PORTAL_SYNC_OVERLAP_SECONDS = 300
+
+
+@frappe.whitelist()
+def get_portal_document_changes(since=None):
+	"""
+	Changes of the portal document list after `since`, for clients that keep a local copy
+	of get_portal_documents.
+
+	server_time lags the clock by PORTAL_SYNC_OVERLAP_SECONDS, so consecutive calls overlap and
+	changes committed late are still returned. The same change can therefore come more than
+	once: clients apply documents by (name, modified), keeping the newest, and treat removals
+	as idempotent.
+
+	Returns:
+		documents: visible documents modified (or made visible) after `since`
+		removed: names of documents that left the user's scope - status change, reassignment, deletion
+		server_time: pass back as `since` on the next call
+		reset: no `since`, or it is older than removals are kept; reload the full list instead
+	"""
+	user = frappe.session.user
+	server_time = frappe.utils.add_to_date(frappe.utils.now_datetime(), seconds=-PORTAL_SYNC_OVERLAP_SECONDS, as_string=True)
+
+	if not user or user == "Guest":
+		frappe.throw("Not authorized", frappe.PermissionError)
+
+	result = {"documents": [], "removed": [], "server_time": server_time, "reset": False}
+
+	ctx = get_user_context()
+	if not can(ctx, "access"):
+		return result
+
+	# get_datetime(None) is now: a missing `since` has to be caught before converting
+	if not since:
+		result["reset"] = True
+		return result
+	try:
+		since = frappe.utils.get_datetime(since)
+	except Exception:
+		frappe.throw(f"Invalid since: {since}", frappe.ValidationError)
+
+	if since < frappe.utils.add_days(frappe.utils.now_datetime(), -REVOKED_RETENTION_DAYS):
+		result["reset"] = True
+		return result
+
+	edo_document = frappe.qb.DocType("EDO Document")
+	conditions = _portal_conditions(edo_document, ctx)
+
+	changed = edo_document.modified > since
+	if conditions:
+		# Restricted scope: documents can also appear without being modified (new reception office user)
+		changed = changed | edo_document.name.isin(changed_access_query(user, since))
+	result["documents"] = (
+		frappe.qb.from_(edo_document)
+		.select(*(edo_document[field] for field in PORTAL_LIST_FIELDS), edo_document.modified)
+		.where(Criterion.all([*conditions, changed]))
+		.orderby(edo_document.modified)
+	).run(as_dict=True)
+
+	if conditions:
+		access = frappe.qb.DocType("EDO Document Access")
+		visible_documents = frappe.qb.from_(edo_document).select(edo_document.name).where(Criterion.all(conditions))
+		result["removed"] = (
+			changed_access_query(user, since).where(access.document.notin(visible_documents))
+		).run(pluck=True)
+	else:
+		# Every document is visible: only deletions remove anything
+		result["removed"] = frappe.get_all(
+			"Deleted Document",
+			filters={"deleted_doctype": "EDO Document", "creation": [">", since]},
+			pluck="deleted_name"
 		)
-		
-		# Filter co-executor documents by status
-		if co_executor_docs:
-			co_executor_docs_filtered = frappe.get_all(
-				"EDO Document",
-				filters={
-					"name": ["in", co_executor_docs],
-					"status": ["in", ["На исполнении", "Выполнено"]]
-				},
-				pluck="name"
+
+	return result
+
+
+def _portal_page(documents, paginated, sort_by, page_size=None):
+	"""Shape get_portal_documents result: plain list in legacy mode, page dict otherwise"""
+	if not paginated:
+		return documents
+
+	has_more = bool(page_size) and len(documents) > page_size
+	if has_more:
+		documents = documents[:page_size]
+
+	next_cursor = None
+	if has_more and documents:
+		last = documents[-1]
+		next_cursor = [str(last.get(sort_by)), last.get("name")]
+
+	return {"documents": documents, "next_cursor": next_cursor, "has_more": has_more}
+
+
+def _portal_documents_query(ctx, search=None, status=None, document_type=None, priority=None,
+		correspondent=None, sort_by="creation", sort_order="desc", after=None, limit=None):
+	"""
+	Build the single query behind get_portal_documents; role-based filtering is
+	edo.utils.policy.scope_filters.
+
+	Returns a frappe.qb query.
+	"""
+	edo_document = frappe.qb.DocType("EDO Document")
+	conditions = _portal_conditions(
+		edo_document, ctx,
+		search=search, status=status, document_type=document_type, priority=priority, correspondent=correspondent,
+	)
+
+	sort_field = edo_document[sort_by]
+	descending = sort_order == "desc"
+
+	if after:
+		cursor = frappe.parse_json(after) if isinstance(after, str) else after
+		if not isinstance(cursor, (list, tuple)) or len(cursor) != 2:
+			frappe.throw("Invalid cursor: expected [sort_value, name]", frappe.ValidationError)
+		cursor_value, cursor_name = cursor
+		if descending:
+			conditions.append(
+				(sort_field < cursor_value) | ((sort_field == cursor_value) & (edo_document.name < cursor_name))
 			)
 		else:
-			co_executor_docs_filtered = []
-		
-		# Combine and get unique document names
-		user_doc_names = list(set(executor_docs + co_executor_docs_filtered))
-		
-		if user_doc_names:
-			filters.append(["name", "in", user_doc_names])
-		else:
-			# User has no documents assigned or all documents are not in execution status
-			return []
-	
-	# Add status filter
+			conditions.append(
+				(sort_field > cursor_value) | ((sort_field == cursor_value) & (edo_document.name > cursor_name))
+			)
+
+	order = Order.desc if descending else Order.asc
+	query = (
+		frappe.qb.from_(edo_document)
+		.select(*(edo_document[field] for field in PORTAL_LIST_FIELDS))
+		.orderby(sort_field, order=order)
+		.orderby(edo_document.name, order=order)
+	)
+	if sort_by not in PORTAL_LIST_FIELDS:
+		query = query.select(sort_field)
+	if conditions:
+		query = query.where(Criterion.all(conditions))
+	if limit:
+		query = query.limit(limit)
+
+	return query
+
+
+def _portal_conditions(edo_document, ctx, search=None, status=None, document_type=None,
+		priority=None, correspondent=None):
+	"""Conditions selecting the documents visible to the user, with the list filters applied"""
+	conditions = scope_filters(ctx, edo_document)
+
 	if status:
-		filters.append(["status", "=", status])
-	
-	# Add document type filter
+		conditions.append(edo_document.status == status)
 	if document_type:
-		filters.append(["document_type", "=", document_type])
-	
-	# Add priority filter
+		conditions.append(edo_document.document_type == document_type)
 	if priority:
-		filters.append(["priority", "=", priority])
-	
-	# Add correspondent filter
+		conditions.append(edo_document.priority == priority)
 	if correspondent:
-		filters.append(["correspondent", "=", correspondent])
-
-	# Get documents with filters
-	documents = frappe.get_all(
-		"EDO Document",
-		filters=filters,
-		fields=["name", "title", "incoming_number", "incoming_date", "outgoing_number", "outgoing_date",
-			"document_type", "status", "priority", "correspondent", "brief_content", "creation", 
-			"executor", "director_approved", "director_rejected", "reception_office"],
-		order_by="creation desc"
+		conditions.append(edo_document.correspondent == correspondent)
+
+	if search and search.strip():
+		conditions.append(_search_condition(edo_document, search))
+
+	return conditions
+
+
+# InnoDB ignores FULLTEXT tokens shorter than innodb_ft_min_token_size (3 by default)
+SEARCH_FULLTEXT_MIN_TOKEN = 3
+SEARCH_FULLTEXT_INDEX = "search_text_fulltext"
+
+
+def normalize_search_text(text):
+	"""Lower-case and collapse whitespace, the form stored in EDO Document.search_text"""
+	return " ".join((text or "").lower().split())
+
+
+def build_search_text(doc):
+	"""Search text of a document: all PORTAL_SEARCH_FIELDS joined into one normalized string"""
+	values = [doc.get(field) for field in PORTAL_SEARCH_FIELDS]
+	return normalize_search_text(" ".join(str(value) for value in values if value))
+
+
+def ensure_search_fulltext_index():
+	"""Create the FULLTEXT index on EDO Document.search_text (MariaDB only)"""
+	if frappe.db.db_type != "mariadb":
+		return
+	if not frappe.db.has_column("EDO Document", "search_text"):
+		return
+	if frappe.db.sql("SHOW INDEX FROM `tabEDO Document` WHERE Key_name = %s", SEARCH_FULLTEXT_INDEX):
+		return
+	frappe.db.sql_ddl(
+		f"ALTER TABLE `tabEDO Document` ADD FULLTEXT INDEX `{SEARCH_FULLTEXT_INDEX}` (`search_text`)"
 	)
-	
-	# For Directors: also get documents from their reception office with status "На рассмотрении"
-	if director_reception_offices:
-		# Build additional filters for documents in reception office
-		additional_filters = []
-		
-		# Copy all filters except director_user
-		for f in filters:
-			if isinstance(f, list) and len(f) > 0 and f[0] != "director_user":
-				additional_filters.append(f)
-		
-		# Add reception office and status filters
-		additional_filters.append(["reception_office", "in", director_reception_offices])
-		additional_filters.append(["status", "=", "На рассмотрении"])
-		
-		additional_docs = frappe.get_all(
-			"EDO Document",
-			filters=additional_filters,
-			fields=["name", "title", "incoming_number", "incoming_date", "outgoing_number", "outgoing_date",
-				"document_type", "status", "priority", "correspondent", "brief_content", "creation", 
-				"executor", "director_approved", "director_rejected", "reception_office"],
-			order_by="creation desc"
+
+
+def _search_condition(edo_document, search):
+	"""
+	Portal search condition on the indexed search_text column.
+
+	Every word of the query must match the document. Words of letters prefix-match a word of
+	the document (MATCH ... AGAINST in boolean mode, served by the FULLTEXT index): "иван"
+	finds "Иванов", "ванов" doesn't. Words with digits (registration numbers: "123" finds
+	"01-02/00123") and words shorter than the FULLTEXT minimum token keep the substring match,
+	as does the whole query on non-MariaDB databases.
+	"""
+	import re
+
+	search = normalize_search_text(search)
+	tokens = re.findall(r"\w+", search)
+
+	if frappe.db.db_type != "mariadb" or not tokens:
+		return edo_document.search_text.like(_like_pattern(search))
+
+	fulltext_tokens = [
+		token for token in tokens
+		if len(token) >= SEARCH_FULLTEXT_MIN_TOKEN and not any(char.isdigit() for char in token)
+	]
+	conditions = [
+		edo_document.search_text.like(_like_pattern(token)) for token in tokens if token not in fulltext_tokens
+	]
+	if fulltext_tokens:
+		conditions.append(
+			_FulltextMatch(edo_document.search_text, " ".join(f"+{token}*" for token in fulltext_tokens))
 		)
-		
-		# Merge documents, avoiding duplicates
-		existing_names = {doc["name"] for doc in documents}
-		for doc in additional_docs:
-			if doc["name"] not in existing_names:
-				documents.append(doc)
-				existing_names.add(doc["name"])
-
-	# Apply search filter after getting documents (for OR search across multiple fields)
-	if search and search.strip():
-		search_lower = search.lower()
-		documents = [
-			doc for doc in documents
-			if (
-				search_lower in (doc.get("name") or "").lower() or
-				search_lower in (doc.get("title") or "").lower() or
-				search_lower in (doc.get("incoming_number") or "").lower() or
-				search_lower in (doc.get("outgoing_number") or "").lower() or
-				search_lower in (doc.get("brief_content") or "").lower()
-			)
-		]
+	return Criterion.all(conditions)
+
+
+def _like_pattern(value):
+	"""LIKE pattern matching value anywhere, with its own % and _ taken literally"""
+	for char in ("\\", "%", "_"):
+		value = value.replace(char, "\\" + char)
+	return f"%{value}%"
 
-	return documents
+
+class _FulltextMatch(Criterion):
+	"""MATCH(column) AGAINST('expression' IN BOOLEAN MODE)"""
+
+	def __init__(self, column, expression):
+		super().__init__()
+		self.column = column
+		self.expression = expression
+
+	def get_sql(self, **kwargs):
+		# expression is built from \w+ tokens only, so it can't carry % or quotes
+		return f"MATCH({self.column.get_sql(**kwargs)}) AGAINST ({frappe.db.escape(self.expression)} IN BOOLEAN MODE)"
 
 
 @frappe.whitelist()
 def get_user_roles():
 	"""Get current user roles"""
-	user = frappe.session.user
-	
-	if not user or user == "Guest":
+	ctx = get_user_context()
+	if ctx.is_guest:
 		return []
-	
-	return frappe.get_roles(user)
+
+	return list(ctx.roles)
+
+
+# Link fields of EDO Document expanded to "<fieldname>_name" in get_document
+DOCUMENT_REFERENCE_LINKS = {
+	"correspondent": "EDO Correspondent",
+	"document_type": "EDO Document Type",
+	"priority": "EDO Priority",
+	"classification": "EDO Classification",
+	"delivery_method": "EDO Delivery Method",
+}
+
+
+# Child tables of EDO Document, counted in get_document's ETag
+DOCUMENT_CHILD_TABLES = {
+	"attachments": "EDO Document Attachment",
+	"co_executors": "EDO Co-Executor",
+	"signatures": "EDO Document Signature",
+}
 
 
 @frappe.whitelist()
 def get_document(name):
-	"""Get a single document by name"""
-	user = frappe.session.user
+	"""Get a single document by name
 
-	if not user or user == "Guest":
+	GET requests are answered with an ETag of modified and child-row counts (plus reference data
+	version and file URL expiry); a matching If-None-Match gets an empty 304.
+	"""
+	ctx = get_user_context()
+	if ctx.is_guest:
 		frappe.throw("Not authorized", frappe.PermissionError)
 
-	# Check if user has any EDO role
-	edo_roles = ["EDO User", "EDO Admin", "EDO Observer", "EDO Executor", "EDO Manager", "EDO Director", "EDO Reception"]
-	user_roles = frappe.get_roles(user)
-	
-	if not any(role in user_roles for role in edo_roles):
-		frappe.throw("No permission to view documents", frappe.PermissionError)
+	def build():
+		doc = frappe.get_doc("EDO Document", name)
+		check(ctx, "read", doc)
+		return _document_payload(doc, ctx.user)
 
-	# Get document
-	doc = frappe.get_doc("EDO Document", name)
-	
-	# For Directors: check if they can view this document
-	# Directors can see documents assigned to them OR documents in their reception office that are ready for review
-	if "EDO Director" in user_roles and "EDO Admin" not in user_roles:
-		# Check if document is assigned to this director
-		if doc.director_user and doc.director_user != user:
-			frappe.throw("No permission to view this document. It is assigned to a different director.", frappe.PermissionError)
-		
-		# If director_user is not set yet, check if director is assigned to the reception office
-		if not doc.director_user:
-			if doc.reception_office:
-				reception_office_doc = frappe.get_doc("EDO Reception Office", doc.reception_office)
-				if reception_office_doc.director != user:
-					frappe.throw("No permission to view this document. It belongs to a different reception office.", frappe.PermissionError)
-			else:
-				# Document has no reception office - director cannot view it
-				frappe.throw("No permission to view this document. It is not assigned to any reception office.", frappe.PermissionError)
-	
-	# For Reception users: check if they can view this document
-	# Reception users can only see documents of their reception office
-	if "EDO Reception" in user_roles and "EDO Admin" not in user_roles:
-		# Find reception office for this user
-		reception_offices = frappe.get_all(
-			"EDO Reception Office User",
-			filters={"user": user, "parenttype": "EDO Reception Office"},
-			pluck="parent"
+	return conditional_response(get_document, lambda: _document_version(name, ctx), build)
+
+
+def _document_version(name, ctx):
+	"""
+	ETag parts of get_document from one query, after the same access checks as a full load
+	(so a 304 is never sent to a user who can't read the document).
+	"""
+	edo_document = frappe.qb.DocType("EDO Document")
+	query = frappe.qb.from_(edo_document).select(
+		edo_document.name, edo_document.modified, edo_document.status, edo_document.executor,
+		edo_document.director_user, edo_document.reception_office,
+	).where(edo_document.name == name)
+
+	for fieldname, child_doctype in DOCUMENT_CHILD_TABLES.items():
+		child = frappe.qb.DocType(child_doctype)
+		query = query.select(
+			frappe.qb.from_(child).select(Count("*"))
+			.where((child.parent == edo_document.name) & (child.parenttype == "EDO Document") & (child.parentfield == fieldname))
+			.as_(f"{fieldname}_count")
 		)
-		
-		if not reception_offices:
-			frappe.throw("You are not assigned to any reception office", frappe.PermissionError)
-		
-		# Check if document belongs to user's reception office
-		if doc.reception_office not in reception_offices:
-			frappe.throw("No permission to view this document. It belongs to a different reception office.", frappe.PermissionError)
-	
-	# For executors: check if they can view this document
-	# Executors can only see documents where they are executor/co-executor
-	# AND only in status "На исполнении" or "Выполнено"
-	if "EDO Manager" not in user_roles and "EDO Director" not in user_roles and "EDO Admin" not in user_roles and "EDO Reception" not in user_roles:
-		# Check if user is executor or co-executor
-		is_executor = doc.executor == user
-		is_co_executor = False
-		
-		if doc.co_executors:
-			for co_exec in doc.co_executors:
-				if co_exec.user == user:
-					is_co_executor = True
-					break
-		
-		if not is_executor and not is_co_executor:
-			frappe.throw("No permission to view this document", frappe.PermissionError)
-		
-		# Check if document is in execution status
-		if doc.status not in ["На исполнении", "Выполнено"]:
-			frappe.throw("Document is not available for execution yet. It must be approved by director first.", frappe.PermissionError)
-	
-	# Check website permission
-	if not has_website_permission(doc, "read", user):
-		frappe.throw("No permission to view document", frappe.PermissionError)
-	
+	co_executor = frappe.qb.DocType("EDO Co-Executor")
+	query = query.select(
+		frappe.qb.from_(co_executor).select(Count("*"))
+		.where((co_executor.parent == edo_document.name) & (co_executor.parenttype == "EDO Document") & (co_executor.user == ctx.user))
+		.as_("is_co_executor")
+	)
+
+	rows = query.run(as_dict=True)
+	if not rows:
+		frappe.throw(f"EDO Document {name} not found", frappe.DoesNotExistError)
+	row = rows[0]
+
+	# Enough of the document for the access checks
+	row.co_executors = [frappe._dict(user=ctx.user)] if row.is_co_executor else []
+	check(ctx, "read", row)
+
+	return [
+		str(row.modified),
+		[row[f"{fieldname}_count"] for fieldname in DOCUMENT_CHILD_TABLES],
+		get_reference_version(),
+		get_url_expiry(),
+	]
+
+
+@frappe.whitelist()
+def get_document_view(name):
+	"""
+	Everything the portal needs to open a document, from one load of the document and roles:
+	the document (as get_document), its comment timeline, the user's roles and capability flags.
+
+	`modified` is the document's modified timestamp - refetch when it changes.
+	"""
+	ctx = get_user_context()
+	if ctx.is_guest:
+		frappe.throw("Not authorized", frappe.PermissionError)
+
+	doc = frappe.get_doc("EDO Document", name)
+	check(ctx, "read", doc)
+
+	return {
+		"document": _document_payload(doc, ctx.user),
+		"comments": _get_comment_timeline(doc.doctype, doc.name),
+		"roles": list(ctx.roles),
+		"capabilities": {
+			"can_edit": can(ctx, "edit", doc),
+			"can_director_approve": can(ctx, "approve_any"),
+			"can_executor_sign": can(ctx, "sign", doc),
+			"can_reception_submit": can(ctx, "reception_submit"),
+		},
+		"modified": str(doc.modified),
+	}
+
+
+def _document_payload(doc, user):
+	"""get_document response: the document with Link titles, user names and a signed file URL"""
 	# Get document as dict - All roles should see all fields (permissions already checked)
 	result = doc.as_dict()
 	
@@ -305,25 +529,30 @@ def get_document(name):
 		if field not in result:
 			result[field] = None
 	
+	# Collect every linked record the response needs and fetch them with one query per doctype
+	resolver = LinkResolver()
+	for fieldname, doctype in DOCUMENT_REFERENCE_LINKS.items():
+		resolver.add(doctype, doc.get(fieldname), [REFERENCE_TITLE_FIELDS[doctype]])
+	resolver.add("EDO Resolution", doc.resolution, ["resolution_name", "resolution_text"])
+	user_fields = ["full_name", "user_image"]
+	for linked_user in [doc.executor, doc.director_user, doc.reception_user]:
+		resolver.add("User", linked_user, user_fields)
+	for row in (doc.co_executors or []) + (doc.signatures or []):
+		resolver.add("User", row.user, user_fields)
+	resolver.resolve()
+
 	# Expand Link fields to show names instead of just IDs
-	if doc.correspondent:
-		result["correspondent_name"] = frappe.db.get_value("EDO Correspondent", doc.correspondent, "correspondent_name") or doc.correspondent
-	if doc.document_type:
-		result["document_type_name"] = frappe.db.get_value("EDO Document Type", doc.document_type, "document_type_name") or doc.document_type
-	if doc.priority:
-		result["priority_name"] = frappe.db.get_value("EDO Priority", doc.priority, "priority_name") or doc.priority
+	for fieldname, doctype in DOCUMENT_REFERENCE_LINKS.items():
+		if doc.get(fieldname):
+			result[f"{fieldname}_name"] = resolver.get_title(doctype, doc.get(fieldname))
 	# Status is now a Select field, no need for status_name (it was for Link field compatibility)
 	# Keeping status_name for backward compatibility but it's the same as status
 	if doc.status:
 		result["status_name"] = doc.status
-	if doc.classification:
-		result["classification_name"] = frappe.db.get_value("EDO Classification", doc.classification, "classification_name") or doc.classification
-	if doc.delivery_method:
-		result["delivery_method_name"] = frappe.db.get_value("EDO Delivery Method", doc.delivery_method, "delivery_method_name") or doc.delivery_method
 	
 	# Get resolution info if exists
 	if doc.resolution:
-		resolution_info = frappe.db.get_value("EDO Resolution", doc.resolution, ["resolution_name", "resolution_text"], as_dict=True)
+		resolution_info = resolver.get_row("EDO Resolution", doc.resolution)
 		if resolution_info:
 			result["resolution_name"] = resolution_info.get("resolution_name")
 			result["resolution_text_from_link"] = resolution_info.get("resolution_text")
@@ -334,7 +563,7 @@ def get_document(name):
 
 	# Get executor info with full name and image
 	if doc.executor:
-		executor_info = frappe.db.get_value("User", doc.executor, ["full_name", "user_image"], as_dict=True)
+		executor_info = resolver.get_row("User", doc.executor)
 		if executor_info:
 			result["executor_full_name"] = executor_info.get("full_name") or doc.executor
 			result["executor_image"] = executor_info.get("user_image")
@@ -345,7 +574,7 @@ def get_document(name):
 		for co_exec in doc.co_executors:
 			co_exec_dict = co_exec.as_dict()
 			if co_exec.user:
-				user_info = frappe.db.get_value("User", co_exec.user, ["full_name", "user_image"], as_dict=True)
+				user_info = resolver.get_row("User", co_exec.user)
 				if user_info:
 					co_exec_dict["user_full_name"] = user_info.get("full_name") or co_exec.user
 					co_exec_dict["user_image"] = user_info.get("user_image")
@@ -358,7 +587,7 @@ def get_document(name):
 		for sig in doc.signatures:
 			sig_dict = sig.as_dict()
 			if sig.user:
-				user_info = frappe.db.get_value("User", sig.user, ["full_name", "user_image"], as_dict=True)
+				user_info = resolver.get_row("User", sig.user)
 				if user_info:
 					sig_dict["user_full_name"] = user_info.get("full_name") or sig.user
 					sig_dict["user_image"] = user_info.get("user_image")
@@ -367,54 +596,55 @@ def get_document(name):
 
 	# Get director info
 	if doc.director_user:
-		director_info = frappe.db.get_value("User", doc.director_user, ["full_name", "user_image"], as_dict=True)
+		director_info = resolver.get_row("User", doc.director_user)
 		if director_info:
 			result["director_full_name"] = director_info.get("full_name") or doc.director_user
 			result["director_image"] = director_info.get("user_image")
 	
 	# Get reception info
 	if doc.reception_user:
-		reception_info = frappe.db.get_value("User", doc.reception_user, ["full_name", "user_image"], as_dict=True)
+		reception_info = resolver.get_row("User", doc.reception_user)
 		if reception_info:
 			result["reception_full_name"] = reception_info.get("full_name") or doc.reception_user
 			result["reception_image"] = reception_info.get("user_image")
 
-	# Process main_document URL - make it accessible with full URL
+	# main_document: external URLs as they are, site files through a signed streaming URL
 	if doc.main_document:
-		main_doc_url = doc.main_document
-		
-		# If already a full URL, keep it
-		if main_doc_url.startswith("http://") or main_doc_url.startswith("https://"):
-			result["main_document"] = main_doc_url
+		result["main_document_file"] = doc.main_document
+		if doc.main_document.startswith("http://") or doc.main_document.startswith("https://"):
+			result["main_document"] = doc.main_document
 		else:
-			# Ensure URL starts with /
-			if not main_doc_url.startswith("/"):
-				main_doc_url = "/" + main_doc_url
-			
-			# Try to find file and make it public if it's private
-			try:
-				from frappe.core.doctype.file.utils import find_file_by_url
-				file = find_file_by_url(main_doc_url)
-				
-				if file and file.is_private:
-					# Make file public so it can be accessed in iframe
-					file.is_private = 0
-					file.save(ignore_permissions=True)
-					# Update file_url if it changed
-					if file.file_url != main_doc_url:
-						main_doc_url = file.file_url
-						if not main_doc_url.startswith("/"):
-							main_doc_url = "/" + main_doc_url
-			except:
-				pass  # Continue even if file not found
-			
-			# Get full URL for public files
-			full_url = frappe.utils.get_url(main_doc_url, full_address=True)
-			result["main_document"] = full_url
+			result["main_document"] = get_main_document_url(doc.name, doc.main_document, user)
 
 	return result
 
 
+@frappe.whitelist(methods=["GET", "HEAD"])
+def stream_main_document(name, expires=None, signature=None, filename=None):
+	"""
+	Serve the main file of a document from a URL signed by get_document.
+
+	Permissions were checked when the URL was issued; here only the signature (bound to the
+	session user) is verified, so PDF viewers can issue Range requests cheaply.
+	"""
+	import mimetypes
+	import os
+
+	user = frappe.session.user
+	if not user or user == "Guest":
+		frappe.throw("Not authorized", frappe.PermissionError)
+
+	verify_signature(name, user, expires, signature)
+
+	file_url = frappe.db.get_value("EDO Document", name, "main_document")
+	relative_path, full_path = resolve_file_path(file_url)
+	if not full_path:
+		frappe.throw("File not found", frappe.DoesNotExistError)
+
+	mimetype = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+	return send_file(relative_path, full_path, mimetype, os.path.basename(full_path))
+
+
 @frappe.whitelist()
 def get_comments(doctype, docname):
 	"""Get comments for a document"""
@@ -423,19 +653,16 @@ def get_comments(doctype, docname):
 	if not user or user == "Guest":
 		frappe.throw("Not authorized", frappe.PermissionError)
 
-	# Check if user has any EDO role
-	edo_roles = ["EDO User", "EDO Admin", "EDO Observer", "EDO Executor", "EDO Manager", "EDO Director", "EDO Reception"]
-	user_roles = frappe.get_roles(user)
-	
-	if not any(role in user_roles for role in edo_roles):
-		frappe.throw("No permission to view document", frappe.PermissionError)
-	
-	# Check if document exists and user has website permission
-	if doctype == "EDO Document":
-		doc = frappe.get_doc(doctype, docname)
-		if not has_website_permission(doc, "read", user):
-			frappe.throw("No permission to view document", frappe.PermissionError)
+	check(get_user_context(), "access")
+
+	# Check if document exists
+	if doctype == "EDO Document" and not frappe.db.exists(doctype, docname):
+		frappe.throw(f"{doctype} {docname} not found", frappe.DoesNotExistError)
+
+	return _get_comment_timeline(doctype, docname)
 
+
+def _get_comment_timeline(doctype, docname):
 	# Получаем все типы комментариев для истории (Comment, Workflow, Info, Created, Updated и т.д.)
 	comments = frappe.get_all(
 		"Comment",
@@ -459,18 +686,11 @@ def add_comment(doctype, docname, content):
 	if not user or user == "Guest":
 		frappe.throw("Not authorized", frappe.PermissionError)
 
-	# Check if user has any EDO role
-	edo_roles = ["EDO User", "EDO Admin", "EDO Observer", "EDO Executor", "EDO Manager", "EDO Director", "EDO Reception"]
-	user_roles = frappe.get_roles(user)
-	
-	if not any(role in user_roles for role in edo_roles):
-		frappe.throw("No permission to view document", frappe.PermissionError)
-	
-	# Check if document exists and user has website permission
-	if doctype == "EDO Document":
-		doc = frappe.get_doc(doctype, docname)
-		if not has_website_permission(doc, "read", user):
-			frappe.throw("No permission to view document", frappe.PermissionError)
+	check(get_user_context(), "access")
+
+	# Check if document exists
+	if doctype == "EDO Document" and not frappe.db.exists(doctype, docname):
+		frappe.throw(f"{doctype} {docname} not found", frappe.DoesNotExistError)
 
 	# Create comment
 	comment = frappe.get_doc({
@@ -503,8 +723,7 @@ def delete_comment(comment_name):
 		frappe.throw("Not authorized", frappe.PermissionError)
 
 	# Only EDO Admin can delete comments
-	if "EDO Admin" not in frappe.get_roles(user):
-		frappe.throw("Only administrators can delete comments", frappe.PermissionError)
+	check(get_user_context(), "delete_comment")
 
 	# Get comment to check it exists
 	comment = frappe.get_doc("Comment", comment_name)
@@ -544,13 +763,8 @@ def create_document(**kwargs):
 	if not user or user == "Guest":
 		frappe.throw("Not authorized", frappe.PermissionError)
 
-	# Check if user has permission to create documents
 	# Admin and Manager can create documents
-	user_roles = frappe.get_roles(user)
-	can_create = "EDO Admin" in user_roles or "EDO Manager" in user_roles
-	
-	if not can_create:
-		frappe.throw("You don't have permission to create documents", frappe.PermissionError)
+	check(get_user_context(), "create")
 
 	# Set default status if not provided
 	if "status" not in kwargs or not kwargs["status"]:
@@ -612,26 +826,21 @@ def update_document(name, **kwargs):
 	if not user or user == "Guest":
 		frappe.throw("Not authorized", frappe.PermissionError)
 
-	user_roles = frappe.get_roles(user)
-	is_admin = "EDO Admin" in user_roles
-	is_director = "EDO Director" in user_roles or is_admin
-
+	ctx = get_user_context()
 	doc = frappe.get_doc("EDO Document", name)
 
 	# Director/Admin: when document is "На рассмотрении", allow updating only resolution and executors
-	if is_director and doc.status == "На рассмотрении":
+	if (ctx.is_director or ctx.is_admin) and doc.status == "На рассмотрении":
 		requested_keys = set(k for k in kwargs.keys() if k not in ("name", "doctype", "creation", "modified", "owner"))
 		if not requested_keys.issubset(DIRECTOR_RESOLUTION_UPDATE_FIELDS):
 			frappe.throw("В статусе «На рассмотрении» директор может менять только резолюцию и исполнителей.", frappe.ValidationError)
 		# Admin can update any doc; Director only docs assigned to them
-		if not is_admin:
-			if not doc.director_user or doc.director_user != user:
-				frappe.throw("Вы можете изменять только документы, назначенные вашей приёмной.", frappe.PermissionError)
+		check(ctx, "update_resolution", doc)
 		for key, value in kwargs.items():
 			if key not in ["name", "doctype", "creation", "modified", "owner"] and key in DIRECTOR_RESOLUTION_UPDATE_FIELDS:
 				if hasattr(doc, key):
 					if key == "resolution" and value:
-						if not frappe.db.exists("EDO Resolution", value):
+						if not get_reference("EDO Resolution", value):
 							frappe.throw(f"Резолюция «{value}» не найдена.", frappe.ValidationError)
 						doc.resolution = value
 						doc.resolution_text = None
@@ -648,12 +857,7 @@ def update_document(name, **kwargs):
 		return doc.as_dict()
 
 	# Обычное редактирование: только документ в статусе "Новый" и без подписей (кроме админа)
-	if not is_admin:
-		if doc.status != "Новый" or (doc.signatures and len(doc.signatures) > 0):
-			frappe.throw("Документ уже подписан или обработан. Редактирование доступно только администратору.", frappe.PermissionError)
-		can_edit = "EDO Manager" in user_roles or "EDO Director" in user_roles
-		if not can_edit:
-			frappe.throw("You don't have permission to edit documents", frappe.PermissionError)
+	check(ctx, "edit", doc)
 
 	protected_fields = [
 		"status", "director_approved", "director_rejected", "director_user", "director_decision_date",
@@ -665,6 +869,9 @@ def update_document(name, **kwargs):
 			if key in protected_fields:
 				frappe.throw(f"Field '{key}' cannot be changed manually. It is set automatically by the workflow.", frappe.ValidationError)
 			if hasattr(doc, key):
+				if key == "main_document" and is_main_document_url(value):
+					# Signed URL from get_document sent back unchanged - the file stays the same
+					continue
 				if key == "co_executors" and isinstance(value, list):
 					doc.set("co_executors", [])
 					for item in value:
@@ -688,27 +895,15 @@ def can_edit_document(document_name=None):
 	if not user or user == "Guest":
 		return False
 
-	user_roles = frappe.get_roles(user)
-	is_admin = "EDO Admin" in user_roles
-	
-	# Админ всегда может редактировать
-	if is_admin:
-		return True
-	
-	# Если указан конкретный документ, проверяем его статус
+	doc = None
 	if document_name:
 		try:
 			doc = frappe.get_doc("EDO Document", document_name)
-			# Если документ уже не в статусе "Новый" или есть подписи, редактирование закрыто для всех кроме админа
-			if doc.status != "Новый" or (doc.signatures and len(doc.signatures) > 0):
-				return False
 		except Exception:
 			# Если документ не найден, возвращаем базовую проверку
 			pass
-	
-	# Manager и Director могут редактировать только новые документы
-	can_edit = "EDO Manager" in user_roles or "EDO Director" in user_roles
-	return can_edit
+
+	return can(get_user_context(), "edit", doc)
 
 
 @frappe.whitelist()
@@ -758,16 +953,7 @@ LEXDOC_FISKA_API_KEY = "fk_3662b4f84723836346270d049aa2ae2c53065d391b5abdb7"
 
 def _check_director_can_approve(doc, user):
 	"""Проверки прав директора для согласования (общие для director_approve и fiska flow)."""
-	if not user or user == "Guest":
-		frappe.throw("Not authorized", frappe.PermissionError)
-	user_roles = frappe.get_roles(user)
-	if "EDO Director" not in user_roles and "EDO Admin" not in user_roles:
-		frappe.throw("Only Director can approve documents", frappe.PermissionError)
-	if doc.status != "На рассмотрении":
-		frappe.throw("Document must be in 'На рассмотрении' status to be approved (Reception must process it first)", frappe.ValidationError)
-	if "EDO Admin" not in user_roles:
-		if not doc.director_user or doc.director_user != user:
-			frappe.throw("You can only approve documents assigned to your reception office", frappe.PermissionError)
+	check(get_user_context(user), "approve", doc)
 
 
 @frappe.whitelist()
@@ -790,10 +976,19 @@ def get_fiska_pdf(name, resolution=None, resolution_text=None):
 	api_key = LEXDOC_FISKA_API_KEY
 	url = "https://oddo.tcld.uz/api/method/lexdoc.lexdoc.api.generate_fiska_pdf"
 
+	# Все ФИО, приоритеты и резолюция — одним запросом на doctype
+	resolver = LinkResolver()
+	resolver.add("User", doc.executor, ["full_name"])
+	resolver.add("User", doc.director_user, ["full_name"])
+	for row in doc.co_executors or []:
+		resolver.add("User", getattr(row, "user", None), ["full_name", "edo_fiska_priority"])
+	resolver.add("EDO Resolution", doc.resolution, ["resolution_text", "resolution_name"])
+	resolver.resolve()
+
 	# Исполнитель (первый) — ФИО
 	executor_name = ""
 	if doc.executor:
-		executor_name = frappe.db.get_value("User", doc.executor, "full_name") or doc.executor
+		executor_name = resolver.get_title("User", doc.executor)
 
 	# Соисполнители: только из таблицы co_executors; приоритет из User.edo_fiska_priority (меньше — выше в списке на фишке)
 	co_executors = []
@@ -804,8 +999,8 @@ def get_fiska_pdf(name, resolution=None, resolution_text=None):
 				continue
 			if u == doc.executor:
 				continue
-			nm = frappe.db.get_value("User", u, "full_name") or u
-			prio = frappe.db.get_value("User", u, "edo_fiska_priority")
+			nm = resolver.get_title("User", u)
+			prio = resolver.get_value("User", u, "edo_fiska_priority")
 			if prio is None:
 				prio = i
 			co_executors.append({"name": nm, "priority": int(prio)})
@@ -814,7 +1009,7 @@ def get_fiska_pdf(name, resolution=None, resolution_text=None):
 	# Руководитель (внизу справа от QR)
 	head_name = ""
 	if doc.director_user:
-		head_name = frappe.db.get_value("User", doc.director_user, "full_name") or doc.director_user
+		head_name = resolver.get_title("User", doc.director_user)
 
 	# Текст верификации (ERI, Hujjat kodi)
 	verification_text = f"edoc.uztelecom.uz tizimi orqali ERI bilan tasdiqlangan, Hujjat kodi: {doc.name}"
@@ -827,7 +1022,7 @@ def get_fiska_pdf(name, resolution=None, resolution_text=None):
 		resolution_text_val = str(resolution_text).strip()
 	if not resolution_name_val or not resolution_text_val:
 		if doc.resolution:
-			resolution_info = frappe.db.get_value("EDO Resolution", doc.resolution, ["resolution_text", "resolution_name"], as_dict=True)
+			resolution_info = resolver.get_row("EDO Resolution", doc.resolution)
 			if resolution_info:
 				if not resolution_text_val:
 					resolution_text_val = (resolution_info.get("resolution_text") or "").strip()
@@ -953,6 +1148,7 @@ def director_approve_with_fiska(name, comment=None, signed_pdf_base64=None, pkcs
 		else:
 			doc.status = "Согласован"
 		doc.save(ignore_permissions=True)
+		publish_workflow_update(doc)
 		result = doc.as_dict()
 		result["verification_url"] = verification_url
 		return result
@@ -961,6 +1157,17 @@ def director_approve_with_fiska(name, comment=None, signed_pdf_base64=None, pkcs
 		frappe.throw(f"Ошибка запроса к сервису: {str(e)[:200]}", frappe.ValidationError)
 
 
+def publish_workflow_update(doc):
+	"""
+	Push the new state of a document to every user whose inbox changed: users related to it
+	before or after the transition (director, office director, executor, co-executors, reception).
+	Sent after commit, so a client refetching on the event sees the new data.
+	"""
+	message = {"name": doc.name, "status": doc.status, "modified": str(doc.modified)}
+	for user in doc.flags.access_users or ():
+		frappe.publish_realtime(WORKFLOW_UPDATE_EVENT, message, user=user, after_commit=True)
+
+
 @frappe.whitelist()
 def director_reject_document(name, comment=None):
 	"""Director rejects a document"""
@@ -969,23 +1176,15 @@ def director_reject_document(name, comment=None):
 	if not user or user == "Guest":
 		frappe.throw("Not authorized", frappe.PermissionError)
 
-	# Check if user is Director or Admin
-	user_roles = frappe.get_roles(user)
-	if "EDO Director" not in user_roles and "EDO Admin" not in user_roles:
+	ctx = get_user_context()
+	if not ctx.is_director and not ctx.is_admin:
 		frappe.throw("Only Director can reject documents", frappe.PermissionError)
 
 	# Get document
 	doc = frappe.get_doc("EDO Document", name)
 
-	# Check if document is in "На рассмотрении" status (after reception processed it)
-	if doc.status != "На рассмотрении":
-		frappe.throw("Document must be in 'На рассмотрении' status to be rejected (Reception must process it first)", frappe.ValidationError)
-	
-	# Check if this director is assigned to this document
-	# Admin can reject any document, but Director can only reject documents assigned to them
-	if "EDO Admin" not in user_roles:
-		if not doc.director_user or doc.director_user != user:
-			frappe.throw("You can only reject documents assigned to your reception office", frappe.PermissionError)
+	# Document on review, assigned to this director (Admin can reject any)
+	check(ctx, "reject", doc)
 
 	# Update document
 	doc.director_approved = 0
@@ -998,6 +1197,7 @@ def director_reject_document(name, comment=None):
 	doc.status = "Отказан"
 	
 	doc.save(ignore_permissions=True)
+	publish_workflow_update(doc)
 	
 	return doc.as_dict()
 
@@ -1012,29 +1212,9 @@ def executor_sign_document(name, comment=None):
 
 	# Get document
 	doc = frappe.get_doc("EDO Document", name)
-	
-	# Check if document is in "На исполнении" status
-	if doc.status != "На исполнении":
-		frappe.throw("Document must be in 'На исполнении' status to be signed", frappe.ValidationError)
-
-	# Check if user is executor or co-executor
-	is_executor = doc.executor == user
-	is_co_executor = False
-	
-	if doc.co_executors:
-		for co_exec in doc.co_executors:
-			if co_exec.user == user:
-				is_co_executor = True
-				break
-	
-	if not is_executor and not is_co_executor:
-		frappe.throw("You are not assigned as executor or co-executor for this document", frappe.PermissionError)
 
-	# Check if user already signed
-	if doc.signatures:
-		for sig in doc.signatures:
-			if sig.user == user:
-				frappe.throw("You have already signed this document", frappe.ValidationError)
+	# In "На исполнении", user is executor or co-executor and hasn't signed yet
+	check(get_user_context(), "sign", doc)
 
 	# Add signature
 	doc.append("signatures", {
@@ -1061,6 +1241,7 @@ def executor_sign_document(name, comment=None):
 		doc.status = "Выполнено"
 	
 	doc.save(ignore_permissions=True)
+	publish_workflow_update(doc)
 	
 	return doc.as_dict()
 
@@ -1073,23 +1254,8 @@ def can_director_approve():
 	if not user or user == "Guest":
 		return False
 
-	user_roles = frappe.get_roles(user)
-	
-	# Admin can always approve
-	if "EDO Admin" in user_roles:
-		return True
-	
-	# Director can approve only if they are assigned as director in at least one reception office
-	if "EDO Director" in user_roles:
-		# Check if user is director of any reception office
-		reception_offices = frappe.get_all(
-			"EDO Reception Office",
-			filters={"director": user},
-			limit=1
-		)
-		return len(reception_offices) > 0
-	
-	return False
+	# Admin always; Director only if assigned as director of at least one reception office
+	return can(get_user_context(), "approve_any")
 
 
 @frappe.whitelist()
@@ -1102,34 +1268,11 @@ def can_executor_sign(name):
 
 	try:
 		doc = frappe.get_doc("EDO Document", name)
-
-		# Check if document is in "На исполнении" status
-		if doc.status != "На исполнении":
-			return False
-
-		# Check if user is executor or co-executor
-		is_executor = doc.executor == user
-		is_co_executor = False
-
-		if doc.co_executors:
-			for co_exec in doc.co_executors:
-				if co_exec.user == user:
-					is_co_executor = True
-					break
-
-		if not is_executor and not is_co_executor:
-			return False
-
-		# Check if user already signed
-		if doc.signatures:
-			for sig in doc.signatures:
-				if sig.user == user:
-					return False
-
-		return True
-	except:
+	except Exception:
 		return False
 
+	return can(get_user_context(), "sign", doc)
+
 
 # ==================== RECEPTION API ====================
 
@@ -1141,15 +1284,10 @@ def can_reception_submit():
 	if not user or user == "Guest":
 		return False
 
-	user_roles = frappe.get_roles(user)
-	result = "EDO Reception" in user_roles
-
-	# Debug log
-	frappe.log_error(f"can_reception_submit: user={user}, roles={user_roles}, result={result}", "permission_debug")
-
 	# Только роль Reception может обрабатывать документы в приемной
 	# Admin не должен иметь доступ к этой функции
-	return result
+	ctx = get_user_context()
+	return can(ctx, "reception_submit")
 
 
 @frappe.whitelist()
@@ -1170,9 +1308,7 @@ def reception_submit_to_director(name, resolution=None, resolution_text=None, ex
 		frappe.throw("Not authorized", frappe.PermissionError)
 
 	# Check if user has Reception role
-	user_roles = frappe.get_roles(user)
-	if "EDO Reception" not in user_roles:
-		frappe.throw("Only Reception can submit documents to director", frappe.PermissionError)
+	check(get_user_context(), "reception_submit")
 
 	# Get document
 	doc = frappe.get_doc("EDO Document", name)
@@ -1185,7 +1321,7 @@ def reception_submit_to_director(name, resolution=None, resolution_text=None, ex
 	# Either resolution (Link) or resolution_text (manual text) should be provided
 	if resolution:
 		# Validate that resolution exists
-		if not frappe.db.exists("EDO Resolution", resolution):
+		if not get_reference("EDO Resolution", resolution):
 			frappe.throw(f"Resolution '{resolution}' not found", frappe.ValidationError)
 		doc.resolution = resolution
 		# Clear manual text if using predefined resolution
@@ -1219,7 +1355,9 @@ def reception_submit_to_director(name, resolution=None, resolution_text=None, ex
 	
 	# Get director from reception office
 	if doc.reception_office:
-		reception_office_doc = frappe.get_doc("EDO Reception Office", doc.reception_office)
+		reception_office_doc = get_reference("EDO Reception Office", doc.reception_office)
+		if not reception_office_doc:
+			frappe.throw(f"Reception office '{doc.reception_office}' not found", frappe.ValidationError)
 		if reception_office_doc.director:
 			# Set director_user to the director of this reception office
 			doc.director_user = reception_office_doc.director
@@ -1232,6 +1370,7 @@ def reception_submit_to_director(name, resolution=None, resolution_text=None, ex
 	doc.status = "На рассмотрении"
 
 	doc.save(ignore_permissions=True)
+	publish_workflow_update(doc)
 
 	return doc.as_dict()
 
@@ -1343,10 +1482,7 @@ def get_stamp_image(file_url: str):
 	# Decode the URL
 	from urllib.parse import unquote
 	file_url = unquote(file_url)
-	
-	# Log for debugging
-	frappe.log_error(f"get_stamp_image called with file_url: {file_url}, user: {user}", "get_stamp_image")
-	
+
 	# Find the file
 	file = find_file_by_url(file_url)
 	if not file:
@@ -1438,8 +1574,196 @@ def get_pdf_info(document_name):
 	}
 
 
-@frappe.whitelist()
-def apply_stamps_to_pdf(document_name, stamps):
+# Background stamping: realtime event with the progress of a job, and how long its status is kept
+STAMP_JOB_EVENT = "edo_stamp_job"
+STAMP_JOB_TTL = 24 * 60 * 60
+# Larger batches of apply_stamps_to_documents are never stamped inside the web request
+STAMP_BATCH_SYNC_LIMIT = 5
+
+
+@frappe.whitelist()
+def apply_stamps_to_pdf(document_name, stamps, run_async=False):
+	"""
+	Apply multiple stamps to PDF document (see _apply_stamps_to_pdf).
+
+	With run_async the stamping runs as a background job on the long queue and
+	{success: True, job_id: "...", status: "queued"} is returned at once. The job reports its
+	progress as STAMP_JOB_EVENT realtime messages to the user; get_stamp_job_status returns
+	the same state, with new_file_url when done.
+	"""
+	if not frappe.utils.cint(run_async):
+		with trace("apply_stamps_to_pdf", document=document_name):
+			return _apply_stamps_to_pdf(document_name, stamps)
+
+	check(get_user_context(), "stamp")
+	if not frappe.db.exists("EDO Document", document_name):
+		frappe.throw(f"Document not found: {document_name}", frappe.NotFound)
+
+	job_id = frappe.generate_hash(length=16)
+	_update_stamp_job(job_id, {
+		"job_id": job_id,
+		"document": document_name,
+		"user": frappe.session.user,
+		"status": "queued",
+		"done": 0,
+		"total": 0,
+	})
+	frappe.enqueue(
+		"edo.edo.doctype.edo_document.edo_document.run_stamp_job",
+		queue="long",
+		job_name=f"Stamp {document_name}",
+		stamp_job=job_id,
+		document_name=document_name,
+		stamps=stamps,
+	)
+	return {"success": True, "job_id": job_id, "status": "queued"}
+
+
+@frappe.whitelist()
+def get_stamp_job_status(job_id):
+	"""State of a background stamping job: status (queued, running, done, failed), done/total steps, new_file_url, error"""
+	job = frappe.cache().get_value(_stamp_job_key(job_id))
+	if not job:
+		frappe.throw(f"Stamping job {job_id} not found", frappe.DoesNotExistError)
+	if job["user"] != frappe.session.user and not get_user_context().is_admin:
+		frappe.throw("No permission to view this job", frappe.PermissionError)
+	return job
+
+
+def run_stamp_job(stamp_job, document_name, stamps):
+	"""Background job of apply_stamps_to_pdf(run_async=True); runs as the user who queued it"""
+	last_percent = -1
+	last_total = 0
+
+	def progress(done, total):
+		nonlocal last_percent, last_total
+		last_total = total
+		# One message per percent, not per step of a 300-page scan
+		percent = int(done * 100 / total) if total else 100
+		if percent != last_percent:
+			last_percent = percent
+			_update_stamp_job(stamp_job, {"status": "running", "done": done, "total": total}, publish=True)
+
+	_update_stamp_job(stamp_job, {"status": "running"}, publish=True)
+	try:
+		with trace("apply_stamps_to_pdf", document=document_name, job=stamp_job):
+			result = _apply_stamps_to_pdf(document_name, stamps, progress=progress)
+	except Exception as e:
+		frappe.db.rollback()
+		_update_stamp_job(stamp_job, {"status": "failed", "error": str(e)}, publish=True)
+		return
+
+	_update_stamp_job(
+		stamp_job, {"status": "done", "done": last_total, "new_file_url": result["new_file_url"]}, publish=True
+	)
+
+
+@frappe.whitelist()
+def apply_stamps_to_documents(document_names, stamps, run_async=False):
+	"""
+	Apply the same stamps to several documents (see _apply_stamps_to_pdf for the stamps format).
+
+	Documents are stamped one after another in one process, so decoded stamps, rendered stamp
+	images and Link titles are reused across them. A failing document is rolled back to its
+	savepoint and reported; the others are kept and committed together by the request (or job).
+	Batches of more than STAMP_BATCH_SYNC_LIMIT documents always run as a background job.
+
+	Returns:
+		{results: [{document, success, new_file_url | error}, ...], succeeded: n, failed: n}
+		or, with run_async, {success: True, job_id: "...", status: "queued"} - the job state
+		(get_stamp_job_status) gets done/total documents and the same results when done.
+	"""
+	document_names = frappe.parse_json(document_names)
+	if not document_names or not isinstance(document_names, list):
+		frappe.throw("No documents provided", frappe.ValidationError)
+
+	check(get_user_context(), "stamp")
+
+	if not frappe.utils.cint(run_async) and len(document_names) <= STAMP_BATCH_SYNC_LIMIT:
+		return _apply_stamps_to_documents(document_names, stamps)
+
+	job_id = frappe.generate_hash(length=16)
+	_update_stamp_job(job_id, {
+		"job_id": job_id,
+		"documents": document_names,
+		"user": frappe.session.user,
+		"status": "queued",
+		"done": 0,
+		"total": len(document_names),
+	})
+	frappe.enqueue(
+		"edo.edo.doctype.edo_document.edo_document.run_stamp_batch_job",
+		queue="long",
+		job_name=f"Stamp {len(document_names)} documents",
+		stamp_job=job_id,
+		document_names=document_names,
+		stamps=stamps,
+	)
+	return {"success": True, "job_id": job_id, "status": "queued"}
+
+
+def run_stamp_batch_job(stamp_job, document_names, stamps):
+	"""Background job of apply_stamps_to_documents(run_async=True); runs as the user who queued it"""
+	def progress(done, total):
+		_update_stamp_job(stamp_job, {"status": "running", "done": done, "total": total}, publish=True)
+
+	_update_stamp_job(stamp_job, {"status": "running"}, publish=True)
+	try:
+		result = _apply_stamps_to_documents(document_names, stamps, progress=progress)
+		# The job owns the transaction: stamped documents are visible before "done" is reported
+		frappe.db.commit()
+	except Exception as e:
+		frappe.db.rollback()
+		_update_stamp_job(stamp_job, {"status": "failed", "error": str(e)}, publish=True)
+		return
+
+	_update_stamp_job(stamp_job, {"status": "done", **result}, publish=True)
+
+
+def _apply_stamps_to_documents(document_names, stamps, progress=None):
+	# Invalid stamps fail the whole call once, not every document
+	try:
+		stamps = frappe.parse_json(stamps)
+	except ValueError as e:
+		frappe.throw(f"Invalid stamps format: {str(e)}", frappe.ValidationError)
+	if not stamps or not isinstance(stamps, list):
+		frappe.throw("Stamps must be a non-empty list", frappe.ValidationError)
+
+	# Link titles of stamp fields are shared by the documents of the batch
+	resolver = LinkResolver()
+	results = []
+	for done, document_name in enumerate(document_names, 1):
+		frappe.db.savepoint("edo_stamp_document")
+		try:
+			with trace("apply_stamps_to_pdf", document=document_name, batch=len(document_names)):
+				# No commit per document: a commit would release the savepoint of the next one
+				result = _apply_stamps_to_pdf(document_name, stamps, resolver=resolver, commit=False)
+			results.append({"document": document_name, "success": True, "new_file_url": result["new_file_url"]})
+		except Exception as e:
+			frappe.db.rollback(save_point="edo_stamp_document")
+			# The error goes into the result, not into the messages of the whole call
+			frappe.clear_messages()
+			results.append({"document": document_name, "success": False, "error": str(e)})
+		if progress:
+			progress(done, len(document_names))
+
+	succeeded = sum(1 for result in results if result["success"])
+	return {"results": results, "succeeded": succeeded, "failed": len(results) - succeeded}
+
+
+def _update_stamp_job(job_id, values, publish=False):
+	key = _stamp_job_key(job_id)
+	job = {**(frappe.cache().get_value(key) or {}), **values}
+	frappe.cache().set_value(key, job, expires_in_sec=STAMP_JOB_TTL)
+	if publish:
+		frappe.publish_realtime(STAMP_JOB_EVENT, job, user=job.get("user"))
+
+
+def _stamp_job_key(job_id):
+	return f"edo_stamp_job:{job_id}"
+
+
+def _apply_stamps_to_pdf(document_name, stamps, progress=None, resolver=None, commit=True):
 	"""
 	Apply multiple stamps to PDF document.
 
@@ -1448,13 +1772,18 @@ def apply_stamps_to_pdf(document_name, stamps):
 		stamps: JSON list of stamps to apply
 			[{
 				"stamp_name": "STAMP-0001",
-				"page_number": 0,  # 0-indexed
+				"page_number": 0,  # 0-indexed, or "all" for every page
 				"position": "bottom-right" | "top-left" | ... | "custom",
 				"x": 100,  # Only for custom position
 				"y": 100,  # Only for custom position
 				"scale": 1.0
 			}, ...]
 
+		progress: called with (steps done, steps total) while stamping: three steps per stamped
+			page (see apply_stamps_to_pages) and the save, the last one, left to the caller to report
+		resolver: LinkResolver shared with other documents stamped in the same call (optional)
+		commit: commit once the document is saved; off when the caller owns the transaction
+
 	Returns:
 		{success: True, new_file_url: "...", message: "..."}
 	"""
@@ -1462,7 +1791,7 @@ def apply_stamps_to_pdf(document_name, stamps):
 	import json
 	import os
 	import traceback
-	from pypdf import PdfReader, PdfWriter
+	from pypdf import PdfReader
 	from reportlab.pdfgen import canvas
 	from reportlab.lib.utils import ImageReader
 	from PIL import Image
@@ -1473,10 +1802,7 @@ def apply_stamps_to_pdf(document_name, stamps):
 			frappe.throw("Not authorized", frappe.PermissionError)
 
 		# Check permission
-		user_roles = frappe.get_roles(user)
-		can_stamp = any(role in user_roles for role in ["EDO Admin", "EDO Manager", "EDO Director"])
-		if not can_stamp:
-			frappe.throw("You don't have permission to apply stamps", frappe.PermissionError)
+		check(get_user_context(), "stamp")
 
 		# Parse stamps if string
 		if isinstance(stamps, str):
@@ -1531,21 +1857,23 @@ def apply_stamps_to_pdf(document_name, stamps):
 			)
 			frappe.throw("Main document is not a PDF file", frappe.ValidationError)
 
-		# Read original PDF
+		# Read original PDF once: its bytes are parsed, hashed for the backup name and saved as the backup
+		parse_span = start_span("parse")
 		try:
-			with open(pdf_path, 'rb') as f:
-				original_pdf_bytes = f.read()
+			original_content, original_content_hash = _read_file_with_hash(pdf_path)
 		except Exception as e:
 			frappe.log_error(f"Failed to read PDF file {pdf_path}: {str(e)}\n{traceback.format_exc()}", "apply_stamps_read_error")
 			frappe.throw(f"Failed to read PDF file: {str(e)}", frappe.ValidationError)
 
 		try:
-			pdf_reader = PdfReader(io.BytesIO(original_pdf_bytes))
+			pdf_reader = PdfReader(io.BytesIO(original_content))
 		except Exception as e:
 			frappe.log_error(f"Failed to parse PDF: {str(e)}\n{traceback.format_exc()}", "apply_stamps_parse_error")
 			frappe.throw(f"Invalid PDF file: {str(e)}", frappe.ValidationError)
 
-		pdf_writer = PdfWriter()
+		# The writer starts as a clone of the source; only pages with stamps are touched below
+		pdf_writer = new_stamp_writer(pdf_reader)
+		parse_span.finish(pages=len(pdf_reader.pages), bytes=len(original_content))
 
 		# Group stamps by page
 		stamps_by_page = {}
@@ -1555,6 +1883,11 @@ def apply_stamps_to_pdf(document_name, stamps):
 				continue
 			
 			page_num = stamp_info.get("page_number", 0)
+			if page_num == STAMP_ALL_PAGES:
+				# Одна и та же печать на каждой странице - одно изображение в оверлее
+				for page_idx in range(len(pdf_reader.pages)):
+					stamps_by_page.setdefault(page_idx, []).append(stamp_info)
+				continue
 			if not isinstance(page_num, int) or page_num < 0:
 				frappe.log_error(f"Invalid page_number: {page_num} in stamp {stamp_info}", "apply_stamps_validation")
 				continue
@@ -1565,37 +1898,31 @@ def apply_stamps_to_pdf(document_name, stamps):
 
 		# Process each page
 		total_stamps_to_apply = sum(len(stamps) for stamps in stamps_by_page.values())
-		stamps_applied_count = 0
-		
-		for page_idx, page in enumerate(pdf_reader.pages):
-			if page_idx in stamps_by_page:
-				# Apply stamps to this page
-				try:
-					stamped_page, page_stamps_applied = apply_stamps_to_page(page, stamps_by_page[page_idx], doc)
-					pdf_writer.add_page(stamped_page)
-					stamps_applied_count += page_stamps_applied
-					
-					# Логируем результат применения штампов к странице
-					if page_stamps_applied > 0:
-						frappe.log_error(
-							f"Applied {page_stamps_applied} stamps to page {page_idx}",
-							"apply_stamps_page_success"
-						)
-					else:
-						frappe.log_error(
-							f"No stamps applied to page {page_idx}. Total stamps for page: {len(stamps_by_page[page_idx])}",
-							"apply_stamps_page_no_stamps"
-						)
-				except Exception as e:
-					frappe.log_error(
-						f"Failed to apply stamps to page {page_idx}: {str(e)}\n{traceback.format_exc()}\nStamps: {stamps_by_page[page_idx]}",
-						"apply_stamps_page_error"
-					)
-					# Fallback: add page without stamps
-					pdf_writer.add_page(page)
-			else:
-				pdf_writer.add_page(page)
-		
+
+		# Link titles for stamp fields are resolved once per document (or batch), not per page
+		resolver = resolver or LinkResolver()
+
+		# All stamped pages share one overlay document (see apply_stamps_to_pages)
+		stamped_pages = [
+			(page_idx, pdf_writer.pages[page_idx]) for page_idx in sorted(stamps_by_page) if page_idx < len(pdf_writer.pages)
+		]
+		# The save is the last step: stamping the pages never reports the job as done
+		pages_progress = (lambda done, total: progress(done, total + 1)) if progress else None
+		try:
+			pages_applied = apply_stamps_to_pages(
+				[(page, stamps_by_page[page_idx]) for page_idx, page in stamped_pages], doc, resolver=resolver,
+				progress=pages_progress
+			)
+		except Exception as e:
+			frappe.log_error(
+				f"Failed to apply stamps to pages {[page_idx for page_idx, page in stamped_pages]}: {str(e)}\n{traceback.format_exc()}",
+				"apply_stamps_page_error"
+			)
+			# Fallback: pages without stamps
+			pages_applied = [0] * len(stamped_pages)
+
+		stamps_applied_count = sum(pages_applied)
+
 		# Проверяем, что хотя бы один штамп был применен
 		if total_stamps_to_apply > 0 and stamps_applied_count == 0:
 			# Логируем детальную информацию о том, почему штампы не были применены
@@ -1641,6 +1968,7 @@ def apply_stamps_to_pdf(document_name, stamps):
 			frappe.throw(error_msg, frappe.ValidationError)
 
 		# Write to bytes
+		write_span = start_span("write")
 		try:
 			output = io.BytesIO()
 			pdf_writer.write(output)
@@ -1658,6 +1986,8 @@ def apply_stamps_to_pdf(document_name, stamps):
 		except Exception as e:
 			frappe.log_error(f"Failed to write PDF: {str(e)}\n{traceback.format_exc()}", "apply_stamps_write_error")
 			frappe.throw(f"Failed to create stamped PDF: {str(e)}", frappe.ValidationError)
+		write_span.finish(bytes=len(output_bytes))
+		save_span = start_span("save")
 
 		# Generate unique filenames using content hash to avoid conflicts
 		import re
@@ -1677,13 +2007,8 @@ def apply_stamps_to_pdf(document_name, stamps):
 		if len(clean_name) > max_base_length:
 			clean_name = clean_name[:max_base_length]
 
-		# Читаем оригинальный контент для расчета хэша
-		with open(pdf_path, 'rb') as f:
-			original_content = f.read()
-
 		# Используем хэш содержимого для уникальности имен файлов
-		# Для оригинального файла
-		original_content_hash = get_content_hash(original_content)
+		# Для оригинального файла (хэш посчитан при чтении)
 		original_hash_suffix = original_content_hash[-8:]  # Последние 8 символов хэша
 		original_backup_filename = f"{clean_name}_original_{original_hash_suffix}.pdf"
 
@@ -1736,7 +2061,7 @@ def apply_stamps_to_pdf(document_name, stamps):
 						frappe.log_error(f"Failed to remove old stamped file {file_name}: {str(e)}", "apply_stamps_cleanup")
 
 		# Save original to attachments (backup)
-		# original_content уже прочитан выше для расчета хэша
+		# original_content уже прочитан выше
 		try:
 			original_backup_file = frappe.get_doc({
 				"doctype": "File",
@@ -1809,13 +2134,9 @@ def apply_stamps_to_pdf(document_name, stamps):
 			doc.main_document = stamped_file.file_url
 			doc.save(ignore_permissions=True)
 			
-			# Логируем только краткую информацию (Title ограничен 140 символами)
-			# Сокращаем сообщение, чтобы не превысить лимит
-			short_msg = f"Stamps applied. Doc: {document_name[:30]}, File: {stamped_file.name[:30]}"
-			frappe.log_error(short_msg, "apply_stamps_success")
-			
 			# Обновляем документ в базе данных, чтобы изменения были видны сразу
-			frappe.db.commit()
+			if commit:
+				frappe.db.commit()
 		except Exception as e:
 			# Сокращаем сообщение для title (ограничение 140 символов)
 			error_msg = str(e)
@@ -1825,6 +2146,7 @@ def apply_stamps_to_pdf(document_name, stamps):
 				"apply_stamps_save_error"
 			)
 			frappe.throw(f"Failed to save stamped PDF: {error_msg}", frappe.ValidationError)
+		save_span.finish(file=stamped_file.file_url, stamps=stamps_applied_count)
 
 		return {
 			"success": True,
@@ -1847,41 +2169,196 @@ def apply_stamps_to_pdf(document_name, stamps):
 		frappe.throw(f"Failed to apply stamps: {str(e)}", frappe.ValidationError)
 
 
-def apply_stamps_to_page(page, stamps_info, document=None):
+def new_stamp_writer(pdf_reader, incremental=None):
+	"""
+	PdfWriter for stamping a document read by pdf_reader.
+
+	Incremental mode (site config edo_stamp_incremental_save, pypdf >= 5) appends the changed
+	objects and a new xref section to the original bytes instead of rewriting the file: the cost
+	follows the stamps, not the file size, and earlier signatures stay valid. Otherwise (and on
+	older pypdf) the writer is a full clone of the source.
+	"""
+	from pypdf import PdfWriter
+
+	if incremental is None:
+		incremental = frappe.utils.cint(frappe.conf.get("edo_stamp_incremental_save"))
+	if incremental and _pypdf_saves_incrementally():
+		return PdfWriter(pdf_reader, incremental=True)
+	return PdfWriter(clone_from=pdf_reader)
+
+
+@lru_cache(maxsize=None)
+def _pypdf_saves_incrementally():
+	"""Whether the installed pypdf has incremental saves; checked (and warned about) once per process"""
+	import pypdf
+
+	major = frappe.utils.cint(pypdf.__version__.split(".")[0])
+	if major < 5:
+		frappe.log_error(
+			f"Incremental PDF save needs pypdf >= 5 (installed: {pypdf.__version__}), rewriting files",
+			"stamp_incremental_unsupported"
+		)
+	return major >= 5
+
+
+def _read_file_with_hash(path):
+	"""Content of a file and its md5 (as File content_hash), from a single read"""
+	import hashlib
+
+	# One buffer: hashing chunks and joining them would hold the file twice
+	with open(path, 'rb') as f:
+		content = f.read()
+	return content, hashlib.md5(content).hexdigest()
+
+
+# page_number of a stamp put on every page
+STAMP_ALL_PAGES = "all"
+
+# How field texts get on a stamp (site config edo_stamp_text_mode, or "text_mode" of a stamp):
+# drawn into the stamp bitmap, or laid out as PDF text over the plain stamp image
+STAMP_TEXT_RASTER = "raster"
+STAMP_TEXT_VECTOR = "vector"
+
+
+def apply_stamps_to_page(page, stamps_info, document=None, resolver=None):
 	"""Apply multiple stamps to a single PDF page
 
 	Args:
 		page: PDF page object
 		stamps_info: list of stamp info dicts
 		document: EDO Document object for filling stamp fields
+		resolver: LinkResolver shared by all pages of the document (optional)
+	"""
+	return page, apply_stamps_to_pages([(page, stamps_info)], document, resolver=resolver)[0]
+
+
+def apply_stamps_to_pages(pages_stamps, document=None, resolver=None, progress=None):
+	"""Apply stamps to several PDF pages through one overlay document
+
+	The stamps of all pages are planned here (images, positions, text lines) and drawn into an
+	overlay with one page per stamped page (see edo.utils.stamp_overlay). Each distinct stamp
+	image becomes one form XObject shared by the overlay's pages, so a seal put on every page is
+	embedded (and the overlay parsed) once. Large documents can be drawn by a process pool,
+	in chunks that are merged back in page order.
+
+	Args:
+		pages_stamps: list of (page, stamps_info) - pages are merged with their stamps in place
+		document: EDO Document object for filling stamp fields
+		resolver: LinkResolver shared by all pages of the document (optional)
+		progress: called with (steps done, steps total) as pages are planned, drawn and merged -
+			three steps per page (optional)
+
+	Returns:
+		list of the number of stamps applied to each page (0 for pages left unmerged by an error)
 	"""
 	import io
-	import os
 	import traceback
 	from pypdf import PdfReader
-	from reportlab.pdfgen import canvas
-	from reportlab.lib.utils import ImageReader
-	from PIL import Image
 
-	# Get page dimensions
-	media_box = page.mediabox
-	page_width = float(media_box.width)
-	page_height = float(media_box.height)
+	# image key -> placed stamp image, shared by the pages that draw it
+	images = {}
+	# stamp name -> load error, logged once for all pages
+	failed_stamps = {}
+	# (page index, summary) of pages that got no stamp, logged once after planning
+	unstamped = []
+	plan = []
+	applied = []
+	total_steps = 3 * len(pages_stamps)
+	plan_span = start_span("plan", pages=len(pages_stamps))
+	for planned, (page, stamps_info) in enumerate(pages_stamps, 1):
+		# Get page dimensions
+		media_box = page.mediabox
+		page_width = float(media_box.width)
+		page_height = float(media_box.height)
+
+		ops, stamps_applied, errors = _plan_page_stamps(
+			page_width, page_height, stamps_info, document, resolver, images, failed_stamps
+		)
+		plan.append((page_width, page_height, ops))
+		applied.append(stamps_applied)
+
+		if not stamps_applied:
+			error_summary = f"Total: {len(stamps_info)}"
+			if errors:
+				error_summary += f". Errors: {'; '.join(errors[:5])}"  # Показываем первые 5 ошибок
+				if len(errors) > 5:
+					error_summary += f" (и еще {len(errors) - 5} ошибок)"
+			unstamped.append((planned - 1, error_summary))
+		if progress:
+			progress(planned, total_steps)
+
+	plan_span.finish(stamps=sum(applied), images=len(images))
+
+	if unstamped:
+		# Одна запись на документ, а не на каждую страницу без штампов
+		frappe.log_error(
+			f"No stamps applied on {len(unstamped)} of {len(pages_stamps)} pages. "
+			+ " | ".join(f"Page {page_idx}: {summary}" for page_idx, summary in unstamped[:5]),
+			"stamp_no_stamps_applied"
+		)
 
-	# Create overlay with stamps
-	packet = io.BytesIO()
-	c = canvas.Canvas(packet, pagesize=(page_width, page_height))
-	
+	# Рисуем и применяем оверлей только если были применены штампы
+	if not any(applied):
+		return applied
+
+	# Merge overlay pages with the original pages; merged - stamps of the pages merged so far
+	overlay_size = 0
+	merged = [0] * len(pages_stamps)
+	try:
+		with span("render") as render_span:
+			overlays = render_overlays(plan, images, get_font_path())
+			overlay_size = sum(len(overlay) for overlay in overlays)
+			render_span.set(overlays=len(overlays), bytes=overlay_size)
+		if progress:
+			progress(2 * len(pages_stamps), total_steps)
+
+		merge_span = start_span("merge")
+		overlay_pages = []
+		for overlay in overlays:
+			overlay_pages.extend(PdfReader(io.BytesIO(overlay)).pages)
+		if len(overlay_pages) != len(pages_stamps):
+			frappe.log_error(
+				f"Overlay PDF has {len(overlay_pages)} pages for {len(pages_stamps)} stamped pages. Overlay size: {overlay_size}",
+				"stamp_merge_no_pages"
+			)
+			# Если overlay неполный, возвращаем оригинальные страницы без штампов
+			# но не выбрасываем исключение - пусть вызывающий код решает
+			return [0] * len(pages_stamps)
+
+		for done, ((page, stamps_info), overlay_page, stamps_applied) in enumerate(zip(pages_stamps, overlay_pages, applied), 1):
+			if stamps_applied:
+				page.merge_page(overlay_page)
+				merged[done - 1] = stamps_applied
+			if progress:
+				progress(2 * len(pages_stamps) + done, total_steps)
+		merge_span.finish(pages=sum(1 for stamps_applied in applied if stamps_applied))
+		return applied
+	except Exception as e:
+		frappe.log_error(
+			f"Failed to merge stamp overlay: {str(e)}\n{traceback.format_exc()}\n"
+			f"Stamps planned: {sum(applied)}, merged: {sum(merged)}, Pages: {len(pages_stamps)}, Overlay size: {overlay_size}",
+			"stamp_merge_error"
+		)
+		# Страницы, слитые до ошибки, уже содержат штампы - возвращаем то, что реально применено,
+		# не выбрасываем исключение - пусть вызывающий код решает
+		return merged
+
+
+def _plan_page_stamps(page_width, page_height, stamps_info, document, resolver, images, failed_stamps=None):
+	"""
+	Overlay ops of one page's stamps, adding their images to images; returns (ops, stamps applied, errors).
+	failed_stamps ({stamp name: error}) is shared by the pages of a document, so a stamp that
+	can't be loaded is logged once, not on every page it is put on.
+	"""
+	import traceback
+
+	if failed_stamps is None:
+		failed_stamps = {}
+	ops = []
 	# Счетчик успешно примененных штампов
 	stamps_applied = 0
 	# Список ошибок для детального логирования
 	errors = []
-	
-	# Логируем начало обработки штампов для отладки
-	frappe.log_error(
-		f"Starting to apply {len(stamps_info)} stamps to page {page_width:.2f}x{page_height:.2f}",
-		"stamp_apply_start"
-	)
 
 	for stamp_info in stamps_info:
 		try:
@@ -1905,74 +2382,44 @@ def apply_stamps_to_page(page, stamps_info, document=None):
 			custom_x = stamp_info.get("x")
 			custom_y = stamp_info.get("y")
 
-			# Get stamp image path
-			try:
-				stamp_doc = frappe.get_doc("EDO Stamp", stamp_name)
-			except Exception as e:
-				error_msg = f"Failed to get stamp {stamp_name}: {str(e)}"
-				frappe.log_error(error_msg, "stamp_load_error")
-				errors.append(error_msg)
-				continue
-			
-			if not stamp_doc.stamp_image:
-				error_msg = f"Stamp {stamp_name} has no image"
-				frappe.log_error(error_msg, "stamp_validation")
-				errors.append(error_msg)
-				continue
-
-			stamp_image_path = get_file_path(stamp_doc.stamp_image)
-			if not stamp_image_path:
-				error_msg = f"Stamp image path is None for stamp {stamp_name} (stamp_image URL: {stamp_doc.stamp_image})"
-				frappe.log_error(error_msg, "stamp_file_error")
-				errors.append(error_msg)
-				continue
-			
-			if not os.path.exists(stamp_image_path):
-				error_msg = f"Stamp image not found at path: {stamp_image_path} for stamp {stamp_name} (stamp_image URL: {stamp_doc.stamp_image})"
-				frappe.log_error(error_msg, "stamp_file_error")
-				errors.append(error_msg)
+			if stamp_name in failed_stamps:
+				errors.append(failed_stamps[stamp_name])
 				continue
 
-			# Load stamp image
+			# Decoded image and field mappings, cached across pages and requests
 			try:
-				stamp_img = Image.open(stamp_image_path)
+				asset = get_stamp_asset(stamp_name)
 			except Exception as e:
-				error_msg = f"Failed to open stamp image {stamp_image_path}: {str(e)}"
-				frappe.log_error(error_msg, "stamp_image_error")
+				error_msg = f"Failed to load stamp {stamp_name}: {str(e)}"
+				frappe.log_error(error_msg, "stamp_load_error")
+				failed_stamps[stamp_name] = error_msg
 				errors.append(error_msg)
 				continue
 
-			# Handle transparency - convert to RGBA if needed
-			if stamp_img.mode != 'RGBA':
-				stamp_img = stamp_img.convert('RGBA')
-			
-			# Fill stamp with document data if field_mappings exist
-			# Перезагружаем документ с child table для получения актуальных данных
-			stamp_doc.reload()
-			
-			# Получаем field_mappings из child table
-			field_mappings_list = []
-			if hasattr(stamp_doc, 'field_mappings') and stamp_doc.field_mappings:
-				# Конвертируем child table в список словарей
-				for mapping in stamp_doc.field_mappings:
-					if hasattr(mapping, 'as_dict'):
-						field_mappings_list.append(mapping.as_dict())
-					elif isinstance(mapping, dict):
-						field_mappings_list.append(mapping)
-					else:
-						# Пытаемся получить атрибуты напрямую
-						field_mappings_list.append({
-							"document_field": getattr(mapping, 'document_field', None),
-							"position_x": getattr(mapping, 'position_x', 0),
-							"position_y": getattr(mapping, 'position_y', 0),
-							"font_size": getattr(mapping, 'font_size', 12),
-							"color": getattr(mapping, 'color', '#000000'),
-							"max_width": getattr(mapping, 'max_width', 0),
-						})
-			
-			if field_mappings_list and len(field_mappings_list) > 0 and document:
+			stamp_img = asset.image
+			image_key = asset.key
+			# Vector mode: the base image as is, field texts are drawn as PDF text after it.
+			# Without a TrueType font reportlab can embed (none installed, or a .ttc) the texts
+			# are drawn into the image: reportlab's built-in fonts have no Cyrillic.
+			text_mode = stamp_info.get("text_mode") or frappe.conf.get("edo_stamp_text_mode") or STAMP_TEXT_RASTER
+			if text_mode == STAMP_TEXT_VECTOR and not get_pdf_font_name(get_font_path()):
+				text_mode = STAMP_TEXT_RASTER
+			vector_texts = None
+			if asset.field_mappings and document and text_mode == STAMP_TEXT_VECTOR:
+				try:
+					vector_texts = stamp_field_texts(list(asset.field_mappings), document, resolver=resolver)
+				except Exception as e:
+					frappe.log_error(f"Failed to resolve stamp texts for {stamp_name}: {str(e)}", "stamp_text_error")
+			# Fill stamp with document data if field_mappings exist. The filled image is cached
+			# by the resolved texts, so documents sharing them reuse one rendering.
+			elif asset.field_mappings and document:
 				try:
-					stamp_img = render_text_on_stamp_image(stamp_img, field_mappings_list, document)
+					field_mappings = list(asset.field_mappings)
+					texts = stamp_field_texts(field_mappings, document, resolver=resolver)
+					stamp_img = get_rendered_stamp(asset, texts, lambda: render_text_on_stamp_image(
+						asset.image, field_mappings, document, texts=texts
+					))
+					image_key = rendered_stamp_key(asset, texts)
 				except Exception as e:
 					# Continue with original image if text rendering fails
 					pass
@@ -2001,21 +2448,15 @@ def apply_stamps_to_page(page, stamps_info, document=None):
 				errors.append(error_msg)
 				continue
 
-			# Draw stamp on canvas with transparency support
+			# Draw stamp on the overlay with transparency support
 			try:
-				c.drawImage(
-					ImageReader(stamp_img),
-					x, y,
-					width=scaled_w,
-					height=scaled_h,
-					mask='auto'
-				)
+				# Embedded at the resolution it is printed at (cached per image and scale)
+				placed_key = (*image_key, scale)
+				images[placed_key] = get_placed_stamp(image_key, stamp_img, scale)
+				ops.append(("image", placed_key, x, y, scaled_w, scaled_h))
+				if vector_texts:
+					ops.extend(stamp_text_ops(asset.field_mappings, vector_texts, x, y, scale, stamp_h))
 				stamps_applied += 1
-				# Логируем успешное применение штампа для отладки
-				frappe.log_error(
-					f"Stamp {stamp_name} drawn at ({x:.2f}, {y:.2f}) size ({scaled_w:.2f}, {scaled_h:.2f})",
-					"stamp_draw_success"
-				)
 			except Exception as e:
 				error_msg = f"Failed to draw stamp {stamp_name} at ({x}, {y}) size ({scaled_w}, {scaled_h}): {str(e)}"
 				frappe.log_error(f"{error_msg}\n{traceback.format_exc()}", "stamp_draw_error")
@@ -2027,49 +2468,7 @@ def apply_stamps_to_page(page, stamps_info, document=None):
 			errors.append(error_msg)
 			continue
 
-	# Сохраняем canvas и применяем штампы только если были применены штампы
-	if stamps_applied > 0:
-		c.save()
-		packet.seek(0)
-
-		# Merge overlay with original page
-		try:
-			overlay_reader = PdfReader(packet)
-			if overlay_reader.pages:
-				page.merge_page(overlay_reader.pages[0])
-				# Логируем успешный merge для отладки
-				frappe.log_error(
-					f"Successfully merged {stamps_applied} stamps to page. Returning page with {stamps_applied} stamps applied.",
-					"stamp_merge_success"
-				)
-				return page, stamps_applied
-			else:
-				frappe.log_error(
-					f"Overlay PDF has no pages after applying {stamps_applied} stamps. Packet size: {len(packet.getvalue())}",
-					"stamp_merge_no_pages"
-				)
-				# Если overlay пустой, возвращаем оригинальную страницу без штампов
-				# но не выбрасываем исключение - пусть вызывающий код решает
-				return page, 0
-		except Exception as e:
-			frappe.log_error(
-				f"Failed to merge stamp overlay: {str(e)}\n{traceback.format_exc()}\n"
-				f"Stamps applied: {stamps_applied}, Total: {len(stamps_info)}, Packet size: {len(packet.getvalue()) if packet else 0}",
-				"stamp_merge_error"
-			)
-			# Если merge не удался, возвращаем оригинальную страницу без штампов
-			# но не выбрасываем исключение - пусть вызывающий код решает
-			return page, 0
-	else:
-		# Если штампы не были применены, логируем предупреждение с деталями ошибок
-		error_summary = f"No stamps applied. Total: {len(stamps_info)}, Applied: {stamps_applied}"
-		if errors:
-			error_summary += f". Errors: {'; '.join(errors[:5])}"  # Показываем первые 5 ошибок
-			if len(errors) > 5:
-				error_summary += f" (и еще {len(errors) - 5} ошибок)"
-		frappe.log_error(error_summary, "stamp_no_stamps_applied")
-
-	return page, stamps_applied
+	return ops, stamps_applied, errors
 
 
 def calculate_stamp_position(page_width, page_height, stamp_width, stamp_height, position, custom_x=None, custom_y=None):
@@ -2105,6 +2504,11 @@ def wrap_text(text, font, max_width, draw):
 	"""
 	Разбивает текст на строки, чтобы каждая строка не превышала max_width пикселей.
 
+	Ширина строки оценивается суммой advance-ширин слов (font.getlength, каждое слово
+	измеряется один раз) и ширины пробела. Точный draw.textbbox вызывается только когда
+	оценка ближе к max_width, чем на кегль шрифта, - поэтому переносы совпадают с
+	посимвольным измерением через textbbox (см. edo.utils.benchmarks.benchmark_wrap_text).
+
 	Args:
 		text: Текст для разбиения
 		font: PIL ImageFont объект
@@ -2114,58 +2518,41 @@ def wrap_text(text, font, max_width, draw):
 	Returns:
 		Список строк
 	"""
-	def wrap_long_word(word, font, max_width, draw):
-		"""Разбивает длинное слово на части посимвольно"""
-		result = []
-		current = ""
-		for char in word:
-			test = current + char
-			bbox = draw.textbbox((0, 0), test, font=font)
-			if bbox[2] - bbox[0] <= max_width:
-				current = test
-			else:
-				if current:
-					result.append(current)
-				current = char
-		if current:
-			result.append(current)
-		return result if result else [word]
-
-	words = text.split()
+	measure = _TextMeasure(font, draw)
+
 	lines = []
 	current_line = []
+	current_width = 0  # оценка ширины current_line
 
-	for word in words:
-		# Сначала проверяем, помещается ли слово целиком
-		bbox = draw.textbbox((0, 0), word, font=font)
-		word_width = bbox[2] - bbox[0]
+	for word in text.split():
+		word_width = measure.advance(word)
 
-		if word_width > max_width:
-			# Слово слишком длинное - разбиваем посимвольно
+		# Сначала проверяем, помещается ли слово целиком
+		if not measure.fits(word, word_width, max_width):
+			# Слово слишком длинное - разбиваем
 			if current_line:
 				lines.append(' '.join(current_line))
-				current_line = []
-			# Добавляем части длинного слова как отдельные строки
-			word_parts = wrap_long_word(word, font, max_width, draw)
+			word_parts = _wrap_long_word(word, measure, max_width)
 			lines.extend(word_parts[:-1])  # Все части кроме последней
-			if word_parts:
-				current_line = [word_parts[-1]]  # Последняя часть для продолжения
-		else:
-			# Проверяем ширину текущей строки + новое слово
-			test_line = ' '.join(current_line + [word])
-			bbox = draw.textbbox((0, 0), test_line, font=font)
-			line_width = bbox[2] - bbox[0]
+			# Последняя часть для продолжения
+			current_line = [word_parts[-1]]
+			current_width = measure.advance(word_parts[-1])
+			continue
 
-			if line_width <= max_width:
-				current_line.append(word)
-			else:
-				# Если текущая строка не пустая, сохраняем её
-				if current_line:
-					lines.append(' '.join(current_line))
-					current_line = [word]
-				else:
-					# Слово помещается, но строка не пустая - добавляем
-					current_line.append(word)
+		if not current_line:
+			current_line = [word]
+			current_width = word_width
+			continue
+
+		# Проверяем ширину текущей строки + новое слово
+		line_width = current_width + measure.space + word_width
+		if measure.fits(lambda: ' '.join(current_line + [word]), line_width, max_width):
+			current_line.append(word)
+			current_width = line_width
+		else:
+			lines.append(' '.join(current_line))
+			current_line = [word]
+			current_width = word_width
 
 	# Добавляем последнюю строку
 	if current_line:
@@ -2174,76 +2561,109 @@ def wrap_text(text, font, max_width, draw):
 	return lines if lines else [text]
 
 
-def render_text_on_stamp_image(stamp_img, field_mappings, document, show_text_area=False, use_placeholder=False):
+def _wrap_long_word(word, measure, max_width):
 	"""
-	Рендерит текст на изображении штампа на основе настроек field_mappings и данных документа.
+	Разбивает длинное слово на части: каждая часть - самый длинный помещающийся префикс
+	остатка (бинарный поиск по ширине префикса), но не меньше одного символа.
+	"""
+	result = []
+	rest = word
+	while rest:
+		low, high = 1, len(rest)
+		while low < high:
+			middle = (low + high + 1) // 2
+			prefix = rest[:middle]
+			if measure.fits(prefix, measure.advance(prefix), max_width):
+				low = middle
+			else:
+				high = middle - 1
+		result.append(rest[:low])
+		rest = rest[low:]
+	return result if result else [word]
+
+
+class _TextMeasure:
+	"""Ширины текста для wrap_text: дешёвая оценка через getlength, точная - через textbbox"""
+
+	def __init__(self, font, draw):
+		self.font = font
+		self.draw = draw
+		self.space = font.getlength(" ")
+		# Насколько ширина по textbbox может отличаться от суммы advance-ширин (выносы первого
+		# и последнего глыфа, кернинг на пробелах). Без размера шрифта измеряем всегда точно.
+		size = getattr(font, "size", None)
+		self.tolerance = size if size else None
+		self._advances = {}
+
+	def advance(self, text):
+		width = self._advances.get(text)
+		if width is None:
+			width = self._advances[text] = self.font.getlength(text)
+		return width
+
+	def width(self, text):
+		bbox = self.draw.textbbox((0, 0), text, font=self.font)
+		return bbox[2] - bbox[0]
+
+	def fits(self, text, estimate, max_width):
+		"""text - строка или функция, которая её строит (строка нужна только для точного измерения)"""
+		if self.tolerance is not None:
+			if estimate + self.tolerance <= max_width:
+				return True
+			if estimate - self.tolerance > max_width:
+				return False
+		return self.width(text() if callable(text) else text) <= max_width
+
+
+def _link_title_field(doctype):
+	"""Field shown instead of a Link value on stamps: full_name for users, title_field otherwise"""
+	if doctype == "User":
+		return "full_name"
+	return frappe.get_meta(doctype).title_field or "name"
+
+
+def _stamp_link_fields(field_mappings, document):
+	"""(fieldname, options) of Link fields that the field mappings print from the document"""
+	doc_meta = frappe.get_meta("EDO Document")
+	links = []
+	for field_mapping in field_mappings:
+		if not isinstance(field_mapping, dict) or not field_mapping.get("document_field"):
+			continue
+		fieldname = field_mapping["document_field"].split("|")[0]
+		field_meta = doc_meta.get_field(fieldname)
+		if field_meta and field_meta.fieldtype == "Link" and field_meta.options and getattr(document, fieldname, None):
+			links.append((fieldname, field_meta.options))
+	return links
+
+
+def stamp_field_texts(field_mappings, document, use_placeholder=False, resolver=None):
+	"""
+	Тексты, которые field_mappings печатают на штампе: по одной строке на настройку поля,
+	None - если поле не печатается (не настроено, пустое значение, нет документа).
 
 	Args:
-		stamp_img: PIL Image объект штампа
 		field_mappings: список настроек полей из EDO Stamp (child table)
 		document: EDO Document объект с данными
-		show_text_area: показывать ли рамку области текста (для превью в админке)
-		use_placeholder: использовать плейсхолдер вместо реальных данных (для админки)
+		use_placeholder: плейсхолдеры вместо реальных данных (для админки)
+		resolver: LinkResolver, общий для нескольких штампов одного документа (опционально)
 
 	Returns:
-		PIL Image с нарисованным текстом
+		tuple текстов (ключ кэша отрендеренных штампов, см. edo.utils.stamp_assets)
 	"""
-	from PIL import ImageDraw, ImageFont
-	import re
-	import os
-
-	# Создаем копию изображения для рисования
-	img_with_text = stamp_img.copy()
-	draw = ImageDraw.Draw(img_with_text)
-
-	# Пытаемся загрузить шрифт, если не получится - используем стандартный
-	try:
-		# Пробуем использовать системный шрифт
-		font_paths = [
-			"/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
-			"/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
-			"/System/Library/Fonts/Helvetica.ttc",
-		]
-		default_font = None
-		for font_path in font_paths:
-			try:
-				default_font = ImageFont.truetype(font_path, 12)
-				break
-			except:
-				continue
-		if not default_font:
-			default_font = ImageFont.load_default()
-	except:
-		default_font = ImageFont.load_default()
-
-	# Обрабатываем каждую настройку поля
+	# Названия для Link полей — одним запросом на doctype, а не get_doc на каждое поле
+	if document and not use_placeholder:
+		resolver = resolver or LinkResolver()
+		for fieldname, options in _stamp_link_fields(field_mappings, document):
+			resolver.add(options, getattr(document, fieldname), [_link_title_field(options)])
+		resolver.resolve()
+
+	doc_meta = frappe.get_meta("EDO Document")
+	texts = []
 	# field_mappings уже должны быть списком словарей на этом этапе
-	for idx, field_mapping in enumerate(field_mappings):
-		# Убеждаемся, что это словарь
-		if not isinstance(field_mapping, dict):
-			continue
-
-		document_field = field_mapping.get("document_field")
-		# Пропускаем только если поле не указано вообще (для плейсхолдеров показываем даже пустые поля)
+	for field_mapping in field_mappings:
+		document_field = field_mapping.get("document_field") if isinstance(field_mapping, dict) else None
 		if not document_field:
-			# В режиме плейсхолдеров можно показать что-то общее, но обычно это означает ошибку конфигурации
-			if use_placeholder:
-				# Показываем общий плейсхолдер для не настроенных полей
-				field_value = "[Поле не настроено]"
-				position_x = int(field_mapping.get("position_x") or 0)
-				position_y = int(field_mapping.get("position_y") or 0)
-				font_size = int(field_mapping.get("font_size") or 12)
-				color = field_mapping.get("color") or "#000000"
-				try:
-					color_hex = color.lstrip('#')
-					rgb_color = tuple(int(color_hex[i:i+2], 16) for i in (0, 2, 4))
-				except:
-					rgb_color = (0, 0, 0)
-				try:
-					font = ImageFont.load_default()
-					draw.text((position_x, position_y), field_value, fill=rgb_color, font=font)
-				except:
-					pass
+			texts.append(None)
 			continue
 
 		# document_field может содержать формат "fieldname|Label [Type]" - берём только fieldname
@@ -2254,31 +2674,12 @@ def render_text_on_stamp_image(stamp_img, field_mappings, document, show_text_ar
 			document_field = parts[0]
 			field_label = parts[1] if len(parts) > 1 else document_field
 
-		# Получаем параметры позиции и стиля (нужны для области и текста)
-		position_x = int(field_mapping.get("position_x") or 0)
-		position_y = int(field_mapping.get("position_y") or 0)
-		font_size = int(field_mapping.get("font_size") or 12)
-		max_width = int(field_mapping.get("max_width") or 0)
-		color = field_mapping.get("color") or "#000000"
-
-		# Рисуем область текста если show_text_area=True (независимо от document)
-		if show_text_area and max_width > 0:
-			# Примерная высота области (3 строки)
-			estimated_height = (font_size + 4) * 3
-			# Рисуем прямоугольник области красным цветом
-			draw.rectangle(
-				[position_x, position_y, position_x + max_width, position_y + estimated_height],
-				outline=(255, 0, 0),
-				width=2
-			)
-
 		# Если use_placeholder=True, показываем название поля вместо данных
 		if use_placeholder:
 			# Получаем читаемое название поля
 			if not field_label:
 				# Пытаемся получить label из метаданных
 				try:
-					doc_meta = frappe.get_meta("EDO Document")
 					field_meta = doc_meta.get_field(document_field)
 					field_label = field_meta.label if field_meta else document_field
 				except:
@@ -2286,51 +2687,80 @@ def render_text_on_stamp_image(stamp_img, field_mappings, document, show_text_ar
 			# Убираем [Type] из label если есть
 			if field_label and "[" in field_label:
 				field_label = field_label.split("[")[0].strip()
-			field_value = f"[{field_label}]"
-		elif document:
-			# Получаем значение поля из документа
-			field_value = getattr(document, document_field, None)
-		else:
+			# Для плейсхолдеров показываем даже если поле пустое
+			texts.append(f"[{field_label}]")
 			continue
 
-		# field_value уже установлен выше (либо плейсхолдер, либо из документа)
+		if not document:
+			texts.append(None)
+			continue
 
-		# Для плейсхолдеров показываем даже если поле пустое
-		if use_placeholder:
-			text = str(field_value)
-		else:
-			# Если значение None или пустое, пропускаем (только для реальных данных, не для плейсхолдеров)
-			if field_value is None or field_value == "":
-				continue
-			
-			# Получаем метаданные поля для определения типа
-			doc_meta = frappe.get_meta("EDO Document")
-			field_meta = doc_meta.get_field(document_field)
+		# Получаем значение поля из документа
+		field_value = getattr(document, document_field, None)
+		# Если значение None или пустое, пропускаем
+		if field_value is None or field_value == "":
+			texts.append(None)
+			continue
 
-			# Форматируем значение в зависимости от типа
-			if field_meta and field_meta.fieldtype == "Link":
-				# Для Link полей получаем название связанного документа
-				try:
-					linked_doc = frappe.get_doc(field_meta.options, field_value)
-					# Для User используем full_name, для остальных - title_field или name
-					if field_meta.options == "User":
-						text = getattr(linked_doc, "full_name", None) or getattr(linked_doc, "name", field_value) or field_value
-					else:
-						# Пытаемся получить title_field или name
-						title_field = frappe.get_meta(field_meta.options).title_field or "name"
-						text = getattr(linked_doc, title_field, field_value) or field_value
-				except:
-					text = str(field_value)
-			elif isinstance(field_value, (frappe.utils.datetime.datetime, frappe.utils.datetime.date)):
-				# Для дат используем форматирование
-				if isinstance(field_value, frappe.utils.datetime.datetime):
-					text = frappe.utils.format_datetime(field_value, "dd.MM.yyyy HH:mm")
-				else:
-					text = frappe.utils.formatdate(field_value, "dd.MM.yyyy")
-			elif isinstance(field_value, (int, float)):
-				text = str(field_value)
+		# Форматируем значение в зависимости от типа
+		field_meta = doc_meta.get_field(document_field)
+		if field_meta and field_meta.fieldtype == "Link":
+			# Для Link полей получаем название связанного документа
+			# Для User используем full_name, для остальных - title_field или name
+			text = str(
+				resolver.get_value(field_meta.options, field_value, _link_title_field(field_meta.options))
+				or field_value
+			)
+		elif isinstance(field_value, (frappe.utils.datetime.datetime, frappe.utils.datetime.date)):
+			# Для дат используем форматирование
+			if isinstance(field_value, frappe.utils.datetime.datetime):
+				text = frappe.utils.format_datetime(field_value, "dd.MM.yyyy HH:mm")
 			else:
-				text = str(field_value)
+				text = frappe.utils.formatdate(field_value, "dd.MM.yyyy")
+		else:
+			text = str(field_value)
+		texts.append(text)
+
+	return tuple(texts)
+
+
+def render_text_on_stamp_image(stamp_img, field_mappings, document, show_text_area=False, use_placeholder=False, resolver=None, texts=None):
+	"""
+	Рендерит текст на изображении штампа на основе настроек field_mappings и данных документа.
+
+	Args:
+		stamp_img: PIL Image объект штампа
+		field_mappings: список настроек полей из EDO Stamp (child table)
+		document: EDO Document объект с данными
+		show_text_area: показывать ли рамку области текста (для превью в админке)
+		use_placeholder: использовать плейсхолдер вместо реальных данных (для админки)
+		resolver: LinkResolver, общий для нескольких штампов одного документа (опционально)
+		texts: уже вычисленные stamp_field_texts (опционально)
+
+	Returns:
+		PIL Image с нарисованным текстом
+	"""
+	from PIL import ImageDraw, ImageFont
+
+	if texts is None:
+		texts = stamp_field_texts(field_mappings, document, use_placeholder=use_placeholder, resolver=resolver)
+
+	# Создаем копию изображения для рисования
+	img_with_text = stamp_img.copy()
+	draw = ImageDraw.Draw(img_with_text)
+
+	# Обрабатываем каждую настройку поля
+	for field_mapping, text in zip(field_mappings, texts):
+		# Убеждаемся, что это словарь
+		if not isinstance(field_mapping, dict):
+			continue
+
+		# Получаем параметры позиции и стиля (нужны для области и текста)
+		position_x = int(field_mapping.get("position_x") or 0)
+		position_y = int(field_mapping.get("position_y") or 0)
+		font_size = int(field_mapping.get("font_size") or 12)
+		max_width = int(field_mapping.get("max_width") or 0)
+		color = field_mapping.get("color") or "#000000"
 
 		# Парсим цвет из hex
 		try:
@@ -2340,28 +2770,34 @@ def render_text_on_stamp_image(stamp_img, field_mappings, document, show_text_ar
 			rgb_color = tuple(int(color_hex[i:i+2], 16) for i in (0, 2, 4))
 		except:
 			rgb_color = (0, 0, 0)  # Черный по умолчанию
-		
-		# Загружаем шрифт нужного размера
-		font = None
-		font_paths = [
-			"/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
-			"/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
-			"/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
-			"/usr/share/fonts/truetype/freefont/FreeSans.ttf",
-			"/usr/share/fonts/TTF/DejaVuSans.ttf",  # Arch/Manjaro
-			"/usr/share/fonts/dejavu/DejaVuSans.ttf",  # Some distros
-		]
-		for font_path in font_paths:
-			try:
-				if os.path.exists(font_path):
-					font = ImageFont.truetype(font_path, font_size)
-					break
-			except Exception:
-				continue
 
-		if not font:
-			# Fallback to default font (small, but works)
-			font = ImageFont.load_default()
+		# Пропускаем только если поле не указано вообще (для плейсхолдеров показываем даже пустые поля)
+		if not field_mapping.get("document_field"):
+			# В режиме плейсхолдеров можно показать что-то общее, но обычно это означает ошибку конфигурации
+			if use_placeholder:
+				# Показываем общий плейсхолдер для не настроенных полей
+				try:
+					draw.text((position_x, position_y), "[Поле не настроено]", fill=rgb_color, font=ImageFont.load_default())
+				except:
+					pass
+			continue
+
+		# Рисуем область текста если show_text_area=True (независимо от document)
+		if show_text_area and max_width > 0:
+			# Примерная высота области (3 строки)
+			estimated_height = (font_size + 4) * 3
+			# Рисуем прямоугольник области красным цветом
+			draw.rectangle(
+				[position_x, position_y, position_x + max_width, position_y + estimated_height],
+				outline=(255, 0, 0),
+				width=2
+			)
+
+		if text is None:
+			continue
+
+		# Шрифт нужного размера (из кэша, см. edo.utils.fonts)
+		font = get_font(font_size)
 
 		# Рисуем текст на изображении
 		try:
@@ -2376,13 +2812,60 @@ def render_text_on_stamp_image(stamp_img, field_mappings, document, show_text_ar
 			else:
 				# Без переноса - одна строка
 				draw.text((position_x, position_y), text, fill=rgb_color, font=font)
-		except Exception as e:
+		except Exception:
 			# Продолжаем при ошибке рисования
 			continue
 
 	return img_with_text
 
 
+def stamp_text_ops(field_mappings, texts, x, y, scale, stamp_height):
+	"""
+	Строки текстов field_mappings для векторного слоя поверх штампа, нарисованного в (x, y)
+	с масштабом scale: ("text", x, y, кегль, (r, g, b), строка) в координатах страницы PDF
+	(см. edo.utils.stamp_overlay). Шрифт встраивается подмножеством глифов, текст остаётся
+	чётким при любом масштабе и доступен для поиска.
+
+	Позиции, кегль и переносы строк - те же, что у render_text_on_stamp_image (в пикселях
+	изображения штампа, отсчёт от верхнего левого угла).
+	"""
+	from PIL import Image, ImageDraw
+
+	measure_draw = ImageDraw.Draw(Image.new("L", (1, 1)))
+	top = y + stamp_height * scale
+	ops = []
+
+	for field_mapping, text in zip(field_mappings, texts):
+		if text is None or not isinstance(field_mapping, dict):
+			continue
+
+		position_x = int(field_mapping.get("position_x") or 0)
+		position_y = int(field_mapping.get("position_y") or 0)
+		font_size = int(field_mapping.get("font_size") or 12)
+		max_width = int(field_mapping.get("max_width") or 0)
+
+		font = get_font(font_size)
+		# PIL рисует текст от линии выносных элементов, reportlab - от базовой линии
+		ascent = font.getmetrics()[0] if hasattr(font, "getmetrics") else font_size * 0.8
+		lines = wrap_text(text, font, max_width, measure_draw) if max_width > 0 else [text]
+
+		color = _hex_to_rgb(field_mapping.get("color"))
+		for line_no, line in enumerate(lines):
+			baseline = position_y + line_no * (font_size + 4) + ascent
+			ops.append(("text", x + position_x * scale, top - baseline * scale, font_size * scale, color, line))
+
+	return ops
+
+
+def _hex_to_rgb(color):
+	"""(r, g, b) цвета "#rrggbb", чёрный по умолчанию"""
+	try:
+		color_hex = (color or "#000000").lstrip('#')
+		return tuple(int(color_hex[i:i+2], 16) for i in (0, 2, 4))
+	except Exception:
+		return (0, 0, 0)
+
+
 def get_file_path(file_url):
 	"""Get absolute file path from Frappe file URL"""
 	if not file_url:
@@ -2519,10 +3002,7 @@ def sign_document_with_pkcs7(document_name, pkcs7):
 			frappe.throw("Not authorized", frappe.PermissionError)
 
 		# Check permission
-		user_roles = frappe.get_roles(user)
-		can_sign = any(role in user_roles for role in ["EDO Admin", "EDO Manager", "EDO Director"])
-		if not can_sign:
-			frappe.throw("You don't have permission to sign documents", frappe.PermissionError)
+		check(get_user_context(), "sign_pdf")
 
 		# Проверяем параметры (ошибки нашей стороны)
 		if not document_name:
@@ -2966,7 +3446,8 @@ def sign_document_with_pkcs7(document_name, pkcs7):
 			
 			# После успешной подписи переходим по статусам как раньше
 			# Определяем, кто подписывает: директор или исполнитель
-			is_director = "EDO Director" in user_roles or "EDO Admin" in user_roles
+			ctx = get_user_context()
+			is_director = ctx.is_director or ctx.is_admin
 			is_executor = False
 			
 			# Проверяем, является ли пользователь исполнителем
@@ -3024,6 +3505,7 @@ def sign_document_with_pkcs7(document_name, pkcs7):
 						doc.status = "Выполнено"
 			
 			doc.save(ignore_permissions=True)
+			publish_workflow_update(doc)
 			
 			frappe.db.commit()
 		except Exception as e:
@@ -0,0 +1,2 @@
+# Copyright (c) 2026, Publish and contributors
+# For license information, please see license.txt
@@ -0,0 +1,268 @@
+# Copyright (c) 2026, Publish and contributors
+# For license information, please see license.txt
+
+"""
+Materialized visibility index for EDO Document.
+
+One row per (user, document, reason): why a user can see a document in the portal.
+Rows are rebuilt from EDODocument.on_update and EDOReceptionOffice.on_update, so that
+"what can this user see" is a single indexed lookup instead of several queries per request.
+Role checks stay in the callers: a row only says the user is related to the document,
+the caller decides which reasons (and statuses) count for the user's roles.
+
+When a user loses every relation to a document (or the document is deleted), a "Revoked" row
+is kept for REVOKED_RETENTION_DAYS so delta sync can tell the portal to drop the document.
+
+Backfill / repair:
+	bench --site <site> execute edo.edo.doctype.edo_document_access.edo_document_access.rebuild_document_access
+"""
+
+from collections import defaultdict
+
+import frappe
+from frappe.model.document import Document
+from frappe.query_builder import Criterion
+
+ACCESS_EXECUTOR = "Executor"
+ACCESS_CO_EXECUTOR = "Co-Executor"
+ACCESS_RECEPTION = "Reception"
+ACCESS_DIRECTOR = "Director"
+ACCESS_OFFICE_DIRECTOR = "Office Director"
+# Tombstone: the user was related to the document and no longer is; never grants access
+ACCESS_REVOKED = "Revoked"
+
+REVOKED_RETENTION_DAYS = 30
+
+# Reasons derived from the reception office rather than from the document itself
+OFFICE_REASONS = (ACCESS_RECEPTION, ACCESS_OFFICE_DIRECTOR)
+
+ACCESS_FIELDS = ("name", "creation", "modified", "modified_by", "owner", "user", "document", "reason", "status")
+
+
+class EDODocumentAccess(Document):
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("EDO Document Access", ["user", "reason", "document"])
+
+
+def get_access_rows(doc, office_users=None, office_director=None):
+	"""
+	(user, reason) pairs for an EDO Document.
+
+	office_users / office_director can be passed in to avoid querying the reception office
+	(used by the bulk rebuild); otherwise they are read from doc.reception_office.
+	"""
+	rows = set()
+
+	if doc.get("executor"):
+		rows.add((doc.executor, ACCESS_EXECUTOR))
+	for co_exec in doc.get("co_executors") or []:
+		if co_exec.get("user"):
+			rows.add((co_exec.get("user"), ACCESS_CO_EXECUTOR))
+	if doc.get("director_user"):
+		rows.add((doc.director_user, ACCESS_DIRECTOR))
+
+	if doc.get("reception_office"):
+		if office_users is None:
+			office_users = frappe.get_all(
+				"EDO Reception Office User",
+				filters={"parent": doc.reception_office, "parenttype": "EDO Reception Office"},
+				pluck="user"
+			)
+		if office_director is None:
+			office_director = frappe.db.get_value("EDO Reception Office", doc.reception_office, "director")
+		for user in office_users:
+			if user:
+				rows.add((user, ACCESS_RECEPTION))
+		if office_director:
+			rows.add((office_director, ACCESS_OFFICE_DIRECTOR))
+
+	return rows
+
+
+def sync_document_access(doc):
+	"""
+	Rebuild access rows of one document (called from EDODocument.on_update).
+
+	Returns users related to the document before or after the update.
+	"""
+	rows = get_access_rows(doc)
+	users = {user for user, reason in rows}
+	old_users = set(frappe.get_all(
+		"EDO Document Access",
+		filters={"document": doc.name, "reason": ["!=", ACCESS_REVOKED]},
+		pluck="user",
+		distinct=True
+	))
+
+	# Existing tombstones are kept (with their timestamp) unless the user regained access
+	access = frappe.qb.DocType("EDO Document Access")
+	condition = access.reason != ACCESS_REVOKED
+	if users:
+		condition = condition | access.user.isin(list(users))
+	frappe.qb.from_(access).delete().where((access.document == doc.name) & condition).run()
+
+	rows |= {(user, ACCESS_REVOKED) for user in old_users - users}
+	_insert_access_rows((user, doc.name, reason, doc.status) for user, reason in rows)
+
+	return old_users | users
+
+
+def remove_document_access(document):
+	"""Turn access rows of a deleted document into tombstones, one per user"""
+	users = frappe.get_all(
+		"EDO Document Access",
+		filters={"document": document, "reason": ["!=", ACCESS_REVOKED]},
+		pluck="user",
+		distinct=True
+	)
+	frappe.db.delete("EDO Document Access", {"document": document})
+	_insert_access_rows((user, document, ACCESS_REVOKED, None) for user in users)
+
+
+def sync_reception_office_access(reception_office):
+	"""Rebuild office-derived rows (Reception, Office Director) for all documents of a reception office"""
+	office = frappe.get_doc("EDO Reception Office", reception_office)
+	office_users = [row.user for row in office.users if row.user]
+
+	access = frappe.qb.DocType("EDO Document Access")
+	edo_document = frappe.qb.DocType("EDO Document")
+	office_documents = (
+		frappe.qb.from_(edo_document)
+		.select(edo_document.name)
+		.where(edo_document.reception_office == reception_office)
+	)
+	old_users = {
+		row[0] for row in (
+			frappe.qb.from_(access)
+			.select(access.user).distinct()
+			.where(access.reason.isin(OFFICE_REASONS) & access.document.isin(office_documents))
+		).run()
+	}
+	(
+		frappe.qb.from_(access)
+		.delete()
+		.where(access.reason.isin(OFFICE_REASONS) & access.document.isin(office_documents))
+	).run()
+
+	documents = frappe.get_all(
+		"EDO Document",
+		filters={"reception_office": reception_office},
+		fields=["name", "status"]
+	)
+	rows = []
+	for document in documents:
+		for user in office_users:
+			rows.append((user, document.name, ACCESS_RECEPTION, document.status))
+		if office.director:
+			rows.append((office.director, document.name, ACCESS_OFFICE_DIRECTOR, document.status))
+		# Users who left the office; a tombstone is harmless if they still see the document for another reason
+		for user in old_users - set(office_users) - {office.director}:
+			rows.append((user, document.name, ACCESS_REVOKED, document.status))
+	_insert_access_rows(rows)
+
+
+def rebuild_document_access():
+	"""Rebuild the whole index from EDO Document, EDO Co-Executor and EDO Reception Office."""
+	office_directors = dict(frappe.get_all("EDO Reception Office", fields=["name", "director"], as_list=True))
+	office_users = defaultdict(list)
+	for row in frappe.get_all(
+		"EDO Reception Office User",
+		filters={"parenttype": "EDO Reception Office"},
+		fields=["parent", "user"]
+	):
+		office_users[row.parent].append(row.user)
+
+	co_executors = defaultdict(list)
+	for row in frappe.get_all(
+		"EDO Co-Executor",
+		filters={"parenttype": "EDO Document"},
+		fields=["parent", "user"]
+	):
+		co_executors[row.parent].append(frappe._dict(user=row.user))
+
+	documents = frappe.get_all(
+		"EDO Document",
+		fields=["name", "status", "executor", "director_user", "reception_office"]
+	)
+
+	# Tombstones can't be rebuilt from documents - keep them
+	frappe.db.delete("EDO Document Access", {"reason": ["!=", ACCESS_REVOKED]})
+	rows = []
+	for document in documents:
+		document.co_executors = co_executors.get(document.name, [])
+		office = document.reception_office
+		for user, reason in get_access_rows(
+			document,
+			office_users=office_users.get(office, []) if office else None,
+			office_director=(office_directors.get(office) or "") if office else None,
+		):
+			rows.append((user, document.name, reason, document.status))
+	_insert_access_rows(rows)
+	frappe.db.commit()
+
+	return {"documents": len(documents), "rows": len(rows)}
+
+
+def prune_revoked_access():
+	"""Drop tombstones older than REVOKED_RETENTION_DAYS (daily scheduler job)"""
+	cutoff = frappe.utils.add_days(frappe.utils.now_datetime(), -REVOKED_RETENTION_DAYS)
+	frappe.db.delete("EDO Document Access", {"reason": ACCESS_REVOKED, "modified": ["<", cutoff]})
+
+
+def has_document_access(user, document, reasons):
+	"""True if the user is related to the document by one of the given reasons"""
+	return bool(frappe.db.exists(
+		"EDO Document Access",
+		{"user": user, "document": document, "reason": ["in", list(reasons)]}
+	))
+
+
+def accessible_documents_query(user, grants):
+	"""
+	Subquery selecting documents the user can see.
+
+	Args:
+		user: User name
+		grants: {reason: statuses} - statuses is a list of document statuses the reason
+			is limited to, or None for any status
+
+	Use as `edo_document.name.isin(accessible_documents_query(...))`.
+	"""
+	access = frappe.qb.DocType("EDO Document Access")
+	grant_conditions = []
+	for reason, statuses in grants.items():
+		condition = access.reason == reason
+		if statuses:
+			condition = condition & access.status.isin(list(statuses))
+		grant_conditions.append(condition)
+
+	return (
+		frappe.qb.from_(access)
+		.select(access.document)
+		.where((access.user == user) & Criterion.any(grant_conditions))
+	)
+
+
+def changed_access_query(user, since):
+	"""Subquery selecting documents whose access rows for the user (tombstones included) changed after `since`"""
+	access = frappe.qb.DocType("EDO Document Access")
+	return (
+		frappe.qb.from_(access)
+		.select(access.document).distinct()
+		.where((access.user == user) & (access.modified > since))
+	)
+
+
+def _insert_access_rows(rows):
+	"""Bulk insert (user, document, reason, status) tuples"""
+	now = frappe.utils.now()
+	session_user = frappe.session.user if getattr(frappe.local, "session", None) else "Administrator"
+	values = [
+		(frappe.generate_hash(length=12), now, now, session_user, session_user, user, document, reason, status)
+		for user, document, reason, status in rows
+	]
+	if values:
+		frappe.db.bulk_insert("EDO Document Access", ACCESS_FIELDS, values)
@@ -2,8 +2,9 @@
 # For license information, please see license.txt
 
 import frappe
-from frappe.model.document import Document
 
+from edo.utils.reference_cache import ReferenceDocument
 
-class EDODocumentType(Document):
+
+class EDODocumentType(ReferenceDocument):
 	pass
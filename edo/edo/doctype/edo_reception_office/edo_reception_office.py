@@ -2,8 +2,14 @@
 # For license information, please see license.txt
 
 import frappe
-from frappe.model.document import Document
 
+from edo.utils.reference_cache import ReferenceDocument
 
-class EDOReceptionOffice(Document):
-	pass
+
+class EDOReceptionOffice(ReferenceDocument):
+	def on_update(self):
+		super().on_update()
+		# Membership and director drive document visibility
+		from edo.edo.doctype.edo_document_access.edo_document_access import sync_reception_office_access
+
+		sync_reception_office_access(self.name)
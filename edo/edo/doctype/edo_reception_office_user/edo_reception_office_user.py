@@ -7,3 +7,9 @@ from frappe.model.document import Document
 
 class EDOReceptionOfficeUser(Document):
 	pass
+
+
+def on_doctype_update():
+	from edo.utils.indexes import add_workflow_indexes
+
+	add_workflow_indexes("EDO Reception Office User")
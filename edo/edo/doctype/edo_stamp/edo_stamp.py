@@ -4,9 +4,15 @@
 import frappe
 from frappe.model.document import Document
 
+from edo.utils.stamp_assets import clear_stamp_assets, get_stamp_asset
+
 
 class EDOStamp(Document):
-	pass
+	def on_update(self):
+		clear_stamp_assets(self.name)
+
+	def on_trash(self):
+		clear_stamp_assets(self.name)
 
 
 @frappe.whitelist()
@@ -80,31 +86,19 @@ def get_stamp_preview(stamp_name, document_name=None, show_text_area=False):
 	# Конвертируем строку в bool если пришла из JS
 	if isinstance(show_text_area, str):
 		show_text_area = show_text_area.lower() in ('true', '1', 'yes')
-	import os
 	import base64
-	from PIL import Image
 	from io import BytesIO
 	
-	# Получаем штамп
-	stamp_doc = frappe.get_doc("EDO Stamp", stamp_name)
-	
-	if not stamp_doc.stamp_image:
-		frappe.throw("Штамп не имеет изображения")
-	
-	# Получаем путь к изображению
-	from edo.edo.doctype.edo_document.edo_document import get_file_path
-	stamp_image_path = get_file_path(stamp_doc.stamp_image)
-	
-	if not stamp_image_path or not os.path.exists(stamp_image_path):
-		frappe.throw("Изображение штампа не найдено")
-	
-	# Загружаем изображение
-	stamp_img = Image.open(stamp_image_path)
-	if stamp_img.mode != 'RGBA':
-		stamp_img = stamp_img.convert('RGBA')
-	
+	# Получаем декодированный штамп (из кэша)
+	try:
+		asset = get_stamp_asset(stamp_name)
+	except frappe.ValidationError as e:
+		# Preview is for one stamp: show the reason to the user
+		frappe.throw(str(e), type(e))
+	stamp_img = asset.image
+
 	# Если есть field_mappings, заполняем их
-	if hasattr(stamp_doc, 'field_mappings') and stamp_doc.field_mappings and len(stamp_doc.field_mappings) > 0:
+	if asset.field_mappings:
 		# Получаем документ для заполнения
 		doc = None
 		if document_name:
@@ -117,28 +111,11 @@ def get_stamp_preview(stamp_name, document_name=None, show_text_area=False):
 		# Если show_text_area=True (админка) и нет конкретного документа - показываем плейсхолдеры
 		use_placeholder = show_text_area and not document_name
 
-		# Конвертируем field_mappings в список словарей
-		field_mappings_list = []
-		for mapping in stamp_doc.field_mappings:
-			if hasattr(mapping, 'as_dict'):
-				field_mappings_list.append(mapping.as_dict())
-			elif isinstance(mapping, dict):
-				field_mappings_list.append(mapping)
-			else:
-				field_mappings_list.append({
-					"document_field": getattr(mapping, 'document_field', None),
-					"position_x": getattr(mapping, 'position_x', 0),
-					"position_y": getattr(mapping, 'position_y', 0),
-					"font_size": getattr(mapping, 'font_size', 12),
-					"color": getattr(mapping, 'color', '#000000'),
-					"max_width": getattr(mapping, 'max_width', 0),
-				})
-
-		# Рендерим текст на изображении
+		# Рендерим текст на копии изображения
 		# В админке (show_text_area=True без document_name) показываем плейсхолдеры
 		from edo.edo.doctype.edo_document.edo_document import render_text_on_stamp_image
 		stamp_img = render_text_on_stamp_image(
-			stamp_img, field_mappings_list, doc,
+			stamp_img, list(asset.field_mappings), doc,
 			show_text_area=show_text_area,
 			use_placeholder=use_placeholder
 		)
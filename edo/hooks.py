@@ -207,6 +207,12 @@ after_install = "edo.utils.setup_permissions.setup_admin_permissions"
 # 	],
 # }
 
+scheduler_events = {
+	"daily": [
+		"edo.edo.doctype.edo_document_access.edo_document_access.prune_revoked_access"
+	],
+}
+
 # Testing
 # -------
 
@@ -235,6 +241,9 @@ after_install = "edo.utils.setup_permissions.setup_admin_permissions"
 
 # ignore_links_on_delete = ["Communication", "ToDo"]
 
+# Tombstone rows of deleted documents (see EDO Document Access)
+ignore_links_on_delete = ["EDO Document Access"]
+
 # Request Events
 # ----------------
 # before_request = ["edo.utils.before_request"]
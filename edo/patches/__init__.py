@@ -20,3 +20,34 @@ def add_user_fiska_priority_custom_field():
 		"description": "Приоритет в списке на фишке (меньше — выше в списке)",
 	}).insert(ignore_permissions=True)
 	frappe.db.commit()
+
+
+def add_edo_document_search_index():
+	"""Backfill EDO Document.search_text and create its FULLTEXT index for the portal search."""
+	from edo.edo.doctype.edo_document.edo_document import (
+		PORTAL_SEARCH_FIELDS,
+		build_search_text,
+		ensure_search_fulltext_index,
+	)
+
+	for row in frappe.get_all("EDO Document", fields=list(PORTAL_SEARCH_FIELDS)):
+		frappe.db.set_value(
+			"EDO Document", row.name, "search_text", build_search_text(row), update_modified=False
+		)
+	ensure_search_fulltext_index()
+	frappe.db.commit()
+
+
+def build_edo_document_access():
+	"""Backfill the EDO Document Access visibility index."""
+	from edo.edo.doctype.edo_document_access.edo_document_access import rebuild_document_access
+
+	rebuild_document_access()
+
+
+def add_edo_workflow_indexes():
+	"""Composite indexes for the role-scoped workflow queries (see edo.utils.indexes)."""
+	from edo.utils.indexes import add_workflow_indexes
+
+	add_workflow_indexes()
+	frappe.db.commit()
@@ -0,0 +1,7 @@
+# Copyright (c) 2026, Publish and contributors
+
+from edo.patches import add_edo_document_search_index
+
+
+def execute():
+	add_edo_document_search_index()
@@ -0,0 +1,7 @@
+# Copyright (c) 2026, Publish and contributors
+
+from edo.patches import build_edo_document_access
+
+
+def execute():
+	build_edo_document_access()
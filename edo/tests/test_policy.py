@@ -0,0 +1,352 @@
+# Copyright (c) 2026, Publish and contributors
+# For license information, please see license.txt
+"""
+Parity of edo.utils.policy with the role branches it replaced.
+
+The baseline_* functions below are the checks as they were written in the endpoints before the
+policy module (edo_document.py). Every rule is compared with its baseline for each combination
+of roles, reception offices, access index rows and document state: same allow/deny, same
+exception type, same message. The portal scope is compared with the filters of the old
+get_portal_documents, frozen per role in SCOPE_CASES.
+"""
+from itertools import product
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from edo.edo.doctype.edo_document_access.edo_document_access import (
+	ACCESS_OFFICE_DIRECTOR,
+	ACCESS_RECEPTION,
+	accessible_documents_query,
+	get_access_rows,
+)
+from edo.utils.policy import RULES, UserContext, can, check, scope_filters
+
+USER = "policy-test-user@example.com"
+OTHER_USER = "policy-test-other@example.com"
+OFFICE = "Policy Test Office"
+
+EDO_ROLES = ["EDO User", "EDO Admin", "EDO Observer", "EDO Executor", "EDO Manager", "EDO Director", "EDO Reception"]
+
+ROLE_SETS = {
+	"admin": ["EDO Admin"],
+	"manager": ["EDO Manager"],
+	"director": ["EDO Director"],
+	"reception": ["EDO Reception"],
+	"executor": ["EDO Executor"],
+	"observer": ["EDO User", "EDO Observer"],
+	"no_edo_role": ["System Manager"],
+	"admin_director": ["EDO Admin", "EDO Director"],
+	"director_reception": ["EDO Director", "EDO Reception"],
+	"manager_director": ["EDO Manager", "EDO Director"],
+}
+
+# (reception offices the user works in, offices the user directs, access index reasons)
+ENVIRONMENTS = [
+	(offices, directed, granted)
+	for offices in (frozenset(), frozenset({OFFICE}))
+	for directed in (frozenset(), frozenset({OFFICE}))
+	for granted in (frozenset(), frozenset({ACCESS_OFFICE_DIRECTOR}), frozenset({ACCESS_RECEPTION}))
+]
+
+DOCUMENTS = [
+	frappe._dict(
+		name="EDO-POLICY-TEST",
+		status=status,
+		director_user=director_user,
+		reception_office=reception_office,
+		executor=executor,
+		co_executors=[frappe._dict(user=user) for user in co_executors],
+		signatures=[frappe._dict(user=user) for user in signatures],
+	)
+	for status, director_user, reception_office, executor, co_executors, signatures in product(
+		("Новый", "На рассмотрении", "На исполнении", "Выполнено"),
+		(None, USER, OTHER_USER),
+		(None, OFFICE),
+		(None, USER, OTHER_USER),
+		((), (USER,)),
+		((), (USER,), (OTHER_USER,)),
+	)
+]
+
+
+# Rules that read offices or the access index; the others only depend on roles and the document
+ENVIRONMENT_RULES = {"read", "approve_any"}
+
+
+# Baseline: the role branches as they were in the endpoints
+
+def baseline_access(doc, user, user_roles, env):
+	if not any(role in user_roles for role in EDO_ROLES):
+		frappe.throw("No permission to view document", frappe.PermissionError)
+
+
+def baseline_read(doc, user, user_roles, env):
+	offices, directed, granted = env
+
+	def has_document_access(reasons):
+		return bool(set(reasons) & granted)
+
+	if not any(role in user_roles for role in EDO_ROLES):
+		frappe.throw("No permission to view documents", frappe.PermissionError)
+
+	if "EDO Director" in user_roles and "EDO Admin" not in user_roles:
+		if doc.director_user and doc.director_user != user:
+			frappe.throw("No permission to view this document. It is assigned to a different director.", frappe.PermissionError)
+		if not doc.director_user:
+			if doc.reception_office:
+				if not has_document_access([ACCESS_OFFICE_DIRECTOR]):
+					frappe.throw("No permission to view this document. It belongs to a different reception office.", frappe.PermissionError)
+			else:
+				frappe.throw("No permission to view this document. It is not assigned to any reception office.", frappe.PermissionError)
+
+	if "EDO Reception" in user_roles and "EDO Admin" not in user_roles:
+		if not has_document_access([ACCESS_RECEPTION]):
+			if not offices:
+				frappe.throw("You are not assigned to any reception office", frappe.PermissionError)
+			frappe.throw("No permission to view this document. It belongs to a different reception office.", frappe.PermissionError)
+
+	if "EDO Manager" not in user_roles and "EDO Director" not in user_roles and "EDO Admin" not in user_roles and "EDO Reception" not in user_roles:
+		is_executor = doc.executor == user or any(co_exec.user == user for co_exec in doc.co_executors)
+		if not is_executor:
+			frappe.throw("No permission to view this document", frappe.PermissionError)
+		if doc.status not in ["На исполнении", "Выполнено"]:
+			frappe.throw("Document is not available for execution yet. It must be approved by director first.", frappe.PermissionError)
+
+
+def baseline_create(doc, user, user_roles, env):
+	if not ("EDO Admin" in user_roles or "EDO Manager" in user_roles):
+		frappe.throw("You don't have permission to create documents", frappe.PermissionError)
+
+
+def baseline_edit(doc, user, user_roles, env):
+	if "EDO Admin" not in user_roles:
+		if doc.status != "Новый" or (doc.signatures and len(doc.signatures) > 0):
+			frappe.throw("Документ уже подписан или обработан. Редактирование доступно только администратору.", frappe.PermissionError)
+		if not ("EDO Manager" in user_roles or "EDO Director" in user_roles):
+			frappe.throw("You don't have permission to edit documents", frappe.PermissionError)
+
+
+def baseline_can_edit(doc, user_roles):
+	if "EDO Admin" in user_roles:
+		return True
+	if doc and (doc.status != "Новый" or (doc.signatures and len(doc.signatures) > 0)):
+		return False
+	return "EDO Manager" in user_roles or "EDO Director" in user_roles
+
+
+def baseline_update_resolution(doc, user, user_roles, env):
+	# update_document only checked this for a Director/Admin on a document "На рассмотрении"
+	if "EDO Admin" not in user_roles:
+		if not doc.director_user or doc.director_user != user:
+			frappe.throw("Вы можете изменять только документы, назначенные вашей приёмной.", frappe.PermissionError)
+
+
+def _baseline_director_decision(verb):
+	def baseline(doc, user, user_roles, env):
+		if "EDO Director" not in user_roles and "EDO Admin" not in user_roles:
+			frappe.throw(f"Only Director can {verb} documents", frappe.PermissionError)
+		if doc.status != "На рассмотрении":
+			frappe.throw(
+				f"Document must be in 'На рассмотрении' status to be {verb}d (Reception must process it first)",
+				frappe.ValidationError
+			)
+		if "EDO Admin" not in user_roles:
+			if not doc.director_user or doc.director_user != user:
+				frappe.throw(f"You can only {verb} documents assigned to your reception office", frappe.PermissionError)
+	return baseline
+
+
+def baseline_approve_any(doc, user, user_roles, env):
+	if not baseline_can_director_approve(user_roles, env):
+		frappe.throw("Only Director can approve documents", frappe.PermissionError)
+
+
+def baseline_can_director_approve(user_roles, env):
+	offices, directed, granted = env
+	if "EDO Admin" in user_roles:
+		return True
+	if "EDO Director" in user_roles:
+		return bool(directed)
+	return False
+
+
+def baseline_sign(doc, user, user_roles, env):
+	if doc.status != "На исполнении":
+		frappe.throw("Document must be in 'На исполнении' status to be signed", frappe.ValidationError)
+	is_executor = doc.executor == user or any(co_exec.user == user for co_exec in doc.co_executors)
+	if not is_executor:
+		frappe.throw("You are not assigned as executor or co-executor for this document", frappe.PermissionError)
+	if any(sig.user == user for sig in doc.signatures):
+		frappe.throw("You have already signed this document", frappe.ValidationError)
+
+
+def baseline_reception_submit(doc, user, user_roles, env):
+	if "EDO Reception" not in user_roles:
+		frappe.throw("Only Reception can submit documents to director", frappe.PermissionError)
+
+
+def baseline_stamp(doc, user, user_roles, env):
+	if not any(role in user_roles for role in ["EDO Admin", "EDO Manager", "EDO Director"]):
+		frappe.throw("You don't have permission to apply stamps", frappe.PermissionError)
+
+
+def baseline_sign_pdf(doc, user, user_roles, env):
+	if not any(role in user_roles for role in ["EDO Admin", "EDO Manager", "EDO Director"]):
+		frappe.throw("You don't have permission to sign documents", frappe.PermissionError)
+
+
+def baseline_delete_comment(doc, user, user_roles, env):
+	if "EDO Admin" not in user_roles:
+		frappe.throw("Only administrators can delete comments", frappe.PermissionError)
+
+
+BASELINES = {
+	"access": baseline_access,
+	"read": baseline_read,
+	"create": baseline_create,
+	"edit": baseline_edit,
+	"update_resolution": baseline_update_resolution,
+	"approve": _baseline_director_decision("approve"),
+	"reject": _baseline_director_decision("reject"),
+	"approve_any": baseline_approve_any,
+	"sign": baseline_sign,
+	"reception_submit": baseline_reception_submit,
+	"stamp": baseline_stamp,
+	"sign_pdf": baseline_sign_pdf,
+	"delete_comment": baseline_delete_comment,
+}
+
+
+# Portal scope as the pre-refactor get_portal_documents filtered it, one frozen case per role:
+# (roles, reception offices the user works in, offices the user directs, visible(doc)).
+# A director of an office also saw its documents "На рассмотрении" (the second query merged in);
+# a reception user outside any office and a user without an EDO role got an empty list.
+REVIEW = "На рассмотрении"
+EXECUTION = ("На исполнении", "Выполнено")
+
+
+def _is_executor_of(doc):
+	return doc.executor == USER or any(co_exec.user == USER for co_exec in doc.co_executors)
+
+
+SCOPE_CASES = {
+	"EDO Admin": (["EDO Admin"], {OFFICE}, {OFFICE}, lambda doc: True),
+	"EDO Manager": (["EDO Manager"], set(), set(), lambda doc: True),
+	"director of an office": (
+		["EDO Director"], set(), {OFFICE},
+		lambda doc: doc.director_user == USER or (doc.reception_office == OFFICE and doc.status == REVIEW),
+	),
+	"director without an office": (["EDO Director"], set(), set(), lambda doc: doc.director_user == USER),
+	"reception with an office": (["EDO Reception"], {OFFICE}, set(), lambda doc: doc.reception_office == OFFICE),
+	"reception without offices": (["EDO Reception"], set(), set(), lambda doc: False),
+	"director and reception": (
+		["EDO Director", "EDO Reception"], {OFFICE}, {OFFICE},
+		lambda doc: doc.reception_office == OFFICE and (doc.director_user == USER or doc.status == REVIEW),
+	),
+	"executor": (["EDO Executor"], set(), set(), lambda doc: _is_executor_of(doc) and doc.status in EXECUTION),
+	"observer": (["EDO User", "EDO Observer"], set(), set(), lambda doc: _is_executor_of(doc) and doc.status in EXECUTION),
+	"website user": ([], set(), set(), lambda doc: False),
+}
+
+
+def outcome(func, *args):
+	"""None when func passes, (exception type, message) when it throws"""
+	try:
+		func(*args)
+	except (frappe.PermissionError, frappe.ValidationError) as e:
+		return type(e), str(e)
+	finally:
+		frappe.clear_messages()
+
+
+def make_context(roles, env):
+	offices, directed, granted = env
+	ctx = UserContext(USER, roles)
+	# Seed the lazily loaded office lookups instead of reading them from the database
+	ctx.__dict__["offices"] = offices
+	ctx.__dict__["directed_offices"] = directed
+	return ctx
+
+
+def access_index(granted):
+	return patch(
+		"edo.utils.policy.has_document_access",
+		side_effect=lambda user, document, reasons: bool(set(reasons) & granted),
+	)
+
+
+class TestPolicyParity(FrappeTestCase):
+	def test_every_rule_has_a_baseline(self):
+		self.assertEqual(set(RULES), set(BASELINES))
+
+	def test_check_matches_baseline(self):
+		for action, baseline in BASELINES.items():
+			environments = ENVIRONMENTS if action in ENVIRONMENT_RULES else ENVIRONMENTS[:1]
+			for role_set, env in product(ROLE_SETS, environments):
+				roles = ROLE_SETS[role_set]
+				ctx = make_context(roles, env)
+				with access_index(env[2]):
+					for doc in DOCUMENTS:
+						if action == "update_resolution" and not (
+							("EDO Director" in roles or "EDO Admin" in roles) and doc.status == "На рассмотрении"
+						):
+							continue
+						expected = outcome(baseline, doc, USER, roles, env)
+						actual = outcome(check, ctx, action, doc)
+						self.assertEqual(
+							actual, expected,
+							f"{action} for {role_set} {env} on {doc}",
+						)
+						self.assertEqual(can(ctx, action, doc), expected is None, f"can {action} for {role_set}")
+
+	def test_capabilities_match_baseline(self):
+		"""can() as used for the portal capabilities, against the old _can_* helpers"""
+		for role_set, env in product(ROLE_SETS, ENVIRONMENTS):
+			roles = ROLE_SETS[role_set]
+			ctx = make_context(roles, env)
+			self.assertEqual(can(ctx, "approve_any"), baseline_can_director_approve(roles, env), role_set)
+			self.assertEqual(can(ctx, "reception_submit"), "EDO Reception" in roles, role_set)
+			self.assertEqual(can(ctx, "edit"), baseline_can_edit(None, roles), role_set)
+			for doc in DOCUMENTS:
+				self.assertEqual(can(ctx, "edit", doc), baseline_can_edit(doc, roles), role_set)
+
+	def test_guest_is_never_allowed(self):
+		ctx = UserContext("Guest", [])
+		for action in RULES:
+			self.assertFalse(can(ctx, action, DOCUMENTS[0]))
+			self.assertEqual(
+				outcome(check, ctx, action, DOCUMENTS[0]),
+				(frappe.PermissionError, "Not authorized"),
+			)
+
+	def test_scope_filters_match_frozen_scope(self):
+		"""scope_filters over the access rows of each document selects what the old filters selected"""
+		edo_document = frappe.qb.DocType("EDO Document")
+		for case, (roles, offices, directed, expected) in SCOPE_CASES.items():
+			ctx = make_context(roles, (frozenset(offices), frozenset(directed), frozenset()))
+			grants = []
+
+			def record(user, reasons):
+				grants.append((user, reasons))
+				return accessible_documents_query(user, reasons)
+
+			with patch("edo.utils.policy.accessible_documents_query", side_effect=record):
+				conditions = scope_filters(ctx, edo_document)
+			self.assertEqual(len(conditions), len(grants), case)
+
+			for doc in DOCUMENTS:
+				rows = get_access_rows(
+					doc,
+					office_users=[USER] if doc.reception_office in offices else [OTHER_USER],
+					office_director=USER if doc.reception_office in directed else OTHER_USER,
+				)
+				visible = can(ctx, "access") and all(
+					any(
+						(user, reason) in rows and (not statuses or doc.status in statuses)
+						for reason, statuses in reasons.items()
+					)
+					for user, reasons in grants
+				)
+				self.assertEqual(visible, bool(expected(doc)), f"{case} on {doc}")
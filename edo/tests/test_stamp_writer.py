@@ -0,0 +1,55 @@
+# Copyright (c) 2026, Publish and contributors
+# For license information, please see license.txt
+"""
+new_stamp_writer: an incremental save appends to the original file, a rewrite doesn't have to.
+"""
+import io
+import unittest
+
+import pypdf
+from frappe.tests.utils import FrappeTestCase
+from pypdf import PdfReader, PdfWriter
+from reportlab.pdfgen import canvas
+
+from edo.edo.doctype.edo_document.edo_document import new_stamp_writer
+
+
+def make_pdf(pages=3):
+	writer = PdfWriter()
+	for _ in range(pages):
+		writer.add_blank_page(width=595, height=842)
+	output = io.BytesIO()
+	writer.write(output)
+	return output.getvalue()
+
+
+def make_overlay():
+	packet = io.BytesIO()
+	c = canvas.Canvas(packet, pagesize=(595, 842))
+	c.rect(400, 50, 150, 80)
+	c.save()
+	return PdfReader(io.BytesIO(packet.getvalue())).pages[0]
+
+
+def stamp(content, incremental):
+	writer = new_stamp_writer(PdfReader(io.BytesIO(content)), incremental=incremental)
+	writer.pages[1].merge_page(make_overlay())
+	output = io.BytesIO()
+	writer.write(output)
+	return output.getvalue()
+
+
+class TestStampWriter(FrappeTestCase):
+	@unittest.skipIf(int(pypdf.__version__.split(".")[0]) < 5, "incremental save needs pypdf >= 5")
+	def test_incremental_output_starts_with_original(self):
+		content = make_pdf()
+		output = stamp(content, incremental=True)
+
+		self.assertTrue(output.startswith(content))
+		self.assertGreater(len(output), len(content))
+		self.assertEqual(len(PdfReader(io.BytesIO(output)).pages), 3)
+
+	def test_rewrite_keeps_pages(self):
+		output = stamp(make_pdf(), incremental=False)
+
+		self.assertEqual(len(PdfReader(io.BytesIO(output)).pages), 3)
@@ -0,0 +1,31 @@
+# Copyright (c) 2026, Publish and contributors
+# For license information, please see license.txt
+"""
+wrap_text breaks lines exactly like the textbbox-per-prefix implementation it replaced
+(edo.utils.benchmarks._reference_wrap_text) for every text, font size and width of the corpus.
+"""
+from frappe.tests.utils import FrappeTestCase
+from PIL import Image, ImageDraw
+
+from edo.edo.doctype.edo_document.edo_document import wrap_text
+from edo.utils.benchmarks import (
+	WRAP_TEXT_CORPUS,
+	WRAP_TEXT_SIZES,
+	WRAP_TEXT_WIDTHS,
+	_reference_wrap_text,
+)
+from edo.utils.fonts import get_font
+
+
+class TestWrapText(FrappeTestCase):
+	def test_matches_reference(self):
+		draw = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+		for size in WRAP_TEXT_SIZES:
+			font = get_font(size)
+			for text in WRAP_TEXT_CORPUS:
+				for width in WRAP_TEXT_WIDTHS:
+					with self.subTest(text=text, size=size, width=width):
+						self.assertEqual(
+							wrap_text(text, font, width, draw),
+							_reference_wrap_text(text, font, width, draw),
+						)
@@ -0,0 +1,174 @@
+"""
+Micro-benchmarks of the stamping hot paths.
+
+	bench --site <site> execute edo.utils.benchmarks.benchmark_wrap_text
+	bench --site <site> execute edo.utils.benchmarks.benchmark_stamp_save --kwargs "{'file_url': '/files/scan.pdf', 'stamp_name': 'STAMP-0001'}"
+	bench --site <site> execute edo.utils.benchmarks.benchmark_stamp_render --kwargs "{'pages': 300, 'workers': 4}"
+
+Benchmarks only time the code. That the optimized code gives the same result as the reference
+implementation is checked by the tests (edo/tests/test_wrap_text.py, test_stamp_writer.py).
+"""
+import time
+
+WRAP_TEXT_CORPUS = (
+	"",
+	"Исполнить",
+	"Рассмотреть и подготовить ответ заявителю в установленный законодательством срок",
+	"Прошу рассмотреть обращение гражданина по вопросу предоставления земельного участка "
+	"и подготовить проект ответа с учётом позиции юридического управления до 15.03.2025",
+	"Электроэнергетическихсистемавтоматизированногоуправленияпредприятием и прочее",
+	"№ 01-02/1234-вх от 12.01.2025 г.   Контроль: Иванов И.И., Петров П.П., Сидоров С.С.",
+	"Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt",
+	"Тошкент шаҳар ҳокимлигининг қарорига мувофиқ ижро этилсин ва натижаси ҳақида маълумот берилсин",
+	"a " * 40,
+	"W" * 120,
+)
+
+WRAP_TEXT_SIZES = (8, 10, 12, 14, 18, 24)
+WRAP_TEXT_WIDTHS = (1, 20, 60, 120, 200, 350)
+
+
+def benchmark_wrap_text(rounds=20):
+	"""Timings of wrap_text and of the textbbox-per-prefix reference on the same cases"""
+	from PIL import Image, ImageDraw
+
+	from edo.edo.doctype.edo_document.edo_document import wrap_text
+	from edo.utils.fonts import get_font, get_font_path
+
+	draw = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+	cases = [
+		(text, get_font(size), width)
+		for text in WRAP_TEXT_CORPUS
+		for size in WRAP_TEXT_SIZES
+		for width in WRAP_TEXT_WIDTHS
+	]
+
+	return {
+		"font_path": get_font_path(),
+		"cases": len(cases),
+		"reference_ms": _time_ms(_reference_wrap_text, cases, draw, rounds),
+		"wrap_text_ms": _time_ms(wrap_text, cases, draw, rounds),
+	}
+
+
+def benchmark_stamp_save(file_url, stamp_name, page_number=0, rounds=3):
+	"""
+	Stamp one page of a PDF with a full rewrite and with an incremental save: time and output
+	size of each (nothing is saved)
+	"""
+	import io
+
+	from pypdf import PdfReader
+
+	from edo.edo.doctype.edo_document.edo_document import (
+		_read_file_with_hash,
+		apply_stamps_to_pages,
+		get_file_path,
+		new_stamp_writer,
+	)
+
+	content, content_hash = _read_file_with_hash(get_file_path(file_url))
+	stamps = [{"stamp_name": stamp_name, "page_number": page_number}]
+
+	def stamp(incremental):
+		writer = new_stamp_writer(PdfReader(io.BytesIO(content)), incremental=incremental)
+		apply_stamps_to_pages([(writer.pages[page_number], stamps)])
+		output = io.BytesIO()
+		writer.write(output)
+		return output.getvalue()
+
+	result = {"source_bytes": len(content), "source_hash": content_hash}
+	for mode, incremental in (("rewrite", False), ("incremental", True)):
+		start = time.perf_counter()
+		for _ in range(rounds):
+			output = stamp(incremental)
+		result[f"{mode}_ms"] = round((time.perf_counter() - start) * 1000 / rounds, 3)
+		result[f"{mode}_bytes"] = len(output)
+	return result
+
+
+def benchmark_stamp_render(pages=300, workers=4, rounds=3):
+	"""
+	Overlay of a seal with two text lines on every page, drawn in-process and by a pool of workers
+	(pool start included): where the pooled time drops below the serial one is the page count to
+	set as edo_stamp_parallel_min_pages
+	"""
+	from PIL import Image
+
+	from edo.utils.fonts import get_font_path
+	from edo.utils.stamp_overlay import render_overlay, render_overlays_in_pool
+
+	pages, workers = int(pages), int(workers)
+	images = {"seal": Image.new("RGBA", (600, 600), (30, 60, 160, 160))}
+	ops = [
+		("image", "seal", 420, 40, 120, 120),
+		("text", 420, 30, 8, (30, 60, 160), "Вх. № 01-02/00123"),
+		("text", 420, 20, 8, (30, 60, 160), "от 12.01.2025"),
+	]
+	plan = [(595.0, 842.0, ops)] * pages
+	font_path = get_font_path()
+
+	result = {"pages": pages, "workers": workers}
+	for mode, render in (
+		("serial", lambda: [render_overlay(plan, images, font_path)]),
+		("pooled", lambda: render_overlays_in_pool(plan, images, font_path, workers)),
+	):
+		start = time.perf_counter()
+		for _ in range(int(rounds)):
+			overlays = render()
+		result[f"{mode}_ms"] = round((time.perf_counter() - start) * 1000 / int(rounds), 3)
+		result[f"{mode}_bytes"] = sum(len(overlay) for overlay in overlays)
+	return result
+
+
+def _time_ms(wrap, cases, draw, rounds):
+	start = time.perf_counter()
+	for _ in range(rounds):
+		for text, font, width in cases:
+			wrap(text, font, width, draw)
+	return round((time.perf_counter() - start) * 1000 / rounds, 3)
+
+
+def _reference_wrap_text(text, font, max_width, draw):
+	"""wrap_text as it was: one textbbox per word, per candidate line and per word prefix"""
+	def width(value):
+		bbox = draw.textbbox((0, 0), value, font=font)
+		return bbox[2] - bbox[0]
+
+	def wrap_long_word(word):
+		result = []
+		current = ""
+		for char in word:
+			test = current + char
+			if width(test) <= max_width:
+				current = test
+			else:
+				if current:
+					result.append(current)
+				current = char
+		if current:
+			result.append(current)
+		return result if result else [word]
+
+	lines = []
+	current_line = []
+	for word in text.split():
+		if width(word) > max_width:
+			if current_line:
+				lines.append(' '.join(current_line))
+				current_line = []
+			word_parts = wrap_long_word(word)
+			lines.extend(word_parts[:-1])
+			if word_parts:
+				current_line = [word_parts[-1]]
+		elif width(' '.join(current_line + [word])) <= max_width:
+			current_line.append(word)
+		elif current_line:
+			lines.append(' '.join(current_line))
+			current_line = [word]
+		else:
+			current_line.append(word)
+
+	if current_line:
+		lines.append(' '.join(current_line))
+	return lines if lines else [text]
@@ -0,0 +1,48 @@
+"""
+Conditional GET for whitelisted endpoints.
+
+The endpoint passes a cheap version of its data (usually one aggregate query) and a builder
+of the full payload, both as callables:
+
+	return conditional_response(get_things, lambda: [max_modified, count], build_payload)
+
+A GET whose If-None-Match matches gets an empty 304; otherwise the payload is built and sent
+as the usual {"message": ...} JSON with an ETag. Browsers revalidate such responses on their
+own, so the portal needs no changes to benefit.
+"""
+import hashlib
+
+import frappe
+
+
+def make_etag(parts):
+	"""ETag of the session user plus a list of JSON-serializable parts"""
+	payload = frappe.as_json([frappe.session.user, *parts], indent=None)
+	return hashlib.md5(payload.encode()).hexdigest()
+
+
+def conditional_response(endpoint, version, build):
+	"""
+	304 / JSON response when `endpoint` was called by an HTTP GET, plain build() result otherwise
+	(POST calls, background jobs, calls from other Python code). version() returns the list of
+	parts the ETag is computed from.
+	"""
+	request = getattr(frappe.local, "request", None)
+	if not request or request.method != "GET" or frappe.form_dict.get("cmd") != _method_path(endpoint):
+		return build()
+
+	from werkzeug.wrappers import Response
+
+	etag = make_etag(version())
+	if request.if_none_match.contains_weak(etag):
+		response = Response(status=304)
+	else:
+		response = Response(frappe.as_json({"message": build()}, indent=None), mimetype="application/json")
+	response.set_etag(etag)
+	# Cache, but revalidate on every use: data can change at any time
+	response.headers["Cache-Control"] = "private, no-cache"
+	return response
+
+
+def _method_path(endpoint):
+	return f"{endpoint.__module__}.{endpoint.__name__}"
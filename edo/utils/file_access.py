@@ -0,0 +1,112 @@
+"""
+Signed, user-bound URLs for EDO Document files.
+
+get_document hands out a URL of stream_main_document signed with the site's encryption key.
+The URL carries the document, the user it was issued to and an expiry, so the streaming
+endpoint only verifies the signature instead of repeating the role checks of get_document
+on every (Range) request - and private files no longer have to be made public.
+"""
+import hashlib
+import hmac
+import os
+from urllib.parse import quote, urlencode, urlparse
+
+import frappe
+from frappe.utils import cint, now_datetime
+from frappe.utils.password import get_encryption_key
+
+STREAM_METHOD = "edo.edo.doctype.edo_document.edo_document.stream_main_document"
+
+# Seconds a signed URL stays valid (site config: edo_file_url_ttl)
+DEFAULT_URL_TTL = 60 * 60
+
+
+def get_main_document_url(document, file_url, user=None):
+	"""Signed streaming URL for a document's main file"""
+	user = user or frappe.session.user
+	expires = get_url_expiry()
+	params = {
+		"name": document,
+		"expires": expires,
+		"signature": _sign(document, user, expires),
+		# Not used by the endpoint: keeps the file name (and extension) at the end of the URL
+		"filename": os.path.basename(urlparse(file_url).path),
+	}
+	return frappe.utils.get_url(f"/api/method/{STREAM_METHOD}?{urlencode(params)}", full_address=True)
+
+
+def get_url_expiry():
+	"""
+	Expiry of URLs issued now: rounded to the TTL, so the URL (and get_document's ETag) stays
+	the same for a while. A URL is valid for at least one TTL and at most two.
+	"""
+	ttl = cint(frappe.conf.get("edo_file_url_ttl") or DEFAULT_URL_TTL)
+	return (int(now_datetime().timestamp()) // ttl + 2) * ttl
+
+
+def is_main_document_url(url):
+	"""True for URLs produced by get_main_document_url"""
+	return bool(url) and f"/api/method/{STREAM_METHOD}" in url
+
+
+def verify_signature(document, user, expires, signature):
+	"""Raise PermissionError unless the signature was issued for this document and user and has not expired"""
+	if not signature or cint(expires) < now_datetime().timestamp():
+		frappe.throw("Link has expired, reload the document", frappe.PermissionError)
+	if not hmac.compare_digest(_sign(document, user, cint(expires)), signature):
+		frappe.throw("Invalid link", frappe.PermissionError)
+
+
+def resolve_file_path(file_url):
+	"""
+	Site-relative and absolute path of a /files or /private/files URL, without reading
+	the File table. Returns (None, None) for anything outside the site's files folders.
+	"""
+	path = urlparse(file_url or "").path.lstrip("/")
+	if path.startswith("private/files/"):
+		relative_path = path
+		files_folder = ("private", "files")
+	elif path.startswith("files/"):
+		relative_path = "public/" + path
+		files_folder = ("public", "files")
+	else:
+		return None, None
+
+	full_path = os.path.realpath(frappe.get_site_path(relative_path))
+	if not full_path.startswith(os.path.realpath(frappe.get_site_path(*files_folder)) + os.sep):
+		return None, None
+	return relative_path, full_path
+
+
+def send_file(relative_path, full_path, mimetype, filename):
+	"""
+	Response for a site file: X-Accel-Redirect when served behind bench's nginx
+	(it sets X-Use-X-Accel-Redirect), otherwise streamed with Range / conditional GET support.
+	"""
+	from werkzeug.exceptions import NotFound
+	from werkzeug.wrappers import Response
+	from werkzeug.wsgi import wrap_file
+
+	request = frappe.local.request
+	if request.headers.get("X-Use-X-Accel-Redirect"):
+		response = Response(mimetype=mimetype)
+		response.headers["X-Accel-Redirect"] = quote(frappe.utils.encode("/protected/" + relative_path))
+	else:
+		try:
+			f = open(full_path, "rb")
+		except OSError:
+			raise NotFound
+		stat = os.fstat(f.fileno())
+		response = Response(wrap_file(request.environ, f), mimetype=mimetype, direct_passthrough=True)
+		response.last_modified = int(stat.st_mtime)
+		response.set_etag(f"{stat.st_mtime}-{stat.st_size}")
+		response.make_conditional(request, accept_ranges=True, complete_length=stat.st_size)
+
+	response.headers["Content-Disposition"] = f"inline; filename*=UTF-8''{quote(filename)}"
+	response.headers["Cache-Control"] = "private, max-age=3600"
+	return response
+
+
+def _sign(document, user, expires):
+	message = f"{document}\n{user}\n{expires}".encode()
+	return hmac.new(get_encryption_key().encode(), message, hashlib.sha256).hexdigest()
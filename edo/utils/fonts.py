@@ -0,0 +1,126 @@
+"""
+Fonts for stamp text rendering.
+
+The font file is resolved once per worker process: the `edo_stamp_font` site config setting
+(a .ttf path) if set, otherwise the first installed font of FONT_PATHS. ImageFont objects are
+kept in an LRU keyed by (path, size), so rendering a stamp doesn't touch the filesystem.
+The same file is registered with reportlab for the vector text layer of stamps (get_pdf_font_name),
+which embeds only the glyphs used. Fonts reportlab can't register (TrueType collections such as
+macOS Helvetica.ttc) are left to PIL: stamps then get their texts drawn into the image.
+
+Check that the stamping path is served from the cache:
+	bench --site <site> execute edo.utils.fonts.get_font_cache_info
+"""
+import hashlib
+import os
+from functools import lru_cache
+
+import frappe
+
+FONT_PATHS = (
+	"/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+	"/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+	"/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
+	"/usr/share/fonts/truetype/freefont/FreeSans.ttf",
+	"/usr/share/fonts/TTF/DejaVuSans.ttf",  # Arch/Manjaro
+	"/usr/share/fonts/dejavu/DejaVuSans.ttf",  # Some distros
+	"/System/Library/Fonts/Helvetica.ttc",  # macOS
+)
+
+# reportlab's built-in font, only for text drawn without a registered font (no Cyrillic glyphs)
+PDF_FALLBACK_FONT = "Helvetica"
+
+# edo_stamp_font setting -> resolved path (None: no usable font, PIL's default is used)
+_resolved_paths = {}
+# font path -> reportlab font name (None: not registrable)
+_pdf_fonts = {}
+_discovery_runs = 0
+
+
+def get_font_path():
+	"""Font file used for stamp text, resolved on first use in this process"""
+	configured = frappe.conf.get("edo_stamp_font") if getattr(frappe.local, "conf", None) else None
+	if configured not in _resolved_paths:
+		_resolved_paths[configured] = _discover_font(configured)
+	return _resolved_paths[configured]
+
+
+def get_font(size):
+	"""ImageFont of the stamp font in the given size"""
+	return _load_font(get_font_path(), int(size))
+
+
+def get_pdf_font_name(path):
+	"""
+	Name of a get_font_path() result registered with reportlab (subset-embedded into the PDF),
+	registered on first use in this process; None if there is no font or reportlab can't load it
+	"""
+	if path not in _pdf_fonts:
+		_pdf_fonts[path] = _register_pdf_font(path)
+	return _pdf_fonts[path]
+
+
+def get_font_cache_info():
+	"""Resolved font, discovery runs and LRU stats (hits grow, discovery runs stay at 1 per setting)"""
+	info = _load_font.cache_info()
+	return {
+		"font_path": get_font_path(),
+		"discovery_runs": _discovery_runs,
+		"hits": info.hits,
+		"misses": info.misses,
+		"size": info.currsize,
+		"max_size": info.maxsize,
+	}
+
+
+def clear_font_cache():
+	global _discovery_runs
+	_resolved_paths.clear()
+	_pdf_fonts.clear()
+	_discovery_runs = 0
+	_load_font.cache_clear()
+
+
+@lru_cache(maxsize=64)
+def _load_font(path, size):
+	from PIL import ImageFont
+
+	if path:
+		try:
+			return ImageFont.truetype(path, size)
+		except Exception:
+			pass
+	# Fallback to default font (small, but works)
+	return ImageFont.load_default()
+
+
+def _register_pdf_font(path):
+	from reportlab.pdfbase import pdfmetrics
+	from reportlab.pdfbase.ttfonts import TTFont
+
+	if not path or path.lower().endswith(".ttc"):
+		return None
+	name = "EDOStamp-" + hashlib.md5(path.encode()).hexdigest()[:8]
+	try:
+		pdfmetrics.registerFont(TTFont(name, path))
+	except Exception as e:
+		frappe.log_error(f"Font {path} can't be embedded into PDF: {str(e)}", "stamp_font_error")
+		return None
+	return name
+
+
+def _discover_font(configured=None):
+	from PIL import ImageFont
+
+	global _discovery_runs
+	_discovery_runs += 1
+
+	for path in ([configured] if configured else []) + list(FONT_PATHS):
+		if not os.path.exists(path):
+			continue
+		try:
+			ImageFont.truetype(path, 12)
+			return path
+		except Exception:
+			continue
+	return None
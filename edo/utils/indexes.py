@@ -0,0 +1,86 @@
+"""
+Database indexes for the EDO workflow queries.
+
+Indexes are created by the add_edo_workflow_indexes patch and, for fresh installs
+(where patches are only marked as done), from the doctypes' on_doctype_update.
+
+Check the portal queries against them:
+	bench --site <site> execute edo.utils.indexes.verify_portal_queries
+"""
+import frappe
+
+# Composite indexes matched to the role-scoped queries
+WORKFLOW_INDEXES = {
+	"EDO Document": [
+		# Status filter + default ordering of the portal list
+		["status", "creation"],
+		# Reception office listing and director "office documents on review"
+		["reception_office", "status", "creation"],
+		# Director's own documents
+		["director_user", "creation"],
+		# Executor and co-executor documents are selected through EDO Document Access;
+		# "modified" has frappe's own index
+	],
+	"EDO Reception Office User": [
+		["user", "parenttype", "parent"],
+	],
+}
+
+
+def add_workflow_indexes(doctype=None):
+	"""Create WORKFLOW_INDEXES (for one doctype or all); existing indexes are skipped"""
+	for index_doctype, indexes in WORKFLOW_INDEXES.items():
+		if doctype and index_doctype != doctype:
+			continue
+		if not frappe.db.table_exists(index_doctype):
+			continue
+		for fields in indexes:
+			frappe.db.add_index(index_doctype, fields)
+
+
+def verify_portal_queries(user=None):
+	"""
+	Run EXPLAIN on each portal list query (per role, with and without filters)
+	and report tables that are read with a full scan.
+	"""
+	from edo.edo.doctype.edo_document.edo_document import _portal_documents_query
+	from edo.utils.policy import UserContext
+
+	scenarios = [
+		("admin", ["EDO Admin"], {}),
+		("manager", ["EDO Manager"], {}),
+		("director", ["EDO Director"], {}),
+		("reception", ["EDO Reception"], {}),
+		("executor", ["EDO Executor"], {}),
+		("director, status filter", ["EDO Director"], {"status": "На рассмотрении"}),
+		("reception, search", ["EDO Reception"], {"search": "письмо"}),
+		("executor, page after cursor", ["EDO Executor"], {
+			"after": ["2026-01-01 00:00:00", "EDO-0001"], "limit": 51,
+		}),
+		("admin, sort by modified", ["EDO Admin"], {"sort_by": "modified", "limit": 51}),
+	]
+
+	report = []
+	full_scans = []
+	for label, roles, kwargs in scenarios:
+		query = _portal_documents_query(UserContext(user or _sample_user(roles[0]), roles), **kwargs)
+		plan = frappe.db.sql(f"EXPLAIN {query}", as_dict=True)
+		scans = [
+			row for row in plan
+			if row.get("type") == "ALL" and not (row.get("table") or "").startswith("<")
+		]
+		report.append({"scenario": label, "plan": plan, "full_scans": [row.get("table") for row in scans]})
+		full_scans.extend(f"{label}: {row.get('table')} (~{row.get('rows')} rows)" for row in scans)
+
+	for item in report:
+		status = "FULL SCAN: " + ", ".join(item["full_scans"]) if item["full_scans"] else "ok"
+		print(f"{item['scenario']}: {status}")
+		for row in item["plan"]:
+			print(f"    {row.get('table')}: type={row.get('type')} key={row.get('key')} rows={row.get('rows')} {row.get('Extra') or ''}")
+
+	return {"queries": report, "full_scans": full_scans}
+
+
+def _sample_user(role):
+	"""Any user with the role, so EXPLAIN sees realistic selectivity"""
+	return frappe.db.get_value("Has Role", {"role": role, "parenttype": "User"}, "parent") or "Administrator"
@@ -0,0 +1,88 @@
+"""
+Batched resolution of Link field values.
+
+Collect every (doctype, name) a response needs, then fetch each doctype with one
+`name IN (...)` query instead of one frappe.db.get_value per link. Reference doctypes
+are served from edo.utils.reference_cache without a query:
+
+	resolver = LinkResolver()
+	resolver.add("User", doc.executor, ["full_name", "user_image"])
+	resolver.add("EDO Priority", doc.priority, ["priority_name"])
+	executor = resolver.get_row("User", doc.executor)
+"""
+from collections import defaultdict
+
+import frappe
+
+from edo.utils.reference_cache import REFERENCE_DOCTYPES, get_reference_records
+
+# Title field of each EDO reference doctype, as shown in the portal
+REFERENCE_TITLE_FIELDS = {
+	"EDO Correspondent": "correspondent_name",
+	"EDO Document Type": "document_type_name",
+	"EDO Priority": "priority_name",
+	"EDO Classification": "classification_name",
+	"EDO Delivery Method": "delivery_method_name",
+	"EDO Resolution": "resolution_name",
+	"EDO Reception Office": "reception_office_name",
+}
+
+
+class LinkResolver:
+	def __init__(self):
+		self._pending = defaultdict(set)
+		self._fields = defaultdict(set)
+		self._rows = {}
+
+	def add(self, doctype, name, fields):
+		"""Request fields of a linked record; empty names are ignored"""
+		if not name:
+			return
+		new_fields = set(fields) - self._fields[doctype]
+		if new_fields:
+			# Already loaded rows of this doctype lack the new fields - load them again
+			self._fields[doctype] |= new_fields
+			self._pending[doctype] |= {key[1] for key in self._rows if key[0] == doctype}
+		if (doctype, name) not in self._rows or new_fields:
+			self._pending[doctype].add(name)
+
+	def resolve(self):
+		"""Fetch everything requested so far: one query per doctype, none for cached reference data"""
+		for doctype, names in self._pending.items():
+			if not names:
+				continue
+			cached_fields = REFERENCE_DOCTYPES.get(doctype)
+			if cached_fields and self._fields[doctype] <= {"name", *cached_fields}:
+				records = get_reference_records(doctype)
+				for name in names:
+					self._rows[(doctype, name)] = records.get(name)
+				continue
+			rows = frappe.get_all(
+				doctype,
+				filters={"name": ["in", list(names)]},
+				fields=["name", *sorted(self._fields[doctype])],
+			)
+			for name in names:
+				self._rows[(doctype, name)] = None
+			for row in rows:
+				self._rows[(doctype, row.name)] = row
+		self._pending.clear()
+
+	def get_row(self, doctype, name):
+		"""Resolved record as a dict, or None if it doesn't exist"""
+		if not name:
+			return None
+		if self._pending.get(doctype):
+			self.resolve()
+		return self._rows.get((doctype, name))
+
+	def get_value(self, doctype, name, field, default=None):
+		row = self.get_row(doctype, name)
+		if row is None:
+			return default
+		return row.get(field) if row.get(field) is not None else default
+
+	def get_title(self, doctype, name):
+		"""Title of a linked record (see REFERENCE_TITLE_FIELDS, full_name for users), falling back to name"""
+		field = "full_name" if doctype == "User" else REFERENCE_TITLE_FIELDS.get(doctype) or "name"
+		return self.get_value(doctype, name, field) or name
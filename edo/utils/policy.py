@@ -0,0 +1,284 @@
+"""
+Permission policy of the EDO portal.
+
+Every role rule lives here. Endpoints take the user context (built once per request) and ask:
+
+	ctx = get_user_context()
+	check(ctx, "read", doc)                      # throws with the rule's message
+	if can(ctx, "sign", doc): ...
+	conditions = scope_filters(ctx, edo_document)  # SQL conditions for list queries
+
+A rule returns None when the action is allowed, or (message, exception) when it isn't, so
+can() and check() share one definition and endpoints keep their error messages.
+"""
+from functools import cached_property
+
+import frappe
+from frappe.utils.caching import request_cache
+
+from edo.edo.doctype.edo_document_access.edo_document_access import (
+	ACCESS_CO_EXECUTOR,
+	ACCESS_DIRECTOR,
+	ACCESS_EXECUTOR,
+	ACCESS_OFFICE_DIRECTOR,
+	ACCESS_RECEPTION,
+	accessible_documents_query,
+	has_document_access,
+)
+from edo.utils.reference_cache import get_reference_records
+
+EDO_ROLES = ("EDO User", "EDO Admin", "EDO Observer", "EDO Executor", "EDO Manager", "EDO Director", "EDO Reception")
+
+# Statuses in which executors and co-executors can see a document
+EXECUTION_STATUSES = ("На исполнении", "Выполнено")
+
+
+class UserContext:
+	"""Roles and reception offices of a user, read once per request"""
+
+	def __init__(self, user, roles):
+		self.user = user
+		self.roles = tuple(roles)
+
+	@property
+	def is_guest(self):
+		return not self.user or self.user == "Guest"
+
+	@property
+	def has_edo_role(self):
+		return any(role in self.roles for role in EDO_ROLES)
+
+	@property
+	def is_admin(self):
+		return "EDO Admin" in self.roles
+
+	@property
+	def is_manager(self):
+		return "EDO Manager" in self.roles
+
+	@property
+	def is_director(self):
+		return "EDO Director" in self.roles
+
+	@property
+	def is_reception(self):
+		return "EDO Reception" in self.roles
+
+	@property
+	def is_executor_only(self):
+		"""No role that sees documents beyond the user's own executor assignments"""
+		return not (self.is_manager or self.is_director or self.is_admin or self.is_reception)
+
+	@cached_property
+	def offices(self):
+		"""Reception offices the user works in"""
+		return frozenset(frappe.get_all(
+			"EDO Reception Office User",
+			filters={"user": self.user, "parenttype": "EDO Reception Office"},
+			pluck="parent"
+		))
+
+	@cached_property
+	def directed_offices(self):
+		"""Reception offices the user is director of"""
+		return frozenset(
+			name for name, office in get_reference_records("EDO Reception Office").items()
+			if office.director == self.user
+		)
+
+
+def get_user_context(user=None):
+	"""Policy context of a user (the session user by default), memoized for the request"""
+	# Resolve the session user before the cache lookup: frappe.set_user() may change it mid-request
+	return _user_context(user or frappe.session.user)
+
+
+@request_cache
+def _user_context(user):
+	roles = frappe.get_roles(user) if user and user != "Guest" else []
+	return UserContext(user, roles)
+
+
+def can(ctx, action, doc=None):
+	"""True if the user may perform the action (on the document, for document actions)"""
+	return not ctx.is_guest and RULES[action](ctx, doc) is None
+
+
+def check(ctx, action, doc=None):
+	"""Throw the rule's error unless the user may perform the action"""
+	if ctx.is_guest:
+		frappe.throw("Not authorized", frappe.PermissionError)
+	denial = RULES[action](ctx, doc)
+	if denial:
+		message, exc = denial
+		frappe.throw(message, exc)
+
+
+def scope_filters(ctx, edo_document):
+	"""
+	SQL conditions (frappe.qb) selecting the EDO Documents visible to the user in the portal:
+	- Manager and Admin see ALL documents
+	- Directors see documents assigned to them (director_user = user)
+	  OR documents of their reception office in status "На рассмотрении"
+	- Reception users see only documents of their reception office
+	- Executors see only documents where they are executor or co-executor
+	  AND only in status "На исполнении" or "Выполнено" (after director approval)
+
+	Visibility comes from the EDO Document Access index; each role adds one indexed lookup.
+	"""
+	conditions = []
+
+	if ctx.is_director and not ctx.is_admin:
+		conditions.append(edo_document.name.isin(accessible_documents_query(ctx.user, {
+			ACCESS_DIRECTOR: None,
+			ACCESS_OFFICE_DIRECTOR: ["На рассмотрении"],
+		})))
+
+	if ctx.is_reception and not ctx.is_admin:
+		conditions.append(edo_document.name.isin(accessible_documents_query(ctx.user, {
+			ACCESS_RECEPTION: None,
+		})))
+
+	if ctx.is_executor_only:
+		conditions.append(edo_document.name.isin(accessible_documents_query(ctx.user, {
+			ACCESS_EXECUTOR: EXECUTION_STATUSES,
+			ACCESS_CO_EXECUTOR: EXECUTION_STATUSES,
+		})))
+
+	return conditions
+
+
+def _deny(message, exc=frappe.PermissionError):
+	return message, exc
+
+
+def _is_executor(ctx, doc):
+	return doc.executor == ctx.user or any(co_exec.user == ctx.user for co_exec in doc.co_executors or [])
+
+
+def _rule_access(ctx, doc):
+	"""Use the portal at all"""
+	if not ctx.has_edo_role:
+		return _deny("No permission to view document")
+
+
+def _rule_read(ctx, doc):
+	"""Open a document"""
+	if not ctx.has_edo_role:
+		return _deny("No permission to view documents")
+
+	# Directors can see documents assigned to them OR documents in their reception office that are ready for review
+	if ctx.is_director and not ctx.is_admin:
+		if doc.director_user and doc.director_user != ctx.user:
+			return _deny("No permission to view this document. It is assigned to a different director.")
+		if not doc.director_user:
+			if not doc.reception_office:
+				return _deny("No permission to view this document. It is not assigned to any reception office.")
+			if not has_document_access(ctx.user, doc.name, [ACCESS_OFFICE_DIRECTOR]):
+				return _deny("No permission to view this document. It belongs to a different reception office.")
+
+	# Reception users can only see documents of their reception office
+	if ctx.is_reception and not ctx.is_admin:
+		if not has_document_access(ctx.user, doc.name, [ACCESS_RECEPTION]):
+			if not ctx.offices:
+				return _deny("You are not assigned to any reception office")
+			return _deny("No permission to view this document. It belongs to a different reception office.")
+
+	# Executors can only see documents where they are executor/co-executor, in execution status
+	if ctx.is_executor_only:
+		if not _is_executor(ctx, doc):
+			return _deny("No permission to view this document")
+		if doc.status not in EXECUTION_STATUSES:
+			return _deny("Document is not available for execution yet. It must be approved by director first.")
+
+
+def _rule_create(ctx, doc):
+	if not (ctx.is_admin or ctx.is_manager):
+		return _deny("You don't have permission to create documents")
+
+
+def _rule_edit(ctx, doc):
+	"""Regular editing; doc may be None for the general capability"""
+	if ctx.is_admin:
+		return
+	# Only new, unsigned documents
+	if doc and (doc.status != "Новый" or (doc.signatures and len(doc.signatures) > 0)):
+		return _deny("Документ уже подписан или обработан. Редактирование доступно только администратору.")
+	if not (ctx.is_manager or ctx.is_director):
+		return _deny("You don't have permission to edit documents")
+
+
+def _rule_update_resolution(ctx, doc):
+	"""Director changes resolution and executors of a document on review"""
+	if not ctx.is_admin and (not doc.director_user or doc.director_user != ctx.user):
+		return _deny("Вы можете изменять только документы, назначенные вашей приёмной.")
+
+
+def _director_decision_rule(verb):
+	def rule(ctx, doc):
+		if not ctx.is_director and not ctx.is_admin:
+			return _deny(f"Only Director can {verb} documents")
+		if doc.status != "На рассмотрении":
+			return _deny(
+				f"Document must be in 'На рассмотрении' status to be {verb}d (Reception must process it first)",
+				frappe.ValidationError
+			)
+		if not ctx.is_admin and (not doc.director_user or doc.director_user != ctx.user):
+			return _deny(f"You can only {verb} documents assigned to your reception office")
+	return rule
+
+
+def _rule_approve_any(ctx, doc):
+	"""Act as a director at all: Admin, or Director of at least one reception office"""
+	if ctx.is_admin:
+		return
+	if not (ctx.is_director and ctx.directed_offices):
+		return _deny("Only Director can approve documents")
+
+
+def _rule_sign(ctx, doc):
+	"""Executor / co-executor signs a document in execution"""
+	if doc.status != "На исполнении":
+		return _deny("Document must be in 'На исполнении' status to be signed", frappe.ValidationError)
+	if not _is_executor(ctx, doc):
+		return _deny("You are not assigned as executor or co-executor for this document")
+	if any(sig.user == ctx.user for sig in doc.signatures or []):
+		return _deny("You have already signed this document", frappe.ValidationError)
+
+
+def _rule_reception_submit(ctx, doc):
+	# Admin is deliberately not allowed here
+	if not ctx.is_reception:
+		return _deny("Only Reception can submit documents to director")
+
+
+def _rule_stamp(ctx, doc):
+	if not (ctx.is_admin or ctx.is_manager or ctx.is_director):
+		return _deny("You don't have permission to apply stamps")
+
+
+def _rule_sign_pdf(ctx, doc):
+	if not (ctx.is_admin or ctx.is_manager or ctx.is_director):
+		return _deny("You don't have permission to sign documents")
+
+
+def _rule_delete_comment(ctx, doc):
+	if not ctx.is_admin:
+		return _deny("Only administrators can delete comments")
+
+
+RULES = {
+	"access": _rule_access,
+	"read": _rule_read,
+	"create": _rule_create,
+	"edit": _rule_edit,
+	"update_resolution": _rule_update_resolution,
+	"approve": _director_decision_rule("approve"),
+	"reject": _director_decision_rule("reject"),
+	"approve_any": _rule_approve_any,
+	"sign": _rule_sign,
+	"reception_submit": _rule_reception_submit,
+	"stamp": _rule_stamp,
+	"sign_pdf": _rule_sign_pdf,
+	"delete_comment": _rule_delete_comment,
+}
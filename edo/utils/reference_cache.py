@@ -0,0 +1,115 @@
+"""
+Site-scoped Redis cache of EDO reference data.
+
+Reference doctypes are small and rarely change, but are read on every document view,
+fiska and reception request. Each doctype is cached as one {name: row} map in a Redis hash
+and dropped from the controllers' on_update / on_trash / after_rename (see ReferenceDocument).
+"""
+import hashlib
+import json
+
+import frappe
+from frappe.model.document import Document
+
+CACHE_KEY = "edo_reference_data"
+VERSION_KEY = "__version__"
+
+# Cached doctypes and the fields kept for each of them
+REFERENCE_DOCTYPES = {
+	"EDO Correspondent": ["correspondent_name", "correspondent_type", "organization", "inn", "address", "contact_info"],
+	"EDO Document Type": ["document_type_name", "description"],
+	"EDO Priority": ["priority_name", "weight", "description"],
+	"EDO Classification": ["classification_name", "description"],
+	"EDO Delivery Method": ["delivery_method_name", "description"],
+	"EDO Resolution": ["resolution_name", "resolution_text", "is_active"],
+	"EDO Reception Office": ["reception_office_name", "director"],
+	"EDO Status": ["status_name", "color", "description"],
+}
+
+
+class ReferenceDocument(Document):
+	"""Base controller for REFERENCE_DOCTYPES: keeps the reference cache in sync"""
+
+	def on_update(self):
+		clear_reference_cache(self.doctype)
+
+	def on_trash(self):
+		clear_reference_cache(self.doctype)
+
+	def after_rename(self, old, new, merge=False):
+		clear_reference_cache(self.doctype)
+
+
+def get_reference_records(doctype):
+	"""All records of a reference doctype as {name: row}"""
+	if doctype not in REFERENCE_DOCTYPES:
+		frappe.throw(f"{doctype} is not a cached reference doctype", frappe.ValidationError)
+	return frappe.cache().hget(CACHE_KEY, doctype, generator=lambda: _load_records(doctype))
+
+
+def get_reference(doctype, name):
+	"""One cached reference record, or None if it doesn't exist"""
+	if not name:
+		return None
+	return get_reference_records(doctype).get(name)
+
+
+def get_reference_version():
+	"""Hash of all cached reference data; changes whenever any reference record changes"""
+	return frappe.cache().hget(CACHE_KEY, VERSION_KEY, generator=_compute_version)
+
+
+def clear_reference_cache(doctype=None):
+	"""Drop one doctype (or everything) from the cache, now and once the transaction commits"""
+
+	def clear():
+		if doctype:
+			frappe.cache().hdel(CACHE_KEY, doctype)
+			frappe.cache().hdel(CACHE_KEY, VERSION_KEY)
+		else:
+			frappe.cache().delete_value(CACHE_KEY)
+
+	clear()
+	# A request running between our save and commit could have cached the old rows
+	frappe.db.after_commit.add(clear)
+
+
+@frappe.whitelist()
+def get_reference_bundle(version=None):
+	"""
+	Reference data of the portal in one response: every REFERENCE_DOCTYPES section the user
+	may read.
+
+	The client keeps the returned version; when it sends it back and nothing changed,
+	only {version, unchanged: True} is returned. The version covers the sections sent, so a
+	user who gains or loses read access gets a new bundle.
+	"""
+	from edo.utils.policy import check, get_user_context
+
+	check(get_user_context(), "access")
+
+	# The cache is shared by all users: permissions are applied to what is read from it
+	doctypes = [doctype for doctype in REFERENCE_DOCTYPES if frappe.has_permission(doctype, "read")]
+	current_version = hashlib.md5(f"{get_reference_version()}:{','.join(doctypes)}".encode()).hexdigest()
+	if version and version == current_version:
+		return {"version": current_version, "unchanged": True}
+
+	return {
+		"version": current_version,
+		"unchanged": False,
+		"data": {
+			doctype: sorted(get_reference_records(doctype).values(), key=lambda row: row["name"])
+			for doctype in doctypes
+		},
+	}
+
+
+def _load_records(doctype):
+	rows = frappe.get_all(doctype, fields=["name", *REFERENCE_DOCTYPES[doctype]], order_by="name asc")
+	return {row.name: row for row in rows}
+
+
+def _compute_version():
+	data = {doctype: get_reference_records(doctype) for doctype in REFERENCE_DOCTYPES}
+	payload = json.dumps(data, sort_keys=True, default=str)
+	return hashlib.md5(payload.encode()).hexdigest()
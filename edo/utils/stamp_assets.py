@@ -0,0 +1,260 @@
+"""
+Process-level cache of decoded stamp assets.
+
+Stamping decodes the same seal for every page it is put on. The decoded, RGBA-normalized image
+and the field mappings of an EDO Stamp are kept here in an LRU bounded by the images' byte size
+(site config: edo_stamp_cache_mb).
+
+Entries are keyed by site, stamp name, image content hash and the stamp's modified, so a changed
+stamp or image file is never served stale - even by other worker processes. EDOStamp.on_update /
+on_trash drop the stamp's entries from the current process early.
+
+Stamps filled with document data are cached the same way (get_rendered_stamp), keyed by the
+stamp's asset key, a hash of its field mappings and the resolved texts: a batch of documents
+sharing the director or resolution renders each filled stamp once per process.
+
+Before embedding, images are resampled to the resolution they are printed at (get_placed_stamp):
+a scan drawn at scale 0.15 doesn't need its full resolution in the PDF. Target DPI: site config
+edo_stamp_dpi. Fully opaque images are embedded without an alpha channel (no soft mask).
+
+Cached images are shared: copy them before drawing on them.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import frappe
+from frappe.utils import cint
+from frappe.utils.caching import request_cache
+
+DEFAULT_CACHE_MB = 64
+DEFAULT_STAMP_DPI = 200
+
+MAPPING_FIELDS = ("document_field", "position_x", "position_y", "font_size", "color", "max_width")
+
+# (path, mtime, size) -> content hash, so unchanged files are hashed only once
+_file_hashes = {}
+
+
+class _ImageLRU:
+	"""LRU of objects with an nbytes attribute, bounded by their total size"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.entries = OrderedDict()
+		self.nbytes = 0
+
+	def get(self, key):
+		with self.lock:
+			value = self.entries.get(key)
+			if value is not None:
+				self.entries.move_to_end(key)
+			return value
+
+	def put(self, key, value):
+		max_bytes = _max_bytes()
+		if value.nbytes > max_bytes:
+			return
+		with self.lock:
+			if key in self.entries:
+				return
+			self.entries[key] = value
+			self.nbytes += value.nbytes
+			while self.nbytes > max_bytes:
+				_, evicted = self.entries.popitem(last=False)
+				self.nbytes -= evicted.nbytes
+
+	def discard(self, predicate):
+		with self.lock:
+			for key in list(self.entries):
+				if predicate(key):
+					self.nbytes -= self.entries.pop(key).nbytes
+
+	def info(self):
+		with self.lock:
+			return {"entries": len(self.entries), "bytes": self.nbytes}
+
+
+_assets = _ImageLRU()
+_rendered = _ImageLRU()
+_placed = _ImageLRU()
+
+
+class StampAsset:
+	__slots__ = ("key", "name", "image", "field_mappings", "mappings_hash", "content_hash", "modified", "nbytes")
+
+	def __init__(self, key, name, image, field_mappings, content_hash, modified):
+		self.key = key
+		self.name = name
+		self.image = image
+		self.field_mappings = field_mappings
+		self.mappings_hash = hashlib.md5(frappe.as_json(field_mappings, indent=None).encode()).hexdigest()
+		self.content_hash = content_hash
+		self.modified = modified
+		self.nbytes = _image_bytes(image)
+
+
+class CachedImage:
+	__slots__ = ("image", "nbytes")
+
+	def __init__(self, image):
+		self.image = image
+		self.nbytes = _image_bytes(image)
+
+
+def get_stamp_asset(stamp_name):
+	"""
+	Decoded asset of an EDO Stamp.
+
+	Raises DoesNotExistError for unknown stamps and ValidationError when the image is missing
+	or can't be decoded.
+	"""
+	stamp = _get_stamp_row(stamp_name)
+	# Raised, not thrown: stamping catches these per stamp and must not queue a message each time
+	if not stamp:
+		raise frappe.DoesNotExistError(f"EDO Stamp {stamp_name} not found")
+	if not stamp.stamp_image:
+		raise frappe.ValidationError("Штамп не имеет изображения")
+
+	path = _stamp_image_path(stamp.stamp_image)
+	if not path or not os.path.exists(path):
+		raise frappe.ValidationError("Изображение штампа не найдено")
+
+	content_hash = _content_hash(path)
+	key = (frappe.local.site, stamp.name, content_hash, str(stamp.modified))
+	asset = _assets.get(key)
+	if asset:
+		return asset
+
+	asset = StampAsset(key, stamp.name, _load_image(path), _load_field_mappings(stamp.name), content_hash, stamp.modified)
+	_assets.put(key, asset)
+	return asset
+
+
+def get_rendered_stamp(asset, texts, render):
+	"""
+	Stamp image filled with document data: texts are the resolved field texts (one per field
+	mapping, hashable), render() draws them on a copy of the asset image when not cached.
+	"""
+	key = rendered_stamp_key(asset, texts)
+	rendered = _rendered.get(key)
+	if rendered:
+		return rendered.image
+
+	rendered = CachedImage(render())
+	_rendered.put(key, rendered)
+	return rendered.image
+
+
+def rendered_stamp_key(asset, texts):
+	return (*asset.key, asset.mappings_hash, tuple(texts))
+
+
+def get_placed_stamp(key, image, scale):
+	"""
+	Image to embed for a stamp image drawn at scale (PDF points per image pixel): downsampled
+	to edo_stamp_dpi at that size, RGB when fully opaque. key is the image's cache key
+	(StampAsset.key or rendered_stamp_key); the image's original size stays its drawing size.
+	"""
+	dpi = cint(frappe.conf.get("edo_stamp_dpi") or DEFAULT_STAMP_DPI)
+	placed_key = (*key, round(scale, 4), dpi)
+	placed = _placed.get(placed_key)
+	if placed:
+		return placed.image
+
+	placed = CachedImage(_resample(image, scale, dpi))
+	_placed.put(placed_key, placed)
+	return placed.image
+
+
+def clear_stamp_assets(stamp_name=None):
+	"""Drop cached assets and rendered images of one stamp (or all) of the current site from this process"""
+	site = frappe.local.site
+
+	def matches(key):
+		return key[0] == site and (stamp_name is None or key[1] == stamp_name)
+
+	_assets.discard(matches)
+	_rendered.discard(matches)
+	_placed.discard(matches)
+
+
+def get_cache_info():
+	return {
+		"assets": _assets.info(),
+		"rendered": _rendered.info(),
+		"placed": _placed.info(),
+		"max_bytes": _max_bytes(),
+	}
+
+
+@request_cache
+def _get_stamp_row(stamp_name):
+	# One cheap lookup per stamp and request, not per page
+	return frappe.db.get_value("EDO Stamp", stamp_name, ["name", "stamp_image", "modified"], as_dict=True)
+
+
+def _stamp_image_path(file_url):
+	from edo.edo.doctype.edo_document.edo_document import get_file_path
+	from edo.utils.file_access import resolve_file_path
+
+	# /files and /private/files are resolved without reading the File table
+	relative_path, full_path = resolve_file_path(file_url)
+	return full_path or get_file_path(file_url)
+
+
+def _content_hash(path):
+	stat = os.stat(path)
+	file_key = (path, stat.st_mtime_ns, stat.st_size)
+	content_hash = _file_hashes.get(file_key)
+	if not content_hash:
+		with open(path, "rb") as f:
+			content_hash = hashlib.md5(f.read()).hexdigest()
+		if len(_file_hashes) > 1024:
+			_file_hashes.clear()
+		_file_hashes[file_key] = content_hash
+	return content_hash
+
+
+def _load_image(path):
+	from PIL import Image
+
+	try:
+		with Image.open(path) as image:
+			image = image.convert("RGBA") if image.mode != "RGBA" else image.copy()
+	except Exception as e:
+		raise frappe.ValidationError(f"Failed to open stamp image {path}: {str(e)}")
+	return image
+
+
+def _load_field_mappings(stamp_name):
+	return tuple(frappe.get_all(
+		"EDO Stamp Field Mapping",
+		filters={"parent": stamp_name, "parenttype": "EDO Stamp", "parentfield": "field_mappings"},
+		fields=list(MAPPING_FIELDS),
+		order_by="idx asc"
+	))
+
+
+def _resample(image, scale, dpi):
+	from PIL import Image
+
+	# Pixels needed for the printed size: points * dpi / 72
+	width = max(1, round(image.width * scale * dpi / 72))
+	height = max(1, round(image.height * scale * dpi / 72))
+	if width < image.width and height < image.height:
+		image = image.resize((width, height), Image.Resampling.LANCZOS)
+
+	# Alpha that is 255 everywhere only adds a soft mask to the PDF
+	if image.mode == "RGBA" and image.getchannel("A").getextrema() == (255, 255):
+		image = image.convert("RGB")
+	return image
+
+
+def _image_bytes(image):
+	return image.width * image.height * len(image.getbands())
+
+
+def _max_bytes():
+	return cint(frappe.conf.get("edo_stamp_cache_mb") or DEFAULT_CACHE_MB) * 1024 * 1024
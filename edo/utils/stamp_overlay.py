@@ -0,0 +1,107 @@
+"""
+Overlay PDFs with the stamps of a document's pages.
+
+Stamping is planned in the calling process: stamp images, positions and text lines come from
+frappe data and the stamp caches. The overlays are drawn from the plan alone, so large documents
+can be drawn by other processes:
+
+	overlays = render_overlays(plan, images, font_path)  # overlay PDFs, one page per plan entry
+
+	plan:   [(page_width, page_height, ops), ...] - in page order
+	ops:    ("image", image_key, x, y, width, height) - images[image_key] is a PIL image
+	        ("text", x, y, font_size, (r, g, b), line)
+
+An overlay draws each image once, as a form XObject shared by all of its pages. Plans of at least
+edo_stamp_parallel_min_pages pages (default DEFAULT_PARALLEL_MIN_PAGES) are split into consecutive
+chunks drawn by a pool of edo_stamp_workers processes (site config; 0 - the default - draws
+everything in-process). The pool uses the spawn start method (forked copies of a worker would
+share its DB connection) and lives only for the call: RQ work horses exit with os._exit and would
+orphan a kept pool. Each worker imports reportlab and PIL again, which costs more than drawing the
+few pages of a typical document - hence the page threshold. If the pool fails, the plan is drawn
+in-process. Compare both on this server before enabling:
+
+	bench --site <site> execute edo.utils.benchmarks.benchmark_stamp_render --kwargs "{'pages': 300, 'workers': 4}"
+"""
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import frappe
+from frappe.utils import cint
+
+DEFAULT_PARALLEL_MIN_PAGES = 100
+
+
+def render_overlays(plan, images, font_path):
+	"""Overlay PDF bytes for the plan: one document, or one per chunk when drawn in parallel"""
+	workers = cint(frappe.conf.get("edo_stamp_workers"))
+	min_pages = cint(frappe.conf.get("edo_stamp_parallel_min_pages") or DEFAULT_PARALLEL_MIN_PAGES)
+	if workers < 2 or len(plan) < max(min_pages, 2):
+		return [render_overlay(plan, images, font_path)]
+
+	try:
+		return render_overlays_in_pool(plan, images, font_path, workers)
+	except Exception:
+		# Broken pool, unpicklable plan, worker crash: the same overlay, drawn here
+		frappe.log_error(f"Parallel stamp rendering failed, rendering {len(plan)} pages in-process", "stamp_render_pool_error")
+		return [render_overlay(plan, images, font_path)]
+
+
+def render_overlays_in_pool(plan, images, font_path, workers):
+	"""Overlays of consecutive chunks of the plan, drawn by a pool of workers started for this call"""
+	chunk_size = -(-len(plan) // workers)
+	chunks = [plan[start:start + chunk_size] for start in range(0, len(plan), chunk_size)]
+	with ProcessPoolExecutor(max_workers=len(chunks), mp_context=multiprocessing.get_context("spawn")) as pool:
+		futures = [pool.submit(render_overlay, chunk, _chunk_images(chunk, images), font_path) for chunk in chunks]
+		return [future.result() for future in futures]
+
+
+def render_overlay(plan, images, font_path):
+	"""Overlay PDF with one page per plan entry"""
+	from reportlab.lib.utils import ImageReader
+	from reportlab.pdfgen import canvas
+
+	from edo.utils.fonts import PDF_FALLBACK_FONT, get_pdf_font_name
+
+	packet = io.BytesIO()
+	c = canvas.Canvas(packet)
+	# image key -> form name
+	forms = {}
+
+	for page_width, page_height, ops in plan:
+		c.setPageSize((page_width, page_height))
+		for op in ops:
+			if op[0] == "image":
+				_, image_key, x, y, width, height = op
+				image = images[image_key]
+				image_w, image_h = image.size
+				if image_key not in forms:
+					forms[image_key] = f"edo_stamp_{len(forms)}"
+					c.beginForm(forms[image_key], 0, 0, image_w, image_h)
+					c.drawImage(ImageReader(image), 0, 0, width=image_w, height=image_h, mask='auto')
+					c.endForm()
+				c.saveState()
+				c.translate(x, y)
+				c.scale(width / image_w, height / image_h)
+				c.doForm(forms[image_key])
+				c.restoreState()
+			else:
+				_, x, y, font_size, color, line = op
+				c.setFillColorRGB(*(channel / 255 for channel in color))
+				c.setFont(get_pdf_font_name(font_path) or PDF_FALLBACK_FONT, font_size)
+				c.drawString(x, y, line)
+		c.showPage()
+
+	c.save()
+	return packet.getvalue()
+
+
+def _chunk_images(chunk, images):
+	"""Only the images a chunk draws are sent to its worker"""
+	return {
+		op[1]: images[op[1]]
+		for page_width, page_height, ops in chunk
+		for op in ops
+		if op[0] == "image"
+	}
+
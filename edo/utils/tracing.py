@@ -0,0 +1,152 @@
+"""
+Lightweight tracing of slow operations (stamping).
+
+A trace is a named operation with timed spans inside it; traces replace Error Log rows that
+only said "this worked". Error Log stays for failures.
+
+	with trace("apply_stamps", document=name) as t:
+		with span("parse"):
+			...
+		save = start_span("save")
+		...
+		save.finish(file=file_url)
+		t.set(stamps=applied)
+
+Spans outside a trace cost nothing and are dropped. Finished traces go to a Redis list of the
+last TRACE_BUFFER_SIZE traces: all failed ones, successful ones with the probability of the
+site config edo_trace_sample_rate (default 0.1). Read them with:
+
+	bench --site <site> execute edo.utils.tracing.get_recent_traces
+"""
+import random
+import time
+from contextlib import contextmanager
+
+import frappe
+from frappe.utils import flt, now
+
+TRACE_BUFFER_KEY = "edo_traces"
+TRACE_BUFFER_SIZE = 200
+DEFAULT_SAMPLE_RATE = 0.1
+
+
+class Span:
+	__slots__ = ("name", "attrs", "started", "duration_ms")
+
+	def __init__(self, name, attrs):
+		self.name = name
+		self.attrs = attrs
+		self.started = time.perf_counter()
+		self.duration_ms = None
+
+	def set(self, **attrs):
+		self.attrs.update(attrs)
+
+	def finish(self, **attrs):
+		self.attrs.update(attrs)
+		if self.duration_ms is None:
+			self.duration_ms = round((time.perf_counter() - self.started) * 1000, 3)
+
+	def as_dict(self):
+		return {"name": self.name, "duration_ms": self.duration_ms, **self.attrs}
+
+
+class Trace(Span):
+	__slots__ = ("spans", "timestamp", "error")
+
+	def __init__(self, name, attrs):
+		super().__init__(name, attrs)
+		self.spans = []
+		self.timestamp = now()
+		self.error = None
+
+	def as_dict(self):
+		return {
+			**super().as_dict(),
+			"timestamp": self.timestamp,
+			"error": self.error,
+			"spans": [span.as_dict() for span in self.spans],
+		}
+
+
+class _NoSpan:
+	"""Span outside of a trace"""
+
+	def set(self, **attrs):
+		pass
+
+	def finish(self, **attrs):
+		pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+@contextmanager
+def trace(name, **attrs):
+	"""Trace an operation; nested traces become spans of the outer one"""
+	outer = current_trace()
+	if outer:
+		with span(name, **attrs) as nested:
+			yield nested
+		return
+
+	current = Trace(name, attrs)
+	frappe.local.edo_trace = current
+	try:
+		yield current
+	except Exception as e:
+		current.error = str(e)[:500]
+		raise
+	finally:
+		frappe.local.edo_trace = None
+		current.finish()
+		for open_span in current.spans:
+			open_span.finish()
+		_record(current)
+
+
+@contextmanager
+def span(name, **attrs):
+	"""Time a step of the current trace"""
+	current = start_span(name, **attrs)
+	try:
+		yield current
+	finally:
+		current.finish()
+
+
+def start_span(name, **attrs):
+	"""Span of the current trace, timed until finish() (or the end of the trace)"""
+	current = current_trace()
+	if not current:
+		return _NO_SPAN
+	new_span = Span(name, attrs)
+	current.spans.append(new_span)
+	return new_span
+
+
+def current_trace():
+	return getattr(frappe.local, "edo_trace", None)
+
+
+def get_recent_traces(limit=20, name=None):
+	"""Last recorded traces, newest first (optionally of one operation)"""
+	traces = [frappe.parse_json(value) for value in frappe.cache().lrange(TRACE_BUFFER_KEY, 0, TRACE_BUFFER_SIZE - 1)]
+	if name:
+		traces = [t for t in traces if t.get("name") == name]
+	return traces[: int(limit)]
+
+
+def _record(current):
+	sample_rate = frappe.conf.get("edo_trace_sample_rate")
+	sample_rate = DEFAULT_SAMPLE_RATE if sample_rate is None else flt(sample_rate)
+	if not current.error and random.random() >= sample_rate:
+		return
+	try:
+		cache = frappe.cache()
+		cache.lpush(TRACE_BUFFER_KEY, frappe.as_json(current.as_dict(), indent=None))
+		cache.ltrim(TRACE_BUFFER_KEY, 0, TRACE_BUFFER_SIZE - 1)
+	except Exception:
+		# Tracing never breaks the traced operation
+		pass